@@ -0,0 +1,58 @@
+"""Measure appends, and searches d messages behind the newest one, with the right-edge finger search that insert
+uses and with the descent from the root that it replaced.
+
+Usage: python3 bench_append.py [message_count ...]   (defaults to 10000 100000 1000000)
+"""
+import gc
+import sys
+import time
+
+from prolly_tree import ProllyTree, Message, Node
+
+APPENDS = 20000
+SEARCHES = 20000
+DISTANCES = (1, 100, 10000)
+
+
+def insert_from_root(tree, message):
+    """insert() as it was before the finger search: every insert descends from the root."""
+    new_node = Node(message.data, message.timestamp, hasher=tree.hasher)
+    tree._insert_node_at_level(new_node, right_of_new_node=tree._find_node_greater_than(new_node.timestamp))
+    tree._mark_inserted_node_dirty(new_node)
+
+
+def per_call_us(function, arguments):
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for argument in arguments:
+            function(argument)
+        return (time.perf_counter() - start) / len(arguments) * 1e6
+    finally:
+        gc.enable()
+
+
+def main(*counts):
+    for count in counts or (10000, 100000, 1000000):
+        tree = ProllyTree.from_sorted_iter(Message(i * 2, i * 2) for i in range(count))
+        print(f"{count} messages, height {len(tree)}")
+        print("  search d back |   finger |  from root")
+        for distance in DISTANCES:
+            if distance > count:
+                continue
+            keys = [2 * (count - distance) + 1] * SEARCHES
+            print(f"  {distance:>13} | {per_call_us(tree._finger_search, keys):>5.2f} us | "
+                  f"{per_call_us(tree._find_node_greater_than, keys):>7.2f} us")
+
+        # appends, hashes included: the merkel hashes are flushed once at the end
+        timestamps = range(count * 2, count * 2 + APPENDS)
+        finger = per_call_us(tree.insert, [Message(t, t) for t in timestamps])
+        tree.get_root().merkel_hash
+        timestamps = range(count * 2 + APPENDS, count * 2 + 2 * APPENDS)
+        from_root = per_call_us(lambda m: insert_from_root(tree, m), [Message(t, t) for t in timestamps])
+        tree.get_root().merkel_hash
+        print(f"  append insert | {finger:>5.2f} us | {from_root:>7.2f} us")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
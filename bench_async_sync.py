@@ -0,0 +1,66 @@
+"""Show the latency win of pipelined and concurrent asyncio sync sessions against local peers with artificial latency.
+
+Usage: python3 bench_async_sync.py [message_count] [latency_ms]   (defaults to 20000 and 10)
+"""
+import asyncio
+import random
+import sys
+import time
+
+from prolly_tree import ProllyTree, Message
+from prolly_async_sync import AsyncSyncServer, AsyncSyncClient, reconcile_with_peers
+
+DIVERGENCES = [1, 10, 100]
+PEERS = 16
+
+
+def peer_tree(count, missing, rng):
+    dropped = set(rng.sample(range(count), missing))
+    return ProllyTree([Message(i, i) for i in range(count) if i not in dropped])
+
+
+async def session(tree, address, max_in_flight):
+    client = await AsyncSyncClient.connect(tree, address, max_in_flight=max_in_flight)
+    try:
+        start = time.perf_counter()
+        await client.reconcile()
+        return time.perf_counter() - start, client.stats.round_trips
+    finally:
+        await client.close()
+
+
+async def main(count=20000, latency_ms=10):
+    rng = random.Random(5)
+    latency = latency_ms / 1000
+    local = ProllyTree([Message(i, i) for i in range(count)])
+    print(f"{count} messages, {latency_ms} ms per response")
+
+    print("\nOne session")
+    print("    missing | round trips | one in flight | pipelined | speedup")
+    for missing in DIVERGENCES:
+        server = await AsyncSyncServer(peer_tree(count, missing, rng), latency=latency).start()
+        address = server.sockets[0].getsockname()[:2]
+        serial, round_trips = await session(local, address, 1)
+        pipelined, _ = await session(local, address, 64)
+        server.close()
+        await server.wait_closed()
+        print(f"    {missing:>7} | {round_trips:>11} | {serial:>12.3f}s | {pipelined:>8.3f}s | {serial / pipelined:>6.1f}x")
+
+    print(f"\n{PEERS} peers missing 10 messages each")
+    servers = [await AsyncSyncServer(peer_tree(count, 10, rng), latency=latency).start() for _ in range(PEERS)]
+    addresses = [s.sockets[0].getsockname()[:2] for s in servers]
+    start = time.perf_counter()
+    for address in addresses:
+        await session(local, address, 64)
+    one_by_one = time.perf_counter() - start
+    start = time.perf_counter()
+    await reconcile_with_peers(local, addresses)
+    concurrent = time.perf_counter() - start
+    for server in servers:
+        server.close()
+        await server.wait_closed()
+    print(f"    one after another {one_by_one:.3f}s, concurrently {concurrent:.3f}s, {one_by_one / concurrent:.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*[int(arg) for arg in sys.argv[1:3]]))
@@ -0,0 +1,41 @@
+"""Report tree height, node count, memory and diff round trips for different target fanouts.
+
+A diff exchanges one level per round trip, so the height sets the number of rounds and the bucket size sets how
+many entries each round carries. The estimated latency is the round trips times the given link round-trip time.
+
+Usage: python3 bench_fanout.py [message_count] [rtt_ms]   (defaults to 100000 50)
+"""
+import sys
+import tracemalloc
+
+from prolly_tree import ProllyTree, Message
+
+BOUNDARY_BITS = [None, 1, 2, 3, 4, 5, 6, 8]
+
+
+def report(messages, boundary_bits, rtt_ms):
+    tracemalloc.start()
+    tree = ProllyTree(messages, boundary_bits=boundary_bits)
+    tree.get_root().merkel_hash
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    level_sizes = [len(level.to_list()) for level in tree]
+    # entries sent for one diverging message: one bucket on every level below the root
+    bucket_sizes = [below / above for below, above in zip(level_sizes, level_sizes[1:])]
+    round_trips = len(tree)
+    label = "original" if boundary_bits is None else f"{boundary_bits} bits"
+    print(f"    {label:>8} | {len(tree):>6} | {sum(level_sizes):>9} | {memory / len(messages):>9.1f} | "
+          f"{round_trips:>11} | {sum(bucket_sizes):>12.1f} | {round_trips * rtt_ms:>8.0f}ms")
+
+
+def main(count=100000, rtt_ms=50):
+    messages = [Message(i, i) for i in range(count)]
+    print(f"{count} messages, {rtt_ms}ms round trip")
+    print("      fanout | height |     nodes | bytes/msg | round trips | entries/diff |  latency")
+    for boundary_bits in BOUNDARY_BITS:
+        report(messages, boundary_bits, rtt_ms)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,39 @@
+"""Compare building one tree with building an epoch-sharded forest in one process and with a process pool, and time
+dropping an epoch against deleting its messages one by one.
+
+Usage: python3 bench_forest.py [message_count] [epoch_count] [processes]   (defaults to 500000, 24 and all CPUs)
+"""
+import os
+import sys
+import time
+
+from prolly_tree import ProllyTree, Message
+from prolly_forest import ProllyForest
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def main(count=500000, epoch_count=24, processes=None):
+    processes = processes or os.cpu_count()
+    epoch_length = count // epoch_count
+    messages = [Message(i, i) for i in range(count)]
+
+    tree_seconds, tree = timed(ProllyTree, messages)
+    forest_seconds, forest = timed(ProllyForest, messages, epoch_length=epoch_length)
+    pool_seconds, _ = timed(ProllyForest.build, messages, epoch_length=epoch_length, processes=processes)
+    delete_seconds, _ = timed(lambda: [tree.delete(i) for i in range(epoch_length)])
+    drop_seconds, _ = timed(forest.drop_epoch, 0)
+
+    print(f"{count} messages in {epoch_count} epochs")
+    print(f"    build one tree                : {tree_seconds:8.3f}s")
+    print(f"    build forest in one process   : {forest_seconds:8.3f}s")
+    print(f"    build forest in {processes:>2} processes  : {pool_seconds:8.3f}s")
+    print(f"    delete an epoch one by one    : {delete_seconds:8.3f}s")
+    print(f"    drop an epoch                 : {drop_seconds:8.6f}s")
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:4]])
@@ -0,0 +1,29 @@
+"""Compare tree build time under the available hashing schemes.
+
+Usage: python3 bench_hashing.py [message_count]   (defaults to 200000)
+"""
+import sys
+import time
+
+from prolly_tree import ProllyTree, Message, Hasher
+
+SCHEMES = [
+    ("sha256, hex digests (compatible)", Hasher()),
+    ("sha256, raw digests", Hasher(hex_digests=False)),
+    ("blake2b-256, raw digests", Hasher("blake2b", hex_digests=False, digest_size=32)),
+]
+
+
+def main(count=200000):
+    messages = [Message(b"payload %d" % i, i) for i in range(count)]
+    print(f"building a tree of {count} messages")
+    for label, hasher in SCHEMES:
+        start = time.perf_counter()
+        tree = ProllyTree(messages, hasher=hasher)
+        tree.get_root().merkel_hash
+        seconds = time.perf_counter() - start
+        print(f"    {label:<34}: {seconds:.3f}s ({count / seconds:,.0f} msg/s)")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
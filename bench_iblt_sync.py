@@ -0,0 +1,40 @@
+"""Compare round trips and bytes of the plain level-by-level descent with the hybrid mode that finishes with one
+invertible Bloom lookup table exchange, for peers missing a few to many messages.
+
+Usage: python3 bench_iblt_sync.py [message_count] [iblt_max_leaves]   (defaults to 100000 1024)
+"""
+import random
+import sys
+
+from prolly_tree import ProllyTree, Message
+from prolly_sync import SyncServer, SyncClient, LoopbackTransport
+
+DIVERGENCES = [1, 10, 100, 10000]
+
+
+def main(count=100000, iblt_max_leaves=1024):
+    rng = random.Random(5)
+    tree1 = ProllyTree([Message(i, i) for i in range(count)])
+    print(f"{count} messages on the local side, height {len(tree1)}, iblt_max_leaves={iblt_max_leaves}")
+    print("    missing |   spread  |   mode | round trips |   bytes sent | bytes received | fell back")
+    for missing in DIVERGENCES:
+        for spread in ["random", "clustered"]:
+            if spread == "random":
+                dropped = set(rng.sample(range(count), missing))
+            else:
+                first = rng.randrange(count - missing)
+                dropped = set(range(first, first + missing))
+            tree2 = ProllyTree([Message(i, i) for i in range(count) if i not in dropped])
+            for mode in ["plain", "hybrid"]:
+                client = SyncClient(tree2, LoopbackTransport(SyncServer(tree1)),
+                                    iblt_max_leaves=iblt_max_leaves if mode == "hybrid" else None)
+                _, only_remote = client.reconcile()
+                assert len(only_remote) == missing
+                stats = client.stats
+                print(f"    {missing:>7} | {spread:>9} | {mode:>6} | {stats.round_trips:>11} | "
+                      f"{stats.bytes_sent:>12,} | {stats.bytes_received:>14,} | "
+                      f"{'yes' if client.iblt_fell_back else '':>9}")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,46 @@
+"""Compare loading a saved tree image with rebuilding the tree from its messages.
+
+Usage: python3 bench_image.py [message_count]   (defaults to 1000000)
+"""
+import os
+import sys
+import tempfile
+import time
+
+from prolly_tree import ProllyTree, Message
+from prolly_compact import CompactProllyTree
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def main(count=1000000):
+    messages = [Message(i, i) for i in range(count)]
+    build_seconds, tree = timed(ProllyTree, messages)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "tree.img")
+        save_seconds, _ = timed(tree.save, path)
+        size = os.path.getsize(path)
+        root_hash = tree.get_root().merkel_hash
+        del tree
+
+        map_seconds, compact = timed(CompactProllyTree.load, path)
+        assert compact.get_root().merkel_hash == root_hash
+        verify_seconds, _ = timed(compact.verify)
+        del compact
+        load_seconds, tree = timed(ProllyTree.load, path)
+        assert tree.get_root().merkel_hash == root_hash
+
+    print(f"{count} messages, image of {size / 1e6:.1f} MB ({size / count:.1f} bytes/message)")
+    print(f"    rebuild from messages         : {build_seconds:8.3f}s")
+    print(f"    save image                    : {save_seconds:8.3f}s")
+    print(f"    map image (CompactProllyTree) : {map_seconds:8.3f}s")
+    print(f"    verify every hash             : {verify_seconds:8.3f}s")
+    print(f"    load into ProllyTree          : {load_seconds:8.3f}s")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
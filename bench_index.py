@@ -0,0 +1,56 @@
+"""Compare lookups through the exact-key index with the pointer walk from the root, and measure what the index costs
+in memory.
+
+Usage: python3 bench_index.py [message_count ...]   (defaults to 10000 100000 1000000)
+"""
+import random
+import sys
+import time
+import tracemalloc
+
+from prolly_tree import ProllyTree, Message
+
+LOOKUPS = 20000
+
+
+def per_lookup_us(function, arguments):
+    start = time.perf_counter()
+    for argument in arguments:
+        function(argument)
+    return (time.perf_counter() - start) / len(arguments) * 1e6
+
+
+def measure(tree, hits, misses, batch, level):
+    start = time.perf_counter()
+    tree.missing(batch)
+    missing = (time.perf_counter() - start) / len(batch) * 1e6
+    return [per_lookup_us(tree.search, hits),
+            per_lookup_us(tree.search, misses),
+            per_lookup_us(lambda timestamp: tree.get_intermediate_node(timestamp, level), hits),
+            missing]
+
+
+def main(*counts):
+    print("  messages | index bytes/msg |        | hit search | miss search | get_intermediate_node | missing()")
+    for count in counts or (10000, 100000, 1000000):
+        rng = random.Random(count)
+        tree = ProllyTree.from_sorted_iter(Message(i * 2, i * 2) for i in range(count))
+        hits = [rng.randrange(count) * 2 for _ in range(LOOKUPS)]
+        misses = [t + 1 for t in hits]
+        # a sync batch where half the messages are already held
+        batch = [Message(t, t) for pair in zip(hits, misses) for t in pair][:LOOKUPS]
+        level = min(3, len(tree) - 1)
+
+        walk = measure(tree, hits, misses, batch, level)
+        tracemalloc.start()
+        tree.build_index()
+        index_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        indexed = measure(tree, hits, misses, batch, level)
+        for name, row, size in [("walk", walk, f"{'':>15}"), ("index", indexed, f"{index_bytes / count:>15.1f}")]:
+            print(f"  {count:>8} | {size} | {name:>6} | {row[0]:>7.2f} us | {row[1]:>8.2f} us | "
+                  f"{row[2]:>18.2f} us | {row[3]:>6.2f} us")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,44 @@
+"""Compare inserting a batch with insert_many against a loop of insert.
+
+Usage: python3 bench_insert_many.py [tree_size] [batch_size]   (defaults to 100000 10000)
+"""
+import random
+import sys
+import time
+
+from prolly_tree import ProllyTree, Message
+
+
+def main(tree_size=100000, batch_size=10000):
+    rng = random.Random(1)
+    keys = rng.sample(range(10 * (tree_size + batch_size)), tree_size + batch_size)
+    existing = [Message(i, i) for i in sorted(keys[:tree_size])]
+    batch = [Message(i, i) for i in keys[tree_size:]]
+
+    tree = ProllyTree(existing)
+    start = time.perf_counter()
+    for message in batch:
+        tree.insert(message)
+    loop_seconds = time.perf_counter() - start
+
+    tree = ProllyTree(existing)
+    start = time.perf_counter()
+    for message in batch:
+        tree.insert_many([message])
+        tree.get_root().merkel_hash
+    single_seconds = time.perf_counter() - start
+
+    tree = ProllyTree(existing)
+    start = time.perf_counter()
+    tree.insert_many(batch)
+    tree.get_root().merkel_hash
+    batch_seconds = time.perf_counter() - start
+
+    print(f"{batch_size} messages into a tree of {tree_size}")
+    for label, seconds, note in [("loop of insert", loop_seconds, "merkel hashes left stale"),
+                                 ("loop of insert_many([m])", single_seconds, "merkel hashes refreshed per message"),
+                                 ("insert_many(batch)", batch_seconds, "merkel hashes refreshed once")]:
+        print(f"    {label:<26}: {seconds:.3f}s ({batch_size / seconds:,.0f} msg/s, {note})")
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
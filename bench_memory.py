@@ -0,0 +1,37 @@
+"""Report the memory a Prolly tree spends per message, for the linked Node tree and the compact array form.
+
+Usage: python3 bench_memory.py [message_count ...]   (defaults to 1000000 10000000)
+"""
+import sys
+import tracemalloc
+
+from prolly_tree import ProllyTree, Message
+from prolly_compact import CompactProllyTree
+
+
+def measure(build, messages):
+    """Return the bytes still allocated by build(messages) once it has returned, and the result."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build(messages)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, result
+
+
+def report(count):
+    messages = [Message(i, i) for i in range(count)]
+    linked_bytes, tree = measure(ProllyTree, messages)
+    node_count = sum(len(level.to_list()) for level in tree)
+    del tree
+    compact_bytes, compact = measure(CompactProllyTree.from_sorted_iter, messages)
+    print(f"{count:>10} messages, {node_count} nodes")
+    print(f"    linked tree : {linked_bytes / count:8.1f} bytes/message")
+    print(f"    compact tree: {compact_bytes / count:8.1f} bytes/message "
+          f"({compact.nbytes() / count:.1f} in level arrays)")
+
+
+if __name__ == "__main__":
+    counts = [int(arg) for arg in sys.argv[1:]] or [1000000, 10000000]
+    for count in counts:
+        report(count)
@@ -0,0 +1,35 @@
+"""Show how building a tree scales when its leaves are hashed by a LeafHashPool of threads or processes.
+
+Usage: python3 bench_parallel_hashing.py [message_count] [payload_bytes ...]   (defaults to 20000 and 64 4096 65536)
+"""
+import os
+import sys
+import time
+
+from prolly_tree import ProllyTree, Message, Hasher, LeafHashPool
+
+
+def build_seconds(messages, hasher, pool=None):
+    start = time.perf_counter()
+    ProllyTree.from_sorted_iter(messages, hasher, hash_pool=pool)
+    return time.perf_counter() - start
+
+
+def main(count=20000, *payload_sizes):
+    hasher = Hasher(hex_digests=False)
+    worker_counts = sorted({1, 2, os.cpu_count() or 1})
+    print(f"{count} messages, {os.cpu_count()} CPUs")
+    for size in payload_sizes or (64, 4096, 65536):
+        messages = [Message(i.to_bytes(8, "big") * (size // 8), i) for i in range(count)]
+        inline = build_seconds(messages, hasher)
+        print(f"  {size}-byte payloads, hashed inline: {inline:.3f}s")
+        for processes in [False, True]:
+            for workers in worker_counts:
+                with LeafHashPool(workers, processes=processes) as pool:
+                    seconds = build_seconds(messages, hasher, pool)
+                kind = "processes" if processes else "threads"
+                print(f"    {workers:>3} {kind:<9}: {seconds:.3f}s ({inline / seconds:.2f}x)")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
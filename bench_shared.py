@@ -0,0 +1,68 @@
+"""Measure sync sessions per second answered by worker processes over a tree published in shared memory.
+
+Usage: python3 bench_shared.py [message_count] [session_count]   (defaults to 100000 and 400)
+
+Every session is a client missing 100 of the messages. Clients run in as many processes as there are CPUs, so the
+servers are the bottleneck.
+"""
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+from prolly_tree import ProllyTree, Message
+from prolly_sync import SyncClient, SocketTransport
+from prolly_shared import SharedTreePublisher, SharedSyncWorkers
+
+MISSING = 100
+
+
+def _client_tree(count):
+    dropped = set(random.Random(3).sample(range(count), MISSING))
+    return ProllyTree([Message(i, i) for i in range(count) if i not in dropped])
+
+
+def _run_sessions(address, tree, sessions):
+    for _ in range(sessions):
+        transport = SocketTransport.connect(address)
+        try:
+            _, only_remote = SyncClient(tree, transport).reconcile()
+        finally:
+            transport.close()
+        assert len(only_remote) == MISSING
+
+
+def main(count=100000, sessions=400):
+    cpus = os.cpu_count() or 1
+    worker_counts = sorted({1, 2, 4, cpus} & set(range(1, cpus + 1)))
+    tree = ProllyTree([Message(i, i) for i in range(count)])
+    client_tree = _client_tree(count)
+    context = multiprocessing.get_context("fork")
+    print(f"{count} messages served, {sessions} sessions missing {MISSING} messages each, {cpus} client processes")
+    print("    workers | sessions/s | speedup")
+    with tempfile.TemporaryDirectory() as directory, SharedTreePublisher() as publisher:
+        publish_start = time.perf_counter()
+        publisher.publish(tree)
+        publish_seconds = time.perf_counter() - publish_start
+        baseline = None
+        for workers in worker_counts:
+            address = os.path.join(directory, f"sync-{workers}.sock")
+            with SharedSyncWorkers(publisher.name, address, workers=workers):
+                per_client = [sessions // cpus + (i < sessions % cpus) for i in range(cpus)]
+                clients = [context.Process(target=_run_sessions, args=(address, client_tree, n)) for n in per_client]
+                start = time.perf_counter()
+                for client in clients:
+                    client.start()
+                for client in clients:
+                    client.join()
+                    assert client.exitcode == 0
+                rate = sessions / (time.perf_counter() - start)
+            baseline = baseline or rate
+            print(f"    {workers:>7} | {rate:>10.1f} | {rate / baseline:>6.2f}x")
+    print(f"    publishing the image took {publish_seconds:.3f}s")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,267 @@
+"""Run the standard workloads on synthetic Waku-like traffic and keep the numbers, so that two revisions can be
+compared.
+
+Every workload is generated from a fixed seed: in-order appends, out-of-order arrivals, retention deletes, single
+deletes, searches and diffs against peers that diverge by 0.01% to 50%. For each one the suite records the wall
+time, the peak memory allocated while it runs (tracemalloc) and the hashes computed, both in a second untimed pass,
+and the height of the tree.
+
+Usage:
+    python3 bench_suite.py run [--sizes 10000 100000] [--workloads build append ...] [--repeat 1] [--output FILE]
+    python3 bench_suite.py compare OLD.json NEW.json [--threshold 0.10]
+
+compare prints every workload of both files side by side and exits with status 1 when one got slower, or used more
+memory, by more than the threshold, or computed more hashes.
+"""
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import Counter
+
+from prolly_tree import ProllyTree, Message, Hasher, find_diff_between_2_prolly_trees
+
+SEED = 7
+PAYLOAD_BYTES = 120
+STEP = 1_000_000  # Waku timestamps are in nanoseconds; one message per millisecond
+OPERATIONS = 10000  # messages appended, inserted, deleted or searched by the per-message workloads
+DIVERGENCES = [0.0001, 0.01, 0.1, 0.5]
+# differences below these are noise, whatever the ratio
+NOISE = {"seconds": 0.002, "peak_bytes": 64 << 10}
+
+
+class CountingHasher(Hasher):
+    """The default hashing scheme, counting every hash it computes. Every tree works on its own copy of the hasher,
+    and the copies share the counter."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.counter = Counter()
+
+    @property
+    def hashes(self):
+        return self.counter["hashes"]
+
+    def leaf_hash(self, data, timestamp, is_tail=False):
+        self.counter["hashes"] += 1
+        return super().leaf_hash(data, timestamp, is_tail)
+
+    def promoted_hash(self, node_hash):
+        self.counter["hashes"] += 1
+        return super().promoted_hash(node_hash)
+
+    def finish(self, hasher):
+        self.counter["hashes"] += 1
+        return super().finish(hasher)
+
+    def bucket_hash(self, nodes):
+        self.counter["hashes"] += 1
+        return super().bucket_hash(nodes)
+
+
+def waku_messages(count, seed=SEED, start=0):
+    """count messages with increasing nanosecond timestamps and random payloads, always the same for a seed."""
+    rng = random.Random(seed)
+    return [Message(rng.randbytes(PAYLOAD_BYTES).hex(), (start + i) * STEP + rng.randrange(STEP // 2))
+            for i in range(count)]
+
+
+# A workload gets the size and a hasher, does its setup and returns the function to measure, which returns the tree
+# whose height is reported.
+
+def build(size, hasher):
+    messages = waku_messages(size)
+    return lambda: ProllyTree(messages, hasher)
+
+
+def append(size, hasher):
+    tree = ProllyTree(waku_messages(size), hasher)
+    newest = waku_messages(OPERATIONS, SEED + 1, start=size)
+
+    def run():
+        for message in newest:
+            tree.insert(message)
+        tree.get_root().merkel_hash
+        return tree
+    return run
+
+
+def out_of_order(size, hasher):
+    tree = ProllyTree(waku_messages(size), hasher)
+    rng = random.Random(SEED + 2)
+    # late messages land up to 1000 messages left of the newest one, each at its own timestamp in the second half of
+    # a slot, which no existing message uses
+    half = STEP // 2
+    offsets = rng.sample(range(min(size, 1000) * half), OPERATIONS)
+    late = [Message(rng.randbytes(PAYLOAD_BYTES).hex(), (size - 1 - offset // half) * STEP + half + offset % half)
+            for offset in offsets]
+
+    def run():
+        for message in late:
+            tree.insert(message)
+        tree.get_root().merkel_hash
+        return tree
+    return run
+
+
+def retention(size, hasher):
+    messages = waku_messages(size)
+    tree = ProllyTree(messages, hasher)
+    cutoff = messages[size // 10].timestamp
+
+    def run():
+        tree.delete_older_than(cutoff)
+        tree.get_root().merkel_hash
+        return tree
+    return run
+
+
+def delete(size, hasher):
+    messages = waku_messages(size)
+    tree = ProllyTree(messages, hasher)
+    doomed = [m.timestamp for m in random.Random(SEED + 3).sample(messages, min(size // 10, OPERATIONS))]
+
+    def run():
+        for timestamp in doomed:
+            tree.delete(timestamp)
+        tree.get_root().merkel_hash
+        return tree
+    return run
+
+
+def search(size, hasher):
+    messages = waku_messages(size)
+    tree = ProllyTree(messages, hasher)
+    rng = random.Random(SEED + 4)
+    # half hits, half misses
+    keys = [rng.choice(messages).timestamp + (i % 2) for i in range(OPERATIONS)]
+
+    def run():
+        for timestamp in keys:
+            tree.search(timestamp)
+        return tree
+    return run
+
+
+def diff(divergence):
+    def workload(size, hasher):
+        messages = waku_messages(size)
+        rng = random.Random(SEED + 5)
+        missing = set(rng.sample(range(size), max(1, int(size * divergence))))
+        peer = ProllyTree(messages, hasher)
+        local = ProllyTree([m for i, m in enumerate(messages) if i not in missing], hasher)
+        local.get_root().merkel_hash
+        peer.get_root().merkel_hash
+
+        def run():
+            found = find_diff_between_2_prolly_trees(local, peer)
+            assert len(found) == len(missing)
+            return peer
+        return run
+    return workload
+
+
+WORKLOADS = {"build": build, "append": append, "out_of_order": out_of_order, "retention": retention,
+             "delete": delete, "search": search}
+WORKLOADS.update((f"diff_{divergence * 100:g}%", diff(divergence)) for divergence in DIVERGENCES)
+
+
+def measure(name, size, repeat):
+    seconds = []
+    for _ in range(repeat):
+        run = WORKLOADS[name](size, Hasher())
+        start = time.perf_counter()
+        tree = run()
+        seconds.append(time.perf_counter() - start)
+        height = len(tree)
+        del run, tree
+
+    # counting hashes and tracing allocations slow everything down, so they get a pass of their own
+    hasher = CountingHasher()
+    run = WORKLOADS[name](size, hasher)
+    hashes_before = hasher.hashes
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    hashes = hasher.hashes - hashes_before
+    return {"workload": name, "size": size, "seconds": min(seconds), "peak_bytes": peak, "hashes": hashes,
+            "height": height}
+
+
+def revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(args):
+    results = []
+    print(f"{'workload':>14} | {'size':>9} | {'seconds':>9} | {'peak MB':>8} | {'hashes':>10} | height")
+    for size in args.sizes:
+        for name in args.workloads:
+            result = measure(name, size, args.repeat)
+            results.append(result)
+            print(f"{name:>14} | {size:>9} | {result['seconds']:>9.3f} | {result['peak_bytes'] / 2 ** 20:>8.1f} | "
+                  f"{result['hashes']:>10} | {result['height']:>6}", flush=True)
+    report = {"revision": revision(), "python": platform.python_version(), "seed": SEED, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    return 0
+
+
+def compare_results(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    old_results = {(r["workload"], r["size"]): r for r in old["results"]}
+    regressions = 0
+    print(f"{old.get('revision')} -> {new.get('revision')}")
+    print(f"{'workload':>14} | {'size':>9} | {'seconds':>21} | {'peak MB':>17} | {'hashes':>21} |")
+    for result in new["results"]:
+        before = old_results.get((result["workload"], result["size"]))
+        if before is None:
+            continue
+        notes = []
+        for field, label in [("seconds", "slower"), ("peak_bytes", "more memory")]:
+            if (result[field] > before[field] * (1 + args.threshold)
+                    and result[field] - before[field] > NOISE[field]):
+                notes.append(f"{label} x{result[field] / max(before[field], 1e-9):.2f}")
+        if result["hashes"] > before["hashes"]:
+            notes.append("more hashes")
+        regressions += bool(notes)
+        print(f"{result['workload']:>14} | {result['size']:>9} | {before['seconds']:>9.3f} -> "
+              f"{result['seconds']:>8.3f} | {before['peak_bytes'] / 2 ** 20:>6.1f} -> "
+              f"{result['peak_bytes'] / 2 ** 20:>6.1f} | {before['hashes']:>9} -> {result['hashes']:>8} | "
+              f"{'REGRESSION: ' + ', '.join(notes) if notes else ''}")
+    print(f"{regressions} regression(s) above {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the workloads")
+    run_parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    run_parser.add_argument("--workloads", nargs="+", choices=list(WORKLOADS), default=list(WORKLOADS))
+    run_parser.add_argument("--repeat", type=int, default=1, help="runs per workload, the fastest one is kept")
+    run_parser.add_argument("--output", help="JSON file for the results")
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.10,
+                                help="slowdown or memory growth reported as a regression, 0.10 is 10%%")
+    args = parser.parse_args(argv)
+    return run_suite(args) if args.command == "run" else compare_results(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,48 @@
+"""Report round trips, bytes and time of a sync session over the loopback and local socket transports.
+
+Usage: python3 bench_sync.py [message_count]   (defaults to 100000)
+"""
+import random
+import socket
+import sys
+import threading
+import time
+
+from prolly_tree import ProllyTree, Message
+from prolly_sync import SyncServer, SyncClient, LoopbackTransport, SocketTransport
+
+DIVERGENCES = [1, 10, 100, 1000, 10000]
+
+
+def main(count=100000):
+    rng = random.Random(3)
+    tree1 = ProllyTree([Message(i, i) for i in range(count)])
+    print(f"{count} messages on the local side")
+    print("    missing |  transport | round trips |   bytes sent | bytes received |   time")
+    # a small tree cannot miss more messages than it has
+    for missing in [missing for missing in DIVERGENCES if missing <= count]:
+        dropped = set(rng.sample(range(count), missing))
+        tree2 = ProllyTree([Message(i, i) for i in range(count) if i not in dropped])
+        for name in ["loopback", "socket"]:
+            if name == "loopback":
+                transport = LoopbackTransport(SyncServer(tree1))
+            else:
+                client_sock, server_sock = socket.socketpair()
+                server = threading.Thread(target=SyncServer(tree1).serve_connection, args=(server_sock,))
+                server.start()
+                transport = SocketTransport(client_sock)
+            client = SyncClient(tree2, transport)
+            start = time.perf_counter()
+            _, only_remote = client.reconcile()
+            seconds = time.perf_counter() - start
+            if name == "socket":
+                transport.close()
+                server.join()
+            assert len(only_remote) == missing
+            stats = client.stats
+            print(f"    {missing:>7} | {name:>10} | {stats.round_trips:>11} | {stats.bytes_sent:>12,} | "
+                  f"{stats.bytes_received:>14,} | {seconds:.3f}s")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
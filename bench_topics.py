@@ -0,0 +1,57 @@
+"""Compare one sync session per topic with one batched session over all topics.
+
+Usage: python3 bench_topics.py [topic_count] [messages_per_topic] [rtt_ms]   (defaults to 50, 2000 and 50)
+
+A tenth of the topics miss a few messages on the local side. The time column adds rtt_ms per round trip to the
+time spent computing.
+"""
+import sys
+import time
+
+from prolly_tree import Message
+from prolly_sync import SyncClient, SyncServer, LoopbackTransport
+from prolly_topics import TopicTrees, TopicSyncClient, TopicSyncServer
+
+
+def build(topic_count, per_topic):
+    remote, local = TopicTrees(), TopicTrees()
+    for t in range(topic_count):
+        topic = f"/waku/2/topic-{t}/proto"
+        messages = [Message(i, 1700000000 * 10 ** 9 + i * 10 ** 6 + t) for i in range(per_topic)]
+        remote.insert_many(topic, messages)
+        local.insert_many(topic, [m for i, m in enumerate(messages) if t % 10 or i % 200])
+    return remote, local
+
+
+def main(topic_count=50, per_topic=2000, rtt_ms=50):
+    remote, local = build(topic_count, per_topic)
+    print(f"{topic_count} topics of {per_topic} messages, {topic_count // 10 + (topic_count % 10 > 0)} changed")
+    print("    session              | round trips |   bytes sent | bytes received | time at rtt")
+
+    start = time.perf_counter()
+    round_trips = bytes_sent = bytes_received = 0
+    for topic in remote.topics():
+        client = SyncClient(local.tree(topic), LoopbackTransport(SyncServer(remote.tree(topic))))
+        client.reconcile()
+        round_trips += client.stats.round_trips
+        bytes_sent += client.stats.bytes_sent
+        bytes_received += client.stats.bytes_received
+    seconds = time.perf_counter() - start + round_trips * rtt_ms / 1000
+    print(f"    one per topic        | {round_trips:>11} | {bytes_sent:>12,} | {bytes_received:>14,} | {seconds:.3f}s")
+
+    server = TopicSyncServer(remote)
+    for name in ["batched", "batched, warm cache"]:
+        client = TopicSyncClient(local, LoopbackTransport(server))
+        start = time.perf_counter()
+        client.reconcile()
+        seconds = time.perf_counter() - start + client.stats.round_trips * rtt_ms / 1000
+        stats = client.stats
+        print(f"    {name:<20} | {stats.round_trips:>11} | {stats.bytes_sent:>12,} | {stats.bytes_received:>14,} | "
+              f"{seconds:.3f}s")
+    cache = remote.cache
+    print(f"    bucket cache: {len(cache)} buckets, {cache.cached_bytes:,} bytes, {cache.hits} hits, "
+          f"{cache.misses} misses")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:4]])
@@ -0,0 +1,83 @@
+"""Compare the bytes per entry and the encode and decode speed of the JSON and binary sync codecs.
+
+Usage: python3 bench_wire.py [message_count]   (defaults to 100000)
+
+The payload is every level of a tree with Waku-like nanosecond timestamps, as the children responses of one
+request per level, the most a sync session can fetch.
+"""
+import random
+import sys
+import time
+
+from prolly_tree import ProllyTree, Message
+from prolly_sync import SyncServer, SyncClient, LoopbackTransport, JsonCodec
+from prolly_wire import BinaryCodec
+
+START = 1700000000 * 10 ** 9
+
+
+def waku_timestamps(count, seed=5):
+    rng = random.Random(seed)
+    timestamp = START
+    timestamps = []
+    for _ in range(count):
+        timestamp += rng.randrange(1, 2 * 10 ** 7)
+        timestamps.append(timestamp)
+    return timestamps
+
+
+def level_responses(tree, hash_prefix):
+    server = SyncServer(tree)
+    responses = []
+    for level in range(1, len(tree)):
+        owners = [None if n.is_tail else n.timestamp for n in tree[level].to_list()]
+        request = {"op": "children", "level": level, "owners": owners}
+        if hash_prefix is not None and level > 1:
+            request["hash_prefix"] = hash_prefix
+        responses.append(server.handle(request))
+    return responses
+
+
+def timed(function, items, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [function(item) for item in items]
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, results
+
+
+def main(count=100000):
+    timestamps = waku_timestamps(count)
+    tree = ProllyTree([Message(i.to_bytes(8, "big"), t) for i, t in enumerate(timestamps)])
+    print(f"{count} messages, {len(tree)} levels")
+    print("    codec  | hash prefix | bytes/entry | encode MB/s | decode MB/s | encode k entries/s | decode k entries/s")
+    for codec in [JsonCodec(), BinaryCodec()]:
+        for hash_prefix in [None, 8]:
+            responses = level_responses(tree, hash_prefix)
+            entries = sum(len(bucket) for response in responses for bucket in response["children"])
+            encode_seconds, payloads = timed(codec.encode, responses)
+            decode_seconds, _ = timed(codec.decode, payloads)
+            size = sum(len(payload) for payload in payloads)
+            name = "json" if isinstance(codec, JsonCodec) else "binary"
+            print(f"    {name:>6} | {hash_prefix or 'full':>11} | {size / entries:>11.1f} | "
+                  f"{size / encode_seconds / 1e6:>11.1f} | {size / decode_seconds / 1e6:>11.1f} | "
+                  f"{entries / encode_seconds / 1e3:>18.0f} | {entries / decode_seconds / 1e3:>18.0f}")
+
+    dropped = set(random.Random(7).sample(range(count), 100))
+    peer = ProllyTree([Message(i.to_bytes(8, "big"), t) for i, t in enumerate(timestamps) if i not in dropped])
+    print("A session missing 100 messages:")
+    print("    codec  | hash prefix | bytes sent | bytes received")
+    for codec in [JsonCodec(), BinaryCodec()]:
+        for hash_prefix in [None, 8]:
+            client = SyncClient(peer, LoopbackTransport(SyncServer(tree, codec)), codec, hash_prefix=hash_prefix)
+            _, only_remote = client.reconcile()
+            assert len(only_remote) == 100
+            name = "json" if isinstance(codec, JsonCodec) else "binary"
+            print(f"    {name:>6} | {hash_prefix or 'full':>11} | {client.stats.bytes_sent:>10,} | "
+                  f"{client.stats.bytes_received:>14,}")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,209 @@
+import asyncio
+import struct
+
+from prolly_tree import get_non_boundary_nodes, _split_mismatches, _leaf_differences, _level_ending_at, _measure
+from prolly_sync import SyncServer, SyncStats, JsonCodec, _remote_root, _children_request, _remote_buckets
+
+# asyncio flavour of the sync protocol in prolly_sync.py. Requests and responses carry an "id" so many of them can
+# be in flight on one connection and answered in any order. The client does not wait for a whole level before going
+# down: every group of mismatching nodes fetches its own children and descends as soon as they arrive, so a slow
+# subtree does not hold the others back. Sessions only read the local tree, so any number of them can run against
+# the same tree in one event loop. A request the server cannot answer gets {"error": "...", "id": n} back, which the
+# client raises from that request; a frame it cannot decode closes the connection. The client does the same with a
+# response it cannot decode, failing every request still waiting on it.
+
+
+class AsyncSyncServer(SyncServer):
+    """Answers sync requests on asyncio streams. latency is an artificial delay in seconds added to every response."""
+
+    def __init__(self, tree, codec=None, latency=0.0):
+        super().__init__(tree, codec)
+        self.latency = latency
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Listen on a TCP port, 0 picks a free one."""
+        return await asyncio.start_server(self.handle_stream, host, port)
+
+    async def start_unix(self, path):
+        return await asyncio.start_unix_server(self.handle_stream, path)
+
+    async def handle_stream(self, reader, writer):
+        """Answer framed requests on one connection until the peer closes it, each request in its own task."""
+        answers = set()
+        try:
+            while True:
+                payload = await _read_frame(reader)
+                if payload is None:
+                    break
+                answer = asyncio.ensure_future(self._answer(payload, writer))
+                answers.add(answer)
+                answer.add_done_callback(answers.discard)
+            if answers:
+                await asyncio.wait(answers)
+        finally:
+            writer.close()
+
+    async def _answer(self, payload, writer):
+        try:
+            request = self.codec.decode(payload)
+            request_id = request.get("id")
+        except Exception:
+            # nothing to answer without an id, so drop the connection, which fails the client's waiting requests
+            writer.close()
+            return
+        try:
+            response = self.handle(request)
+        except Exception as error:
+            # the client raises it from the request with this id
+            response = {"error": f"{type(error).__name__}: {error}"}
+        response["id"] = request_id
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        _write_frame(writer, self.codec.encode(response))
+        await writer.drain()
+
+
+def _write_frame(writer, payload):
+    writer.write(struct.pack(">I", len(payload)) + payload)
+
+
+async def _read_frame(reader):
+    try:
+        header = await reader.readexactly(4)
+        return await reader.readexactly(struct.unpack(">I", header)[0])
+    except asyncio.IncompleteReadError:
+        return None
+
+
+class AsyncSyncClient:
+    """Reconciles a local tree with one peer over an asyncio stream connection. max_in_flight bounds the requests
+    outstanding at once, 1 turns pipelining off."""
+
+    def __init__(self, tree, reader, writer, codec=None, max_in_flight=64):
+        self.tree = tree
+        self.reader = reader
+        self.writer = writer
+        self.codec = codec or JsonCodec()
+        self.stats = SyncStats()
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._pending = {}
+        self._next_id = 0
+        self._receiver = None
+
+    @classmethod
+    async def connect(cls, tree, address, **kwargs):
+        """Connect to a server on a unix socket path or a (host, port) pair."""
+        if isinstance(address, str):
+            reader, writer = await asyncio.open_unix_connection(address)
+        else:
+            reader, writer = await asyncio.open_connection(*address)
+        return cls(tree, reader, writer, **kwargs)
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+        if self._receiver is not None:
+            await self._receiver
+
+    async def _receive(self):
+        """Hand every response to the request waiting for its id. A response that cannot be decoded or matched ends
+        the connection, and every waiting request fails."""
+        error = ConnectionError("sync server closed the connection")
+        try:
+            while True:
+                payload = await _read_frame(self.reader)
+                if payload is None:
+                    break
+                self.stats.bytes_received += len(payload)
+                response = self.codec.decode(payload)
+                future = self._pending.pop(response.pop("id", None), None)
+                if future is None or future.done():
+                    continue
+                if "error" in response:
+                    future.set_exception(ValueError(f"sync server could not answer: {response['error']}"))
+                else:
+                    future.set_result(response)
+        except (ConnectionError, OSError):
+            pass
+        except Exception as exc:
+            error = ValueError(f"undecodable response from the sync server: {exc!r}")
+            self.writer.close()
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+
+    async def _request(self, message):
+        if self._receiver is None:
+            self._receiver = asyncio.ensure_future(self._receive())
+        elif self._receiver.done():
+            # nothing would ever answer
+            raise ConnectionError("sync server closed the connection")
+        async with self._slots:
+            request_id = self._next_id
+            self._next_id += 1
+            future = asyncio.get_running_loop().create_future()
+            self._pending[request_id] = future
+            payload = self.codec.encode(dict(message, id=request_id))
+            self.stats.round_trips += 1
+            self.stats.bytes_sent += len(payload)
+            _write_frame(self.writer, payload)
+            await self.writer.drain()
+            return await future
+
+    async def _fetch_children(self, level, owners):
+        if not owners:
+            return []
+        return _remote_buckets(self.tree.hasher, level, await self._request(_children_request(level, owners)))
+
+    async def reconcile(self):
+        """Compare with the peer and return (only_local, only_remote) sorted by timestamp, like SyncClient.reconcile.
+        On an instrumented tree the session is counted as a "sync" operation; sessions overlapping in one event loop
+        are counted as one."""
+        with _measure("sync", self.tree):
+            return await self._reconcile()
+
+    async def _reconcile(self):
+        self.stats = SyncStats()
+        only_local, only_remote = [], []
+
+        remote_nodes = [_remote_root(self.tree.hasher, await self._request({"op": "root"}))]
+        local_nodes = _level_ending_at(self.tree.get_root())
+
+        # line the heights up, the taller side compares its whole level
+        while local_nodes[-1].level > remote_nodes[-1].level:
+            local_nodes = get_non_boundary_nodes(local_nodes)
+        while remote_nodes[-1].level > local_nodes[-1].level:
+            remote_nodes = [n for bucket in await self._fetch_children(remote_nodes[-1].level, remote_nodes)
+                            for n in bucket]
+
+        await self._descend(local_nodes, remote_nodes, local_nodes[-1].level, only_local, only_remote)
+        only_local.sort(key=lambda node: node.timestamp)
+        only_remote.sort(key=lambda node: node.timestamp)
+        return only_local, only_remote
+
+    async def _descend(self, local_nodes, remote_nodes, level, only_local, only_remote):
+        if level == 0:
+            for is_local, node in _leaf_differences(local_nodes, remote_nodes):
+                (only_local if is_local else only_remote).append(node)
+            return
+        await asyncio.gather(*[self._descend_group(local_group, remote_group, level, only_local, only_remote)
+                               for local_group, remote_group in _split_mismatches(local_nodes, remote_nodes)])
+
+    async def _descend_group(self, local_group, remote_group, level, only_local, only_remote):
+        remote_children = [n for bucket in await self._fetch_children(level, remote_group) for n in bucket]
+        await self._descend(get_non_boundary_nodes(local_group), remote_children, level - 1, only_local, only_remote)
+
+
+async def reconcile_with_peers(tree, addresses, **kwargs):
+    """Run one session per peer address concurrently against the same local tree and return their
+    (only_local, only_remote) results in the order of the addresses."""
+
+    async def session(address):
+        client = await AsyncSyncClient.connect(tree, address, **kwargs)
+        try:
+            return await client.reconcile()
+        finally:
+            await client.close()
+
+    return await asyncio.gather(*[session(address) for address in addresses])
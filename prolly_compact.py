@@ -0,0 +1,483 @@
+import gc
+import json
+import mmap
+import pickle
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+
+from prolly_tree import ProllyTree, DEFAULT_HASHER, Hasher, Node, Level, _ensure_sorted, _bucket_of
+
+# Compact storage for a Prolly tree: every level is a struct of arrays instead of a linked list of Node objects.
+# Timestamps live in a typed array, digests in one contiguous bytes buffer, boundary flags in a bitmap and a
+# parent points to its child by index. The image is read-only; it is built from a ProllyTree or straight from
+# sorted messages and can be walked through CompactNode views, which read like Node objects.
+#
+# A compact tree can be saved as a binary image: a JSON header followed by the raw arrays of every level, each
+# section aligned to 8 bytes. Loading memory-maps the file and reads the arrays in place, so it costs no hashing
+# and no copying. Payloads are pickled, so an image must only be loaded from a trusted file.
+
+IMAGE_MAGIC = b"PRLYIMG1"
+
+
+def _set_bit(bitmap, index):
+    bitmap[index >> 3] |= 1 << (index & 7)
+
+
+def _get_bit(bitmap, index):
+    return (bitmap[index >> 3] >> (index & 7)) & 1 == 1
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def _digests(hasher, buffer, digest_size):
+    """Every digest of a buffer in the form the tree stores, converted in one go."""
+    raw = bytes(buffer)
+    if hasher.hex_digests:
+        text, width = raw.hex(), 2 * digest_size
+        return [text[i:i + width] for i in range(0, len(text), width)]
+    return [raw[i:i + digest_size] for i in range(0, len(raw), digest_size)]
+
+
+class _PayloadView:
+    """Payloads of a mapped level 0, unpickled on access."""
+    __slots__ = ("offsets", "blob")
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return pickle.loads(self.blob[self.offsets[index]:self.offsets[index + 1]])
+
+
+class CompactLevel:
+    """One level of a CompactProllyTree. Entry i of every array describes the i-th node from the left and the tail is always the last entry."""
+    __slots__ = ("level", "count", "digest_size", "timestamps", "node_hashes", "merkel_hashes",
+                 "boundaries", "down", "data")
+
+    def __init__(self, level, digest_size):
+        self.level = level
+        self.count = 0
+        self.digest_size = digest_size
+        self.timestamps = array("q")  # the tail slot holds a placeholder 0
+        self.node_hashes = bytearray()
+        # on level 0 the merkel hash of a node is its node hash so the same buffer is shared
+        self.merkel_hashes = self.node_hashes if level == 0 else bytearray()
+        self.boundaries = bytearray()
+        self.down = array("q")  # index of the child on the level below, empty on level 0
+        self.data = []  # payloads, level 0 only
+
+    def __len__(self):
+        return self.count
+
+    def append(self, timestamp, node_hash, merkel_hash, boundary, down=None, data=None):
+        index = self.count
+        self.timestamps.append(timestamp)
+        self.node_hashes += node_hash
+        if self.level > 0:
+            self.merkel_hashes += merkel_hash
+            self.down.append(down)
+        else:
+            self.data.append(data)
+        if index & 7 == 0:
+            self.boundaries.append(0)
+        if boundary:
+            _set_bit(self.boundaries, index)
+        self.count += 1
+        return index
+
+    def digest(self, buffer, index):
+        start = index * self.digest_size
+        return bytes(buffer[start:start + self.digest_size])
+
+    def to_list(self, tree):
+        return [CompactNode(tree, self.level, i) for i in range(self.count)]
+
+    def nbytes(self):
+        """Bytes held by the arrays of this level, payloads excluded."""
+        size = (self.timestamps.itemsize * len(self.timestamps) + len(self.node_hashes)
+                + len(self.boundaries) + self.down.itemsize * len(self.down))
+        if self.level > 0:
+            size += len(self.merkel_hashes)
+        return size
+
+
+class CompactNode:
+    """A view of one entry of a CompactProllyTree with the attributes of a Node, so the diff functions can walk it."""
+    __slots__ = ("tree", "level", "index")
+
+    def __init__(self, tree, level, index):
+        self.tree = tree
+        self.level = level
+        self.index = index
+
+    @property
+    def _level(self):
+        return self.tree.levels[self.level]
+
+    @property
+    def is_tail(self):
+        return self.index == self._level.count - 1
+
+    @property
+    def timestamp(self):
+        if self.is_tail:
+            return "Tail"
+        return self._level.timestamps[self.index]
+
+    @property
+    def data(self):
+        if self.level > 0:
+            return None
+        if self.is_tail:
+            return "Tail"
+        return self._level.data[self.index]
+
+    @property
+    def node_hash(self):
+        level = self._level
+        return self.tree.hasher.from_bytes(level.digest(level.node_hashes, self.index))
+
+    @property
+    def merkel_hash(self):
+        level = self._level
+        return self.tree.hasher.from_bytes(level.digest(level.merkel_hashes, self.index))
+
+    @property
+    def boundary(self):
+        return _get_bit(self._level.boundaries, self.index)
+
+    def is_boundary_node(self):
+        return self.boundary
+
+    @property
+    def left(self):
+        if self.index == 0:
+            return None
+        return CompactNode(self.tree, self.level, self.index - 1)
+
+    @property
+    def right(self):
+        if self.index == self._level.count - 1:
+            return None
+        return CompactNode(self.tree, self.level, self.index + 1)
+
+    @property
+    def down(self):
+        if self.level == 0:
+            return None
+        return CompactNode(self.tree, self.level - 1, self._level.down[self.index])
+
+    @property
+    def up(self):
+        if self.level + 1 == len(self.tree.levels):
+            return None
+        parents = self.tree.levels[self.level + 1].down
+        position = bisect_left(parents, self.index)
+        if position < len(parents) and parents[position] == self.index:
+            return CompactNode(self.tree, self.level + 1, position)
+        return None
+
+    def bucket_nodes(self):
+        return _bucket_of(self.down)
+
+    def __repr__(self):
+        return f"CompactNode({self.data}, {self.timestamp})"
+
+
+class CompactProllyTree:
+    """A read-only Prolly tree stored as per-level arrays. It holds the same keys, node hashes and merkel hashes as the ProllyTree it mirrors."""
+    _segment = None  # the shared memory segment a tree read in place from one keeps open, see prolly_shared.py
+
+    def __init__(self, levels=None, hasher=DEFAULT_HASHER):
+        self.levels = levels if levels is not None else []
+        self.hasher = hasher
+        self.digest_size = hasher.digest_size
+        self.root_hash = None  # the root merkel hash recorded in a loaded image
+
+    @classmethod
+    def from_tree(cls, tree):
+        """Copy a ProllyTree into compact form."""
+        hasher = tree.hasher
+        compact = cls(hasher=hasher)
+        for level in tree:
+            compact_level = CompactLevel(level.level, hasher.digest_size)
+            below = compact.levels[-1] if compact.levels else None
+            child_index = 0
+            for node in level.to_list():
+                down = None
+                if below is not None:
+                    # children are promoted in order, so the next promoted entry below is our child
+                    while not _get_bit(below.boundaries, child_index):
+                        child_index += 1
+                    down = child_index
+                    child_index += 1
+                compact_level.append(0 if node.is_tail else node.timestamp,
+                                     hasher.to_bytes(node.node_hash), hasher.to_bytes(node.merkel_hash),
+                                     node.is_boundary_node(), down, node.data)
+            compact.levels.append(compact_level)
+        return compact
+
+    @classmethod
+    def from_sorted_iter(cls, messages, hasher=DEFAULT_HASHER):
+        """Build the compact form straight from messages sorted by timestamp, in one streaming pass and without creating Node objects."""
+        compact = cls(hasher=hasher)
+        buckets = []
+
+        def append(level_index, timestamp, node_hash, merkel_hash, boundary, down=None, data=None):
+            if level_index == len(compact.levels):
+                compact.levels.append(CompactLevel(level_index, hasher.digest_size))
+                buckets.append(hasher.new())
+            hasher.update(buckets[level_index], merkel_hash)
+            return compact.levels[level_index].append(
+                timestamp, hasher.to_bytes(node_hash), hasher.to_bytes(merkel_hash), boundary, down, data)
+
+        def promote(level_index, child_index, child_hash, timestamp, is_tail):
+            node_hash = hasher.promoted_hash(child_hash)
+            merkel_hash = hasher.finish(buckets[level_index])
+            buckets[level_index] = hasher.new()
+            boundary = is_tail or hasher.is_boundary(node_hash)
+            index = append(level_index + 1, timestamp, node_hash, merkel_hash, boundary, down=child_index)
+            return node_hash, boundary, index
+
+        for m in _ensure_sorted(messages):
+            node_hash = hasher.leaf_hash(m.data, m.timestamp)
+            boundary = hasher.is_boundary(node_hash)
+            index = append(0, m.timestamp, node_hash, node_hash, boundary, data=m.data)
+            level_index = 0
+            while boundary:
+                node_hash, boundary, index = promote(level_index, index, node_hash, m.timestamp, False)
+                level_index += 1
+
+        node_hash = hasher.leaf_hash("Tail", "Tail", is_tail=True)
+        level_index = 0
+        while True:
+            has_other_nodes = level_index < len(compact.levels)
+            if level_index == 0:
+                index = append(0, 0, node_hash, node_hash, True, data="Tail")
+            if not has_other_nodes:
+                break
+            node_hash, _, index = promote(level_index, index, node_hash, 0, True)
+            level_index += 1
+            if len(compact.levels[level_index]) == 1:
+                break
+        return compact
+
+    def __iter__(self):
+        return iter(self.levels)
+
+    def __getitem__(self, item):
+        return self.levels[item]
+
+    def __len__(self):
+        return len(self.levels)
+
+    def get_root(self):
+        return CompactNode(self, len(self.levels) - 1, self.levels[-1].count - 1)
+
+    def get_root_at_height(self, height_diff):
+        root_at_height = self.get_root()
+        while height_diff > 0:
+            root_at_height = root_at_height.down
+            height_diff -= 1
+        return root_at_height
+
+    def search(self, timestamp):
+        """Find the leaf with the given timestamp by binary search over level 0."""
+        level = self.levels[0]
+        index = bisect_right(level.timestamps, timestamp, 0, level.count - 1) - 1
+        if index >= 0 and level.timestamps[index] == timestamp:
+            return CompactNode(self, 0, index)
+        return None
+
+    def nbytes(self):
+        """Bytes held by the arrays of all levels, payloads excluded."""
+        return sum(level.nbytes() for level in self.levels)
+
+    def get_intermediate_node(self, timestamp, level):
+        """Get the node at a level using a key, or None if the key was not promoted that far, by binary search over the level."""
+        if level >= len(self.levels):
+            return None
+        compact_level = self.levels[level]
+        index = bisect_left(compact_level.timestamps, timestamp, 0, compact_level.count - 1)
+        if index < compact_level.count - 1 and compact_level.timestamps[index] == timestamp:
+            return CompactNode(self, level, index)
+        return None
+
+    def save(self, path):
+        """Write the tree to path as a binary image that load() can map."""
+        prefix, base, sections, _ = self._image_layout()
+        with open(path, "wb") as f:
+            f.write(prefix)
+            for offset, buffer in sections:
+                f.write(b"\0" * (base + offset - f.tell()))
+                f.write(buffer)
+
+    def image_size(self):
+        """Bytes of the binary image of the tree."""
+        return self._image_layout()[3]
+
+    def write_image(self, buffer):
+        """Write the binary image into a writable buffer of at least image_size() bytes, for example shared memory."""
+        prefix, base, sections, size = self._image_layout()
+        view = memoryview(buffer).cast("B")
+        view[:len(prefix)] = prefix
+        for offset, section in sections:
+            section = memoryview(section).cast("B")
+            view[base + offset:base + offset + section.nbytes] = section
+        return size
+
+    def _image_layout(self):
+        """The magic and header bytes, the offset of the first section, the (offset, buffer) sections and the total size of the image."""
+        hasher = self.hasher
+        sections = []
+        size = 0
+
+        def add(buffer):
+            nonlocal size
+            offset = size
+            sections.append((offset, buffer))
+            size = _align(offset + memoryview(buffer).nbytes)
+            return offset
+
+        levels = []
+        for level in self.levels:
+            entry = {"count": level.count, "timestamps": add(level.timestamps),
+                     "node_hashes": add(level.node_hashes), "boundaries": add(level.boundaries)}
+            if level.level > 0:
+                entry["merkel_hashes"] = add(level.merkel_hashes)
+                entry["down"] = add(level.down)
+            else:
+                payloads = [pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL) for data in level.data]
+                offsets = array("q", [0])
+                for payload in payloads:
+                    offsets.append(offsets[-1] + len(payload))
+                entry["payload_offsets"] = add(offsets)
+                entry["payloads"] = add(b"".join(payloads))
+            levels.append(entry)
+
+        header = json.dumps({
+            "byteorder": sys.byteorder,
+            "hasher": [hasher.algorithm, hasher.hex_digests, hasher._digest_size_arg, hasher.boundary_bits],
+            "root": hasher.to_bytes(self.get_root().merkel_hash).hex(),
+            "levels": levels,
+        }).encode()
+        prefix = IMAGE_MAGIC + struct.pack(">Q", len(header)) + header
+        base = _align(len(prefix))
+        return prefix, base, sections, base + size
+
+    @classmethod
+    def load(cls, path, verify=False):
+        """Map an image written by save(). The arrays are read in place, so loading costs neither hashing nor copying. With verify=True every hash is checked first, see verify()."""
+        with open(path, "rb") as f:
+            image = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls.from_buffer(image, verify, path)
+
+    @classmethod
+    def from_buffer(cls, buffer, verify=False, name="buffer"):
+        """Read an image from any buffer, such as a mapped file or shared memory, in place. The tree keeps views of the buffer, which stays exported as long as the tree is alive."""
+        view = memoryview(buffer).cast("B")
+        if bytes(view[:len(IMAGE_MAGIC)]) != IMAGE_MAGIC:
+            raise ValueError(f"{name} is not a Prolly tree image")
+        header_size = struct.unpack_from(">Q", view, len(IMAGE_MAGIC))[0]
+        header_start = len(IMAGE_MAGIC) + 8
+        header = json.loads(bytes(view[header_start:header_start + header_size]))
+        if header["byteorder"] != sys.byteorder:
+            raise ValueError(f"{name} was written on a {header['byteorder']}-endian machine")
+        base = _align(header_start + header_size)
+
+        def section(offset, size, fmt="B"):
+            return view[base + offset:base + offset + size].cast(fmt)
+
+        compact = cls(hasher=Hasher(*header["hasher"]))
+        compact.root_hash = compact.hasher.from_bytes(bytes.fromhex(header["root"]))
+        digest_size = compact.digest_size
+        for index, entry in enumerate(header["levels"]):
+            count = entry["count"]
+            level = CompactLevel(index, digest_size)
+            level.count = count
+            level.timestamps = section(entry["timestamps"], 8 * count, "q")
+            level.node_hashes = section(entry["node_hashes"], digest_size * count)
+            level.boundaries = section(entry["boundaries"], (count + 7) // 8)
+            if index > 0:
+                level.merkel_hashes = section(entry["merkel_hashes"], digest_size * count)
+                level.down = section(entry["down"], 8 * count, "q")
+            else:
+                level.merkel_hashes = level.node_hashes
+                offsets = section(entry["payload_offsets"], 8 * (count + 1), "q")
+                level.data = _PayloadView(offsets, section(entry["payloads"], offsets[count]))
+            compact.levels.append(level)
+        if verify:
+            compact.verify()
+        return compact
+
+    def verify(self):
+        """Recompute every node hash and merkel hash from the payloads up and check them against the stored ones and the root hash recorded in the image. Raises ValueError at the first mismatch."""
+        hasher = self.hasher
+        for level in self.levels:
+            for index in range(level.count):
+                node = CompactNode(self, level.level, index)
+                if level.level == 0:
+                    node_hash = hasher.leaf_hash(node.data, node.timestamp, node.is_tail)
+                    merkel_hash = node_hash
+                else:
+                    node_hash = hasher.promoted_hash(node.down.node_hash)
+                    merkel_hash = hasher.bucket_hash(node.bucket_nodes())
+                boundary = node.is_tail or hasher.is_boundary(node_hash)
+                if node_hash != node.node_hash or merkel_hash != node.merkel_hash or boundary != node.boundary:
+                    raise ValueError(f"corrupt tree image: level {level.level}, entry {index}")
+        if self.root_hash is not None and self.root_hash != self.get_root().merkel_hash:
+            raise ValueError("corrupt tree image: the root hash does not match")
+        return self.get_root().merkel_hash
+
+    def to_tree(self):
+        """Rebuild a linked ProllyTree with the stored hashes instead of computing them again."""
+        # every node created here stays reachable, so the cyclic collector would only rescan them over and over
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self._link_tree()
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+    def _link_tree(self):
+        tree = ProllyTree(hasher=self.hasher)
+        hasher = tree.hasher
+        tree.levels = []
+        below = None
+        for compact_level in self.levels:
+            level_index = compact_level.level
+            count = compact_level.count
+            node_hashes = _digests(hasher, compact_level.node_hashes, compact_level.digest_size)
+            if level_index > 0:
+                merkel_hashes = _digests(hasher, compact_level.merkel_hashes, compact_level.digest_size)
+            timestamps = compact_level.timestamps
+            nodes = []
+            for index in range(count):
+                is_tail = index == count - 1
+                timestamp = "Tail" if is_tail else timestamps[index]
+                if level_index == 0:
+                    node = Node("Tail" if is_tail else compact_level.data[index], timestamp, is_tail, hasher,
+                                node_hashes[index])
+                else:
+                    node = Node(None, timestamp, is_tail, hasher, node_hashes[index])
+                    node.level = level_index
+                    node.merkel_hash = merkel_hashes[index]
+                    child = below[compact_level.down[index]]
+                    node.down = child
+                    child.up = node
+                node.boundary = _get_bit(compact_level.boundaries, index)
+                nodes.append(node)
+            level = Level(level_index)
+            level.tail = Level.link_nodes(nodes)[-1]
+            tree.levels.append(level)
+            below = nodes
+        return tree
@@ -0,0 +1,170 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from prolly_tree import (ProllyTree, Message, Hasher, DEFAULT_HASHER, reconcile_prolly_trees, get_non_boundary_nodes,
+                         _split_mismatches, _align_heights, _level_ending_at)
+
+# A forest keeps one ProllyTree per time epoch plus a small top tree with one leaf per epoch, whose payload is the
+# merkel hash of that epoch's root. Epochs are independent, so they can be built in parallel and an expired epoch is
+# dropped as a whole. Two forests are reconciled by diffing their top trees first: only epochs whose roots differ
+# are descended into.
+
+
+def _hasher_args(hasher):
+    return hasher.algorithm, hasher.hex_digests, hasher._digest_size_arg, hasher.boundary_bits
+
+
+def _build_shard_image(args):
+    """Build the tree of one epoch in a worker process and write it as an image, which is cheaper to hand back than the linked nodes."""
+    epoch, messages, hasher_args, path = args
+    ProllyTree([Message(data, timestamp) for data, timestamp in messages], Hasher(*hasher_args)).save(path)
+    return epoch, path
+
+
+def _changed_keys(tree1, tree2):
+    """Keys whose leaves differ between two trees: held by one side only or held by both with other payloads. The
+    diff functions compare leaves by key alone, which is not enough for the top tree, where an epoch keeps its key
+    when its root changes."""
+    changed = set()
+    local_nodes, remote_nodes = _align_heights(_level_ending_at(tree1.get_root()), _level_ending_at(tree2.get_root()))
+    pending = [(local_nodes[-1].level, local_nodes, remote_nodes)]
+    while pending:
+        level, local_nodes, remote_nodes = pending.pop()
+        for local_group, remote_group in _split_mismatches(local_nodes, remote_nodes):
+            if level == 0:
+                changed.update(n.timestamp for n in local_group + remote_group if not n.is_tail)
+            else:
+                pending.append((level - 1, get_non_boundary_nodes(local_group), get_non_boundary_nodes(remote_group)))
+    return changed
+
+
+class ProllyForest:
+    """Prolly trees sharded by epoch: a message with timestamp t goes to epoch t // epoch_length."""
+
+    def __init__(self, messages=(), epoch_length=3600, hasher=DEFAULT_HASHER, boundary_bits=None):
+        if boundary_bits is not None:
+            hasher = hasher.with_boundary_bits(boundary_bits)
+        self.epoch_length = epoch_length
+        self.hasher = hasher
+        self.shards = {}  # epoch -> ProllyTree
+        self.top = ProllyTree(hasher=hasher)  # one leaf per epoch, keyed by epoch, holding its root hash
+        self._stale_epochs = set()  # epochs whose leaf in the top tree is out of date
+        for epoch, epoch_messages in self._by_epoch(messages).items():
+            self.shards[epoch] = ProllyTree.from_sorted_iter(epoch_messages, hasher)
+            self._stale_epochs.add(epoch)
+
+    @classmethod
+    def build(cls, messages, epoch_length=3600, hasher=DEFAULT_HASHER, boundary_bits=None, processes=None):
+        """Build a forest with one worker process per epoch at a time. processes defaults to the number of CPUs."""
+        forest = cls(epoch_length=epoch_length, hasher=hasher, boundary_bits=boundary_bits)
+        by_epoch = forest._by_epoch(messages)
+        with tempfile.TemporaryDirectory() as directory, ProcessPoolExecutor(processes) as pool:
+            jobs = [(epoch, [(m.data, m.timestamp) for m in epoch_messages], _hasher_args(forest.hasher),
+                     os.path.join(directory, f"{epoch}.img"))
+                    for epoch, epoch_messages in by_epoch.items()]
+            for epoch, path in pool.map(_build_shard_image, jobs):
+                forest.shards[epoch] = ProllyTree.load(path)
+                forest._stale_epochs.add(epoch)
+        return forest
+
+    def _by_epoch(self, messages):
+        by_epoch = {}
+        for m in messages:
+            by_epoch.setdefault(self.epoch_of(m.timestamp), []).append(m)
+        for epoch_messages in by_epoch.values():
+            epoch_messages.sort(key=lambda m: m.timestamp)
+        return by_epoch
+
+    def epoch_of(self, timestamp):
+        return int(timestamp // self.epoch_length)
+
+    def epochs(self):
+        return sorted(self.shards)
+
+    def insert(self, message):
+        epoch = self.epoch_of(message.timestamp)
+        shard = self.shards.get(epoch)
+        if shard is None:
+            shard = self.shards[epoch] = ProllyTree(hasher=self.hasher)
+        self._stale_epochs.add(epoch)
+        return shard.insert(message)
+
+    def insert_many(self, messages):
+        new_nodes = []
+        for epoch, epoch_messages in self._by_epoch(messages).items():
+            shard = self.shards.get(epoch)
+            if shard is None:
+                shard = self.shards[epoch] = ProllyTree(hasher=self.hasher)
+            self._stale_epochs.add(epoch)
+            new_nodes.extend(shard.insert_many(epoch_messages))
+        return new_nodes
+
+    def search(self, timestamp):
+        shard = self.shards.get(self.epoch_of(timestamp))
+        return shard.search(timestamp) if shard is not None else None
+
+    def delete(self, timestamp):
+        epoch = self.epoch_of(timestamp)
+        shard = self.shards.get(epoch)
+        if shard is None:
+            return None
+        node = shard.delete(timestamp)
+        if node is not None:
+            self._stale_epochs.add(epoch)
+            if shard[0].tail.left is None:
+                del self.shards[epoch]
+        return node
+
+    def drop_epoch(self, epoch):
+        """Drop every message of an epoch at once."""
+        if self.shards.pop(epoch, None) is not None:
+            self._stale_epochs.add(epoch)
+
+    def drop_older_than(self, timestamp):
+        """Drop the epochs that end at or before timestamp. Messages of the epoch holding timestamp are kept."""
+        for epoch in [e for e in self.shards if (e + 1) * self.epoch_length <= timestamp]:
+            self.drop_epoch(epoch)
+
+    def range(self, start=None, end=None):
+        """Lazily yield the leaves with start <= timestamp < end across the epochs, left to right."""
+        for epoch in self.epochs():
+            if start is not None and (epoch + 1) * self.epoch_length <= start:
+                continue
+            if end is not None and epoch * self.epoch_length >= end:
+                break
+            yield from self.shards[epoch].range(start, end)
+
+    def top_tree(self):
+        """The tree over the epoch roots, with the leaves of changed epochs brought up to date."""
+        for epoch in sorted(self._stale_epochs):
+            self.top.delete(epoch)
+            shard = self.shards.get(epoch)
+            if shard is not None:
+                self.top.insert(Message(shard.get_root().merkel_hash, epoch))
+        self._stale_epochs.clear()
+        return self.top
+
+    def get_root(self):
+        return self.top_tree().get_root()
+
+    def reconcile(self, other):
+        """Find (only_in_self, only_in_other) leaves. The top trees are diffed first and only epochs whose roots differ are compared."""
+        if other.epoch_length != self.epoch_length:
+            raise ValueError("forests with different epoch lengths cannot be compared")
+        only_in_self, only_in_other = [], []
+        for epoch in sorted(_changed_keys(self.top_tree(), other.top_tree())):
+            shard, other_shard = self.shards.get(epoch), other.shards.get(epoch)
+            if shard is None:
+                only_in_other.extend(other_shard.range())
+            elif other_shard is None:
+                only_in_self.extend(shard.range())
+            else:
+                in_self, in_other = reconcile_prolly_trees(shard, other_shard)
+                only_in_self.extend(in_self)
+                only_in_other.extend(in_other)
+        return only_in_self, only_in_other
+
+    def diff(self, other):
+        """The leaves of other whose keys this forest lacks, like find_diff_between_2_prolly_trees(self, other)."""
+        return self.reconcile(other)[1]
@@ -0,0 +1,86 @@
+import hashlib
+
+# An invertible Bloom lookup table holds a set of fixed-size keys in a number of cells that depends on how many keys
+# must be recovered, not on how many were inserted. Every key is added to hash_count cells, one in each slice of the
+# table. A cell keeps the count of its keys, the XOR of the keys and the XOR of a checksum of each key. Subtracting
+# the table of one set from the table of another cancels the keys both hold, and the keys left are peeled off the
+# cells that hold a single one. Decoding fails, and says so, when the difference is too large for the table.
+
+
+class InvertibleBloomLookupTable:
+    """A table of cells keys of key_size bytes are added to. cells is rounded up to a multiple of hash_count."""
+
+    def __init__(self, cells, key_size, hash_count=3):
+        self.hash_count = hash_count
+        self.slice_size = max(1, -(-cells // hash_count))
+        self.key_size = key_size
+        size = self.slice_size * hash_count
+        self.counts = [0] * size
+        self.keys = [0] * size
+        self.checks = [0] * size
+
+    def __len__(self):
+        return len(self.counts)
+
+    def _cells_of(self, key):
+        """The cells of a key, one per slice, and its checksum."""
+        digest = hashlib.blake2b(key, digest_size=8 * self.hash_count + 4).digest()
+        cells = [i * self.slice_size + int.from_bytes(digest[8 * i:8 * i + 8], "big") % self.slice_size
+                 for i in range(self.hash_count)]
+        return cells, int.from_bytes(digest[-4:], "big")
+
+    def _toggle(self, key, value, sign):
+        cells, check = self._cells_of(key)
+        for cell in cells:
+            self.counts[cell] += sign
+            self.keys[cell] ^= value
+            self.checks[cell] ^= check
+
+    def add(self, key):
+        self._toggle(key, int.from_bytes(key, "big"), 1)
+
+    def subtract(self, other):
+        """The table of the keys only this one holds minus the keys only other holds."""
+        if (len(other), other.key_size, other.hash_count) != (len(self), self.key_size, self.hash_count):
+            raise ValueError("tables of different shapes cannot be subtracted")
+        table = InvertibleBloomLookupTable(len(self), self.key_size, self.hash_count)
+        table.counts = [a - b for a, b in zip(self.counts, other.counts)]
+        table.keys = [a ^ b for a, b in zip(self.keys, other.keys)]
+        table.checks = [a ^ b for a, b in zip(self.checks, other.checks)]
+        return table
+
+    def decode(self):
+        """Peel the table of a difference. Returns (positive, negative, complete): the keys counted +1 and -1, and
+        whether every cell was emptied. An incomplete decode leaves the table partly peeled."""
+        positive, negative = [], []
+        pending = list(range(len(self)))
+        while pending:
+            cell = pending.pop()
+            sign = self.counts[cell]
+            if sign not in (1, -1) or self.keys[cell].bit_length() > 8 * self.key_size:
+                continue
+            key = self.keys[cell].to_bytes(self.key_size, "big")
+            cells, check = self._cells_of(key)
+            if check != self.checks[cell] or cell not in cells:
+                # more than one key in the cell, whose XOR only looks like a key
+                continue
+            (positive if sign == 1 else negative).append(key)
+            self._toggle(key, self.keys[cell], -sign)
+            pending.extend(cells)
+        complete = not any(self.counts) and not any(self.keys) and not any(self.checks)
+        return positive, negative, complete
+
+    def to_wire(self):
+        """The non-empty cells as [index, count, key, check] with the key in hex."""
+        return [[i, count, format(key, "x"), check]
+                for i, (count, key, check) in enumerate(zip(self.counts, self.keys, self.checks))
+                if count or key or check]
+
+    @classmethod
+    def from_wire(cls, cells, size, key_size, hash_count=3):
+        table = cls(size, key_size, hash_count)
+        for i, count, key, check in cells:
+            table.counts[i] = count
+            table.keys[i] = int(key, 16)
+            table.checks[i] = check
+        return table
@@ -0,0 +1,219 @@
+import multiprocessing
+import os
+import secrets
+import socket
+import struct
+import sys
+from multiprocessing import resource_tracker, shared_memory
+
+from prolly_compact import CompactProllyTree
+from prolly_sync import SyncServer
+
+# Read-only images of a tree in POSIX shared memory, for serving sync requests from several worker processes.
+#
+# A publisher owns a small control segment under its name, holding the generation of the latest image. Every
+# publish() writes the image of the tree, the same one save() writes to a file, into a new segment named after the
+# generation, then stores the generation and unlinks the previous segment. Readers map the control segment once.
+# When they see a new generation they map its segment read-only and read the arrays in place, so attaching costs
+# neither hashing nor copying. The switch is atomic: a reader sees either the old image or the new one, never a
+# mix. A segment that is gone by the time a reader opens it was replaced in the meantime, and the reader looks at
+# the generation again. A reader keeps mapping the old image for as long as a tree read from it is in use, even
+# after it was unlinked.
+
+_GENERATION = struct.Struct("=Q")
+
+
+def _segment_name(name, generation):
+    return f"{name}-{generation}"
+
+
+def _attach(name):
+    """Open an existing segment. It is left out of the resource tracker, which would unlink it when this process
+    exits. Before Python 3.13 this means registering and unregistering it, and the tracker shared by forked processes
+    may report an unknown name when two of them attach the same segment at once, which does no harm."""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track=False)
+    segment = shared_memory.SharedMemory(name)
+    resource_tracker.unregister("/" + segment.name, "shared_memory")
+    return segment
+
+
+def _unlink(segment):
+    # a reader sharing this process's resource tracker may have unregistered the segment, and unlink() unregisters
+    # it again; registering twice is harmless, so register it first
+    resource_tracker.register("/" + segment.name, "shared_memory")
+    segment.unlink()
+
+
+class SharedTreePublisher:
+    """Publishes images of a tree in shared memory under a name that readers in other processes attach to."""
+
+    def __init__(self, name=None):
+        self.name = name or f"prolly-{secrets.token_hex(4)}"
+        self.generation = 0
+        self._control = shared_memory.SharedMemory(self.name, create=True, size=_GENERATION.size)
+        _GENERATION.pack_into(self._control.buf, 0, 0)
+        self._segment = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def publish(self, tree):
+        """Write an image of a ProllyTree or CompactProllyTree and switch the readers to it. Returns its generation."""
+        compact = tree if isinstance(tree, CompactProllyTree) else CompactProllyTree.from_tree(tree)
+        generation = self.generation + 1
+        segment = shared_memory.SharedMemory(_segment_name(self.name, generation), create=True,
+                                             size=compact.image_size())
+        compact.write_image(segment.buf)
+        _GENERATION.pack_into(self._control.buf, 0, generation)
+        self.generation = generation
+        self._unlink_segment()
+        self._segment = segment
+        return generation
+
+    def _unlink_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+            _unlink(self._segment)
+            self._segment = None
+
+    def close(self):
+        """Unlink the control segment and the latest image. Readers keep the image they mapped."""
+        if self._control is not None:
+            self._unlink_segment()
+            self._control.close()
+            _unlink(self._control)
+            self._control = None
+
+
+class SharedTreeReader:
+    """Attaches to the images published under a name. tree() returns the latest one as a CompactProllyTree."""
+
+    def __init__(self, name):
+        self.name = name
+        self.generation = 0
+        self._control = _attach(name)
+        self._tree = None
+        self._segment = None
+        self._retired = []  # segments of older images, closed once no tree read from them is left
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def tree(self):
+        """The latest published image. Only a new generation costs anything: mapping it and reading its header."""
+        while True:
+            generation = _GENERATION.unpack_from(self._control.buf)[0]
+            if generation == 0:
+                raise LookupError(f"no tree has been published under {self.name!r}")
+            if generation == self.generation:
+                return self._tree
+            try:
+                segment = _attach(_segment_name(self.name, generation))
+            except FileNotFoundError:
+                # replaced since the generation was read
+                continue
+            break
+        tree = CompactProllyTree.from_buffer(segment.buf.toreadonly(), name=_segment_name(self.name, generation))
+        # the views of the tree do not keep the segment object alive, which would try to close them when collected
+        tree._segment = segment
+        if self._segment is not None:
+            self._retired.append(self._segment)
+        self._tree, self._segment, self.generation = tree, segment, generation
+        self._close_retired()
+        return tree
+
+    def _close_retired(self):
+        in_use = []
+        for segment in self._retired:
+            try:
+                segment.close()
+            except BufferError:
+                # a tree read from it still holds views, try again on the next switch
+                in_use.append(segment)
+        self._retired = in_use
+
+    def close(self):
+        """Drop the latest image and unmap what is no longer in use."""
+        if self._segment is not None:
+            self._retired.append(self._segment)
+        self._tree = self._segment = None
+        self.generation = 0
+        self._close_retired()
+        self._control.close()
+
+
+class SharedSyncServer(SyncServer):
+    """A SyncServer over the images a SharedTreeReader attaches to. A session starts with a root request, which
+    moves the server to the latest image; the rest of the session is answered from the same image even when a new
+    one is published meanwhile."""
+
+    def __init__(self, reader, codec=None):
+        super().__init__(None, codec)
+        self.reader = reader
+
+    def handle(self, request):
+        if self.tree is None or request.get("op") == "root":
+            self.tree = self.reader.tree()
+        return super().handle(request)
+
+
+def _listen(address):
+    if isinstance(address, str):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(address)
+    listener.listen(128)
+    return listener
+
+
+def _serve_shared(reader, listener, codec):
+    server = SharedSyncServer(reader, codec)
+    while True:
+        sock, _ = listener.accept()
+        try:
+            server.serve_connection(sock)
+        except Exception:
+            # a broken connection or a bad request ends that connection only, serve_connection has closed the socket
+            pass
+
+
+class SharedSyncWorkers:
+    """Worker processes answering sync requests about the tree published under name, on a unix socket path or a
+    (host, port) pair. The workers are forked up front and accept on the same listening socket, each serving one
+    connection at a time. workers defaults to the number of CPUs."""
+
+    def __init__(self, name, address, workers=None, codec=None):
+        self.listener = _listen(address)
+        self.address = self.listener.getsockname()
+        # attached once here, so the workers do not all open the control segment at the same time
+        self.reader = SharedTreeReader(name)
+        context = multiprocessing.get_context("fork")
+        self.processes = [context.Process(target=_serve_shared, args=(self.reader, self.listener, codec), daemon=True)
+                          for _ in range(workers or os.cpu_count() or 1)]
+        for process in self.processes:
+            process.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.reader.close()
+        self.listener.close()
+        if isinstance(self.address, str):
+            os.unlink(self.address)
@@ -0,0 +1,165 @@
+import threading
+from bisect import bisect_left
+
+# Versioned, read-only views of a ProllyTree that stay consistent while the tree keeps changing.
+#
+# tree.snapshot() flushes the pending merkel hashes and records the root, which is O(1) apart from that flush.
+# Nothing is copied up front: a snapshot reads the live buckets until a mutation is about to change one of them.
+# Before every insert or delete the tree hands the owners on the affected path to its live snapshots, and each keeps
+# a copy of the buckets it has not copied yet. A bucket is a run of nodes with their hashes, so a mutation costs
+# every live snapshot O(height) bucket copies at most. Releasing a snapshot, or dropping the last reference to it,
+# frees its copies.
+#
+# A snapshot can be read from any thread, but taking and releasing one are not synchronised with the writer: taking
+# one flushes the tree's pending hashes and both change the set of live snapshots a mutation walks. Do them on the
+# thread that mutates the tree, and hand the snapshot to the readers.
+
+
+class SnapshotNode:
+    """A node of a Snapshot with the attributes of a Node. It knows the owner of its bucket, which is how it reaches its neighbours and the level above."""
+    __slots__ = ("snapshot", "parent", "index", "node", "level", "timestamp", "node_hash", "merkel_hash", "data",
+                 "is_tail")
+
+    def __init__(self, snapshot, parent, index, level, entry):
+        self.snapshot = snapshot
+        self.parent = parent
+        self.index = index
+        self.level = level
+        self.node, self.timestamp, self.node_hash, self.merkel_hash, self.data, self.is_tail = entry
+
+    def bucket_nodes(self):
+        """The bucket of the node as it was when the snapshot was taken."""
+        level = self.level - 1
+        return [SnapshotNode(self.snapshot, self, i, level, entry)
+                for i, entry in enumerate(self.snapshot._entries(self.node))]
+
+    def is_boundary_node(self):
+        # a bucket ends at its only boundary, and the root is the top tail
+        return self.parent is None or self.index == len(self.snapshot._entries(self.parent.node)) - 1
+
+    @property
+    def down(self):
+        if self.level == 0:
+            return None
+        return self.bucket_nodes()[-1]
+
+    @property
+    def up(self):
+        return self.parent if self.is_boundary_node() else None
+
+    @property
+    def left(self):
+        if self.parent is None:
+            return None
+        if self.index > 0:
+            return SnapshotNode(self.snapshot, self.parent, self.index - 1, self.level,
+                                self.snapshot._entries(self.parent.node)[self.index - 1])
+        owner = self.parent.left
+        return owner.down if owner is not None else None
+
+    @property
+    def right(self):
+        if self.parent is None:
+            return None
+        entries = self.snapshot._entries(self.parent.node)
+        if self.index + 1 < len(entries):
+            return SnapshotNode(self.snapshot, self.parent, self.index + 1, self.level, entries[self.index + 1])
+        owner = self.parent.right
+        return owner.bucket_nodes()[0] if owner is not None else None
+
+    def __repr__(self):
+        return f"SnapshotNode({self.data}, {self.timestamp})"
+
+
+def _entry(node):
+    return node, node.timestamp, node.node_hash, node.merkel_hash, node.data, node.is_tail
+
+
+class Snapshot:
+    """A frozen version of a ProllyTree, created with tree.snapshot(). It can be searched, range-queried, diffed and served with SyncServer while the tree changes. Use it as a context manager or call release() when done."""
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.hasher = tree.hasher
+        self._lock = threading.Lock()
+        self._saved = {}  # id(owner) -> (owner, entries of its bucket before the first change)
+        root = tree.get_root()
+        root.merkel_hash  # flush the pending hashes, the tree is consistent from here on
+        self._root = SnapshotNode(self, None, 0, root.level, _entry(root))
+        tree._snapshots.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def release(self):
+        """Stop following the tree and free the copied buckets. The snapshot must not be read afterwards. Call it on
+        the thread that mutates the tree, like tree.snapshot()."""
+        self.tree._snapshots.discard(self)
+        self._saved = {}
+
+    def saved_buckets(self):
+        """Number of buckets copied because the tree changed them after the snapshot."""
+        return len(self._saved)
+
+    def _keep(self, owner):
+        """Copy the bucket of owner unless it was already copied. Called by the tree before it changes the bucket."""
+        if id(owner) not in self._saved and owner.down is not None:
+            self._saved[id(owner)] = (owner, [_entry(n) for n in owner.bucket_nodes()])
+
+    def _entries(self, owner):
+        with self._lock:
+            saved = self._saved.get(id(owner))
+            if saved is not None:
+                return saved[1]
+            # not changed since the snapshot, so the live bucket is still the snapshot's bucket
+            return [_entry(n) for n in owner.bucket_nodes()]
+
+    def __len__(self):
+        return self._root.level + 1
+
+    def get_root(self):
+        return self._root
+
+    def get_root_at_height(self, height_diff):
+        root_at_height = self._root
+        while height_diff > 0:
+            root_at_height = root_at_height.down
+            height_diff -= 1
+        return root_at_height
+
+    def _find_node_at_level(self, timestamp, level):
+        """Find the node of the given level with the smallest timestamp greater than or equal to timestamp, the leftmost one for None."""
+        node = self._root
+        while node.level > level:
+            entries = self._entries(node.node)
+            if timestamp is None:
+                index = 0
+            else:
+                # the last entry of a bucket may be the tail, which is greater than any key
+                hi = len(entries) - 1 if entries[-1][5] else len(entries)
+                index = min(bisect_left([entry[1] for entry in entries[:hi]], timestamp), len(entries) - 1)
+            node = SnapshotNode(self, node, index, node.level - 1, entries[index])
+        return node
+
+    def search(self, timestamp):
+        if self._root.level == 0:
+            return None
+        node = self._find_node_at_level(timestamp, 0)
+        return None if node.is_tail or node.timestamp != timestamp else node
+
+    def get_intermediate_node(self, timestamp, level):
+        """Get the node at a level using a key, or None if the key was not promoted that far."""
+        node = self._find_node_at_level(timestamp, level)
+        return None if node.is_tail or node.timestamp != timestamp else node
+
+    def range(self, start=None, end=None):
+        """Lazily yield the leaves with start <= timestamp < end as they were when the snapshot was taken."""
+        if self._root.level == 0:
+            return
+        node = self._find_node_at_level(start, 0)
+        while not node.is_tail and (end is None or node.timestamp < end):
+            yield node
+            node = node.right
@@ -0,0 +1,222 @@
+import functools
+from collections import Counter
+
+from prolly_tree import ProllyTree
+
+# Opt-in instrumentation of a ProllyTree.
+#
+# tree.instrument() switches the class of the tree, of its own hasher and of its levels to the subclasses below,
+# whose methods count what they do. An uninstrumented tree runs the plain classes, so the hot loops carry no counter
+# and no flag test at all; uninstrument() switches the classes back. The counted events are:
+#   leaf_hashes, promoted_hashes  hashes of new leaves and of their promoted copies
+#   bucket_hashes                 merkel hashes of buckets rebuilt, when built and when a stale one is read again
+#   hops                          left/down pointer steps of the searches that locate a key, and nodes reached when
+#                                 a diff or a sync session reads buckets of the tree
+#   bucket_reads                  buckets read by a diff or a sync session
+#   level_scans                   whole levels materialized with Level.to_list
+# Every public operation records the counts it caused under its name, as does a diff or sync session run on the
+# tree, on either side of a diff and whether the tree or its root node is passed. Merkel hashes are refreshed lazily,
+# so their cost lands on the operation that reads them, and in the totals.
+
+EVENTS = ("leaf_hashes", "promoted_hashes", "bucket_hashes", "hops", "bucket_reads", "level_scans")
+
+# the ProllyTree methods counted as operations
+OPERATIONS = ("insert", "insert_many", "delete", "delete_range", "search", "missing", "get_intermediate_node",
+              "range_page", "range_fingerprint", "snapshot", "save")
+
+
+class TreeStats:
+    """The counters of an instrumented tree: totals, per-operation counts and the hooks called after every operation."""
+
+    def __init__(self):
+        self.enabled = False
+        self.counters = Counter(dict.fromkeys(EVENTS, 0))
+        self.operations = {}
+        self.hooks = []
+        self._depth = 0
+        # levels have slots, so their counting class carries the counters itself
+        self.level_class = None
+
+    def snapshot(self):
+        return {"totals": dict(self.counters),
+                "operations": {name: dict(counts) for name, counts in self.operations.items()}}
+
+    def operation(self, name):
+        return _Operation(self, name)
+
+
+class _Operation:
+    """Counts a block as one call of an operation. An operation running inside another one is part of it."""
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+        self.before = None
+
+    def __enter__(self):
+        stats = self.stats
+        stats._depth += 1
+        if stats._depth == 1:
+            self.before = stats.counters.copy()
+        return self
+
+    def __exit__(self, *exc_info):
+        stats = self.stats
+        stats._depth -= 1
+        if self.before is None:
+            return
+        counts = {"calls": 1}
+        counts.update((event, stats.counters[event] - self.before[event]) for event in EVENTS)
+        totals = stats.operations.setdefault(self.name, Counter())
+        totals.update(counts)
+        for hook in stats.hooks:
+            hook(self.name, counts)
+
+
+def instrument(tree, hook=None):
+    stats = tree._stats
+    if stats is None:
+        stats = tree._stats = TreeStats()
+    if hook is not None:
+        stats.hooks.append(hook)
+    if not stats.enabled:
+        stats.enabled = True
+        tree.__class__ = _instrumented_class(type(tree))
+        tree.hasher.__class__ = _instrumented_class(type(tree.hasher))
+        tree.hasher.counters = stats.counters
+        # the nodes share the hasher, so a diff given a root node finds the stats through it
+        tree.hasher.stats = stats
+        for level in tree:
+            _instrument_level(level, stats)
+    return tree
+
+
+def uninstrument(tree):
+    stats = tree._stats
+    if stats is None or not stats.enabled:
+        return
+    stats.enabled = False
+    tree.__class__ = tree.__class__.plain_class
+    tree.hasher.__class__ = tree.hasher.__class__.plain_class
+    del tree.hasher.counters, tree.hasher.stats
+    for level in tree:
+        level.__class__ = level.__class__.plain_class
+
+
+def _instrument_level(level, stats):
+    if stats.level_class is None or stats.level_class.plain_class is not type(level):
+        stats.level_class = type(f"Instrumented{type(level).__name__}", (InstrumentedLevel, type(level)),
+                                 {"__slots__": (), "plain_class": type(level), "counters": stats.counters})
+    level.__class__ = stats.level_class
+
+
+_INSTRUMENTED = {}
+
+
+def _instrumented_class(plain_class):
+    """The counting subclass of a tree or hasher class, which subclasses of them get too."""
+    instrumented = _INSTRUMENTED.get(plain_class)
+    if instrumented is None:
+        mixin = InstrumentedTree if issubclass(plain_class, ProllyTree) else InstrumentedHasher
+        instrumented = type(f"Instrumented{plain_class.__name__}", (mixin, plain_class),
+                            {"__slots__": (), "plain_class": plain_class})
+        _INSTRUMENTED[plain_class] = instrumented
+    return instrumented
+
+
+class InstrumentedHasher:
+    """Counts every hash on top of the hashing scheme it is mixed into."""
+
+    def copy(self):
+        # a copy is for another tree, which counts on its own if at all
+        hasher = super().copy()
+        hasher.__class__ = self.plain_class
+        del hasher.counters, hasher.stats
+        return hasher
+
+    def leaf_hash(self, data, timestamp, is_tail=False):
+        self.counters["leaf_hashes"] += 1
+        return super().leaf_hash(data, timestamp, is_tail)
+
+    def promoted_hash(self, node_hash):
+        self.counters["promoted_hashes"] += 1
+        return super().promoted_hash(node_hash)
+
+    def bucket_hash(self, nodes):
+        self.counters["bucket_hashes"] += 1
+        return super().bucket_hash(nodes)
+
+    def finish(self, hasher):
+        # a bucket closed while a tree is built
+        self.counters["bucket_hashes"] += 1
+        return super().finish(hasher)
+
+
+class InstrumentedLevel:
+    __slots__ = ()
+
+    def to_list(self):
+        self.counters["level_scans"] += 1
+        return super().to_list()
+
+
+def _counted_operation(name):
+
+    @functools.wraps(getattr(ProllyTree, name))
+    def counted(self, *args, **kwargs):
+        with self._stats.operation(name):
+            return getattr(super(InstrumentedTree, self), name)(*args, **kwargs)
+    return counted
+
+
+class InstrumentedTree:
+    """The searches of ProllyTree with their pointer hops counted, and its public operations recorded."""
+
+    def _add_empty_level(self):
+        level = super()._add_empty_level()
+        _instrument_level(self[-1], self._stats)
+        return level
+
+    # The searches are ProllyTree's, made of the pointer steps below. Each step runs the plain one and counts the
+    # nodes it passed, so a fix to a search or a step is made in one place.
+
+    def _climb_while_greater(self, node, timestamp):
+        top = super()._climb_while_greater(node, timestamp)
+        self._stats.counters["hops"] += top.level - node.level
+        return top
+
+    def _descend_while_greater(self, node, timestamp):
+        # the plain descent fuses its steps for speed; this is the same descent, a left walk and a step down per level
+        while node.down is not None:
+            node = self._left_while_greater(node, timestamp).down
+            self._stats.counters["hops"] += 1
+        return node
+
+    def _left_while_greater(self, node, timestamp):
+        return self._count_left_walk(node, super()._left_while_greater(node, timestamp))
+
+    def _left_while_at_or_after(self, node, timestamp):
+        return self._count_left_walk(node, super()._left_while_at_or_after(node, timestamp))
+
+    def _count_left_walk(self, start, end):
+        hops = 0
+        while end is not start:
+            start = start.left
+            hops += 1
+        self._stats.counters["hops"] += hops
+        return end
+
+    def _find_node_at_level(self, timestamp, level):
+        node = super()._find_node_at_level(timestamp, level)
+        # one step down per level above the one reached
+        self._stats.counters["hops"] += self.get_root().level - level
+        return node
+
+    def _first_nodes_at_or_after(self, timestamp):
+        nodes = super()._first_nodes_at_or_after(timestamp)
+        self._stats.counters["hops"] += len(nodes) - 1
+        return nodes
+
+
+for _name in OPERATIONS:
+    setattr(InstrumentedTree, _name, _counted_operation(_name))
@@ -0,0 +1,244 @@
+import pickle
+import sqlite3
+import sys
+from bisect import bisect_left
+from collections import OrderedDict
+
+from prolly_tree import Hasher
+
+# Disk-backed storage for Prolly trees. Every bucket is an immutable block keyed by the merkel hash of its owner, so
+# identical subtrees are stored once and saving a tree again only writes the buckets that changed. A saved tree is
+# opened as a StoredProllyTree: a read-only view that loads buckets on demand when a search, a range query or a diff
+# descends into them. The buckets of the upper levels, which every sync touches, are kept resident; the others go
+# through an LRU cache with a byte budget.
+#
+# Blocks are pickled, so a store must only be opened from a trusted file.
+
+
+class BucketStore:
+    """A SQLite file of content-addressed buckets and named roots."""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS buckets (hash BLOB PRIMARY KEY, body BLOB NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS roots (name TEXT PRIMARY KEY, body BLOB NOT NULL)")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def has(self, key):
+        return self.db.execute("SELECT 1 FROM buckets WHERE hash = ?", (key,)).fetchone() is not None
+
+    def get(self, key):
+        row = self.db.execute("SELECT body FROM buckets WHERE hash = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(f"bucket {key.hex()} is not in the store")
+        return row[0]
+
+    def put(self, key, body):
+        self.db.execute("INSERT OR IGNORE INTO buckets (hash, body) VALUES (?, ?)", (key, body))
+
+    def bucket_count(self):
+        return self.db.execute("SELECT COUNT(*) FROM buckets").fetchone()[0]
+
+    def save(self, tree, name="main"):
+        """Store the buckets of a tree and record its root under name. A bucket already in the store holds the
+        whole subtree below it, so that subtree is skipped. Returns the number of buckets written."""
+        hasher = tree.hasher
+        root = tree.get_root()
+        written = 0
+        with self.db:
+            stack = [root] if root.level > 0 else []
+            while stack:
+                owner = stack.pop()
+                key = hasher.to_bytes(owner.merkel_hash)
+                if self.has(key):
+                    continue
+                bucket = owner.bucket_nodes()
+                self.put(key, _encode_bucket(hasher, bucket))
+                written += 1
+                stack.extend(n for n in bucket if n.level > 0)
+            record = (root.level, hasher.to_bytes(root.node_hash), hasher.to_bytes(root.merkel_hash),
+                      (hasher.algorithm, hasher.hex_digests, hasher._digest_size_arg, hasher.boundary_bits))
+            self.db.execute("INSERT OR REPLACE INTO roots (name, body) VALUES (?, ?)", (name, pickle.dumps(record)))
+        return written
+
+    def open(self, name="main", cache_bytes=32 << 20, resident_levels=2):
+        """Open the tree saved under name as a lazy read-only StoredProllyTree."""
+        return StoredProllyTree(self, name, cache_bytes, resident_levels)
+
+
+def _encode_bucket(hasher, nodes):
+    # one entry per node: timestamp (None for the tail), node hash, merkel hash and the payload of a leaf
+    return pickle.dumps([(None if n.is_tail else n.timestamp, hasher.to_bytes(n.node_hash),
+                          hasher.to_bytes(n.merkel_hash), n.data if n.level == 0 else None) for n in nodes],
+                        protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class StoredNode:
+    """A node of a StoredProllyTree with the attributes of a Node. It knows the owner of its bucket, which is how it
+    reaches its neighbours and the level above."""
+    __slots__ = ("tree", "parent", "index", "level", "timestamp", "node_hash", "merkel_hash", "data", "is_tail",
+                 "_key")
+
+    def __init__(self, tree, parent, index, level, entry):
+        timestamp, node_hash, merkel_hash, data = entry
+        hasher = tree.hasher
+        self.tree = tree
+        self.parent = parent
+        self.index = index
+        self.level = level
+        self.is_tail = timestamp is None
+        self.timestamp = "Tail" if self.is_tail else timestamp
+        self.node_hash = hasher.from_bytes(node_hash)
+        self.merkel_hash = hasher.from_bytes(merkel_hash)
+        self.data = "Tail" if self.is_tail and level == 0 else data
+        self._key = merkel_hash
+
+    def bucket_nodes(self):
+        """The bucket of the node, loaded from the store unless it is cached."""
+        level = self.level - 1
+        return [StoredNode(self.tree, self, i, level, entry) for i, entry in enumerate(self.tree._entries(self))]
+
+    def is_boundary_node(self):
+        # a bucket ends at its only boundary, and the root is the top tail
+        return self.parent is None or self.index == len(self.tree._entries(self.parent)) - 1
+
+    @property
+    def down(self):
+        if self.level == 0:
+            return None
+        return self.bucket_nodes()[-1]
+
+    @property
+    def up(self):
+        return self.parent if self.is_boundary_node() else None
+
+    @property
+    def left(self):
+        if self.parent is None:
+            return None
+        if self.index > 0:
+            return StoredNode(self.tree, self.parent, self.index - 1, self.level,
+                              self.tree._entries(self.parent)[self.index - 1])
+        owner = self.parent.left
+        return owner.down if owner is not None else None
+
+    @property
+    def right(self):
+        if self.parent is None:
+            return None
+        entries = self.tree._entries(self.parent)
+        if self.index + 1 < len(entries):
+            return StoredNode(self.tree, self.parent, self.index + 1, self.level, entries[self.index + 1])
+        owner = self.parent.right
+        return owner.bucket_nodes()[0] if owner is not None else None
+
+    def __repr__(self):
+        return f"StoredNode({self.data}, {self.timestamp})"
+
+
+class StoredProllyTree:
+    """A read-only view of a tree saved in a BucketStore. Buckets are loaded when something descends into them;
+    those of the top resident_levels levels stay in memory and the others share an LRU cache of cache_bytes."""
+
+    def __init__(self, store, name="main", cache_bytes=32 << 20, resident_levels=2):
+        row = store.db.execute("SELECT body FROM roots WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise KeyError(f"no tree named {name!r} in the store")
+        level, node_hash, merkel_hash, (algorithm, hex_digests, digest_size, boundary_bits) = pickle.loads(row[0])
+        self.store = store
+        self.hasher = Hasher(algorithm, hex_digests, digest_size, boundary_bits)
+        self.cache_bytes = cache_bytes
+        self.cached_bytes = 0
+        self.loads = 0  # buckets read from the store
+        self._cache = OrderedDict()  # key -> (entries, size), least recently used first
+        self._resident = {}
+        self._resident_level = level - resident_levels + 1
+        self._root = StoredNode(self, None, 0, level, (None, node_hash, merkel_hash, None))
+
+        # load the resident levels up front
+        owners = [self._root] if level > 0 else []
+        while owners:
+            owners = [n for owner in owners for n in owner.bucket_nodes()
+                      if n.level > 0 and n.level >= self._resident_level]
+
+    def _entries(self, owner):
+        key = owner._key
+        entries = self._resident.get(key)
+        if entries is not None:
+            return entries
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            return cached[0]
+        body = self.store.get(key)
+        self.loads += 1
+        entries = pickle.loads(body)
+        if owner.level >= self._resident_level:
+            self._resident[key] = entries
+            return entries
+        # charged what the decoded entries take in memory, the list and per entry its tuple and fields, which is
+        # several times the pickled body
+        size = sys.getsizeof(entries) + sum(sys.getsizeof(entry) + sum(map(sys.getsizeof, entry)) for entry in entries)
+        self._cache[key] = (entries, size)
+        self.cached_bytes += size
+        while self.cached_bytes > self.cache_bytes and len(self._cache) > 1:
+            _, (_, size) = self._cache.popitem(last=False)
+            self.cached_bytes -= size
+        return entries
+
+    def __len__(self):
+        return self._root.level + 1
+
+    def get_root(self):
+        return self._root
+
+    def get_root_at_height(self, height_diff):
+        root_at_height = self._root
+        while height_diff > 0:
+            root_at_height = root_at_height.down
+            height_diff -= 1
+        return root_at_height
+
+    def _find_node_at_level(self, timestamp, level):
+        """Find the node of the given level with the smallest timestamp greater than or equal to timestamp, the leftmost one for None, loading one bucket per level on the way down."""
+        node = self._root
+        while node.level > level:
+            entries = self._entries(node)
+            if timestamp is None:
+                index = 0
+            else:
+                # the last entry of a bucket may be the tail, which is greater than any key
+                keys = [entry[0] for entry in entries]
+                hi = len(keys) - 1 if keys[-1] is None else len(keys)
+                index = min(bisect_left(keys, timestamp, 0, hi), len(keys) - 1)
+            node = StoredNode(self, node, index, node.level - 1, entries[index])
+        return node
+
+    def search(self, timestamp):
+        if self._root.level == 0:
+            return None
+        node = self._find_node_at_level(timestamp, 0)
+        return None if node.is_tail or node.timestamp != timestamp else node
+
+    def get_intermediate_node(self, timestamp, level):
+        """Get the node at a level using a key, or None if the key was not promoted that far."""
+        node = self._find_node_at_level(timestamp, level)
+        return None if node.is_tail or node.timestamp != timestamp else node
+
+    def range(self, start=None, end=None):
+        """Lazily yield the leaves with start <= timestamp < end, left to right, paging buckets in as the walk reaches them."""
+        if self._root.level == 0:
+            return
+        node = self._find_node_at_level(start, 0)
+        while not node.is_tail and (end is None or node.timestamp < end):
+            yield node
+            node = node.right
@@ -0,0 +1,488 @@
+import heapq
+import itertools
+import json
+import socket
+import struct
+from bisect import bisect_left
+
+from prolly_tree import (get_non_boundary_nodes, _split_mismatches, _leaf_differences, _level_ending_at,
+                         _counters_of, _measure)
+from prolly_iblt import InvertibleBloomLookupTable
+
+# Request/response sync between two Prolly trees that live in different processes.
+#
+# The server side answers two kinds of requests about its tree:
+#   {"op": "root"}                                     -> {"level": L, "merkel_hash": "<hex>"}
+#   {"op": "children", "level": L, "owners": [ts...]}  -> {"children": [[[ts, "<hex>"], ...], ...]}
+# where a children request asks for the buckets of a whole level's mismatching owners at once and the tail is sent
+# as a null timestamp. A children request may carry "hash_prefix": n, and the merkel hashes of its answer are then
+# cut to their first n bytes. The client compares those prefixes with its own hashes. A collision can hide a
+# mismatching child or pair nodes up wrongly, so a truncated session is only accepted once the differences it found,
+# applied to the local tree, give the peer's root hash, which always comes in full. Otherwise the session starts over
+# with full hashes. The client side drives the same level-by-level comparison as iter_reconcile_prolly_trees, with its
+# own tree read locally and the peer's tree fetched one batched request per level.
+#
+# In hybrid mode the client stops descending once the mismatching subtrees are small and asks for an invertible
+# Bloom lookup table of the leaves under them instead:
+#   {"op": "iblt", "level": L, "owners": [ts...], "cells": m}
+#       -> {"cells": [[index, count, "<hex key>", check], ...], "leaves": n}
+# A leaf is keyed by its 8-byte timestamp followed by its hash. The client subtracts the table from one of its own
+# leaves under the same subtrees and decodes the difference, usually in that single round. A table too small for the
+# difference is retried once with a size taken from the gap between the leaf counts. If that fails too, or the
+# timestamps are not integers ("cells" is null), the client finishes with the normal descent.
+
+# hybrid mode sizes a table for the number of mismatching owners at the level it switches at
+IBLT_MIN_CELLS = 12
+IBLT_CELLS_PER_OWNER = 3
+
+
+class RemoteNode:
+    """A node of the peer's tree as received over the wire: just enough for the comparison."""
+    __slots__ = ("timestamp", "merkel_hash", "level", "is_tail")
+
+    def __init__(self, timestamp, merkel_hash, level, is_tail=False):
+        self.timestamp = "Tail" if is_tail else timestamp
+        self.merkel_hash = merkel_hash
+        self.level = level
+        self.is_tail = is_tail
+
+    def __repr__(self):
+        return f"RemoteNode({self.timestamp}, level={self.level})"
+
+
+class HashPrefix(bytes):
+    """The first bytes of a remote merkel hash. It equals any digest, raw or hex, that starts with them."""
+    __slots__ = ()
+
+    def __eq__(self, other):
+        if isinstance(other, str):
+            return other[:2 * len(self)] == self.hex()
+        return bytes(other[:len(self)]) == bytes(self)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = bytes.__hash__
+
+
+class SyncStats:
+    """Round trips and bytes of one sync session."""
+    __slots__ = ("round_trips", "bytes_sent", "bytes_received")
+
+    def __init__(self):
+        self.round_trips = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def __repr__(self):
+        return (f"SyncStats(round_trips={self.round_trips}, bytes_sent={self.bytes_sent}, "
+                f"bytes_received={self.bytes_received})")
+
+
+class JsonCodec:
+    """Encodes sync messages as JSON."""
+
+    def encode(self, message):
+        return json.dumps(message, separators=(",", ":")).encode()
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+
+class SyncServer:
+    """Answers sync requests about a tree."""
+
+    def __init__(self, tree, codec=None):
+        self.tree = tree
+        self.codec = codec or JsonCodec()
+
+    def handle_bytes(self, payload):
+        return self.codec.encode(self.handle(self.codec.decode(payload)))
+
+    def handle(self, request):
+        op = request["op"]
+        if op == "root":
+            root = self.tree.get_root()
+            return {"level": root.level, "merkel_hash": self._wire_hash(root.merkel_hash)}
+        if op == "children":
+            level = request["level"]
+            hash_size = request.get("hash_prefix")
+            return {"children": [self._children(level, owner, hash_size) for owner in request["owners"]]}
+        if op == "iblt":
+            level = request["level"]
+            owners = [self._owner(level, timestamp) for timestamp in request["owners"]]
+            hasher = self.tree.hasher
+            try:
+                keys = _leaf_keys(hasher, _leaves_under([n for n in owners if n is not None]))
+            except struct.error:
+                return {"cells": None}
+            return {"cells": _table_of(keys, request["cells"], 8 + hasher.digest_size).to_wire(),
+                    "leaves": len(keys)}
+        raise ValueError(f"unknown sync request {op!r}")
+
+    def _owner(self, level, timestamp):
+        if timestamp is None:
+            return self.tree.get_root_at_height(self.tree.get_root().level - level)
+        return self.tree.get_intermediate_node(timestamp, level)
+
+    def _children(self, level, timestamp, hash_size=None):
+        owner = self._owner(level, timestamp)
+        if owner is None or owner.down is None:
+            # the owner is gone, the client will see an empty bucket
+            return []
+        return [[None if n.is_tail else n.timestamp, self._wire_hash(n.merkel_hash, hash_size)]
+                for n in get_non_boundary_nodes([owner])]
+
+    def _wire_hash(self, digest, hash_size=None):
+        return self.tree.hasher.to_bytes(digest)[:hash_size].hex()
+
+    def serve_connection(self, sock):
+        """Answer framed requests on a connected socket until the peer closes it."""
+        with sock:
+            while True:
+                payload = _receive_frame(sock)
+                if payload is None:
+                    return
+                _send_frame(sock, self.handle_bytes(payload))
+
+
+class Transport:
+    """Carries encoded requests to a server and counts what goes over the link."""
+
+    def __init__(self):
+        self.stats = SyncStats()
+
+    def request(self, payload):
+        self.stats.round_trips += 1
+        self.stats.bytes_sent += len(payload)
+        response = self._exchange(payload)
+        self.stats.bytes_received += len(response)
+        return response
+
+    def _exchange(self, payload):
+        raise NotImplementedError
+
+
+class LoopbackTransport(Transport):
+    """Hands requests straight to an in-memory server, still going through the codec so bytes are counted."""
+
+    def __init__(self, server):
+        super().__init__()
+        self.server = server
+
+    def _exchange(self, payload):
+        return self.server.handle_bytes(payload)
+
+
+class SocketTransport(Transport):
+    """Sends length-prefixed requests over a connected stream socket."""
+
+    def __init__(self, sock):
+        super().__init__()
+        self.sock = sock
+
+    @classmethod
+    def connect(cls, address):
+        """Connect to a server on a unix socket path or a (host, port) pair."""
+        if isinstance(address, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(address)
+        else:
+            sock = socket.create_connection(address)
+        return cls(sock)
+
+    def _exchange(self, payload):
+        _send_frame(self.sock, payload)
+        response = _receive_frame(self.sock)
+        if response is None:
+            raise ConnectionError("sync server closed the connection")
+        return response
+
+    def close(self):
+        self.sock.close()
+
+
+def _send_frame(sock, payload):
+    sock.sendall(struct.pack(">I", len(payload)) + payload)
+
+
+def _receive_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _receive_frame(sock):
+    header = _receive_exactly(sock, 4)
+    if header is None:
+        return None
+    return _receive_exactly(sock, struct.unpack(">I", header)[0])
+
+
+def _remote_node(hasher, timestamp, wire_hash, level):
+    raw = bytes.fromhex(wire_hash) if isinstance(wire_hash, str) else wire_hash
+    digest = HashPrefix(raw) if len(raw) < hasher.digest_size else hasher.from_bytes(raw)
+    return RemoteNode(timestamp, digest, level, timestamp is None)
+
+
+def _remote_root(hasher, response):
+    return _remote_node(hasher, None, response["merkel_hash"], response["level"])
+
+
+def _children_request(level, owners, hash_prefix=None):
+    request = {"op": "children", "level": level, "owners": [None if n.is_tail else n.timestamp for n in owners]}
+    if hash_prefix is not None:
+        request["hash_prefix"] = hash_prefix
+    return request
+
+
+def _remote_buckets(hasher, level, response):
+    return [[_remote_node(hasher, timestamp, wire_hash, level - 1) for timestamp, wire_hash in bucket]
+            for bucket in response["children"]]
+
+
+def _leaves_under(owners):
+    """The leaves under the given nodes of one level, left to right, without the tail."""
+    nodes = owners
+    while nodes and nodes[-1].level > 0:
+        nodes = get_non_boundary_nodes(nodes)
+    return [n for n in nodes if not n.is_tail]
+
+
+def _leaf_key(hasher, node):
+    # a leaf's merkel hash is its node hash, and the only hash a RemoteNode has
+    return struct.pack(">q", node.timestamp) + hasher.to_bytes(node.merkel_hash)
+
+
+def _leaf_keys(hasher, leaves):
+    """The leaves by key. Raises struct.error for a timestamp that is not an integer."""
+    return {_leaf_key(hasher, node): node for node in leaves}
+
+
+def _table_of(keys, cells, key_size):
+    table = InvertibleBloomLookupTable(cells, key_size)
+    for key in keys:
+        table.add(key)
+    return table
+
+
+def _fanout(hasher):
+    """The average number of nodes in a bucket."""
+    return 2 ** hasher.boundary_bits if hasher.boundary_bits is not None else 16 / 7
+
+
+class _PrefixCollision(Exception):
+    """Two different merkel hashes had the same prefix."""
+
+
+def _peer_root(tree, only_local, only_remote):
+    """The level and merkel hash of the root of the tree holding the leaves of tree without only_local and with
+    only_remote, which is the peer's root when the differences are right. Boundaries depend only on the hash of each
+    key, so a node whose keys and left neighbour are all unchanged heads the same subtree on the peer, and its merkel
+    hash is reused: only the paths to the differences are hashed again."""
+    hasher = tree.hasher
+    removed = {id(node) for node in only_local}
+    changed = sorted(node.timestamp for node in itertools.chain(only_local, only_remote))
+
+    def unchanged(node):
+        # a node above the leaves holds the keys after its left neighbour up to its own key
+        if node.is_tail or node.level == 0:
+            return False
+        i = bisect_left(changed, node.left.timestamp) if node.left is not None else 0
+        return i == len(changed) or changed[i] > node.timestamp
+
+    def local_nodes():
+        stack = [tree.get_root()]
+        while stack:
+            node = stack.pop()
+            if unchanged(node):
+                yield node
+            elif node.level > 0:
+                stack.extend(reversed(node.bucket_nodes()))
+            elif not node.is_tail and id(node) not in removed:
+                yield node
+
+    buckets = []  # running hasher of the open bucket on each level holding a node besides the tail
+
+    def append(level, node_hash, merkel_hash):
+        while True:
+            # the subtree of a reused node fills every level below it
+            while len(buckets) <= level:
+                buckets.append(hasher.new())
+            hasher.update(buckets[level], merkel_hash)
+            if not hasher.is_boundary(node_hash):
+                return
+            merkel_hash = hasher.finish(buckets[level])
+            buckets[level] = hasher.new()
+            node_hash, level = hasher.promoted_hash(node_hash), level + 1
+
+    # a leaf's merkel hash is its node hash, and the only hash a RemoteNode has
+    for node in heapq.merge(local_nodes(), only_remote, key=lambda node: node.timestamp):
+        append(node.level, node.node_hash if node.level else node.merkel_hash, node.merkel_hash)
+
+    # close every level with the tail, as ProllyTree._build_levels does
+    node_hash = merkel_hash = hasher.leaf_hash("Tail", "Tail", is_tail=True)
+    for bucket in buckets:
+        hasher.update(bucket, merkel_hash)
+        merkel_hash = hasher.finish(bucket)
+        node_hash = hasher.promoted_hash(node_hash)
+    return len(buckets), merkel_hash
+
+
+def _matches_root(tree, remote_root, only_local, only_remote):
+    """Check that the differences found against a peer account for its full root hash."""
+    level, merkel_hash = _peer_root(tree, only_local, only_remote)
+    return level == remote_root.level and merkel_hash == remote_root.merkel_hash
+
+
+class SyncClient:
+    """Reconciles a local tree with a peer reached through a transport. With iblt_max_leaves set the client runs in
+    hybrid mode: it switches to one invertible Bloom lookup table exchange as soon as the mismatching subtrees hold
+    about that many leaves or fewer. With hash_prefix set the peer sends only that many bytes of every merkel hash
+    above the leaves; leaf hashes always come in full."""
+
+    def __init__(self, tree, transport, codec=None, iblt_max_leaves=None, hash_prefix=None):
+        self.tree = tree
+        self.transport = transport
+        self.codec = codec or JsonCodec()
+        self.iblt_max_leaves = iblt_max_leaves
+        self.hash_prefix = hash_prefix
+        self.stats = SyncStats()
+        self.iblt_fell_back = False  # set when the last session's table could not be decoded
+        self.prefix_collided = False  # set when the last session had to start over with full hashes
+
+    def _request(self, message):
+        return self.codec.decode(self.transport.request(self.codec.encode(message)))
+
+    def _fetch_children(self, level, owners, hash_prefix=None):
+        """One round trip for the buckets of all the given remote owners on a level, in the owners' order."""
+        if not owners:
+            return []
+        request = _children_request(level, owners, hash_prefix if level > 1 else None)
+        return _remote_buckets(self.tree.hasher, level, self._request(request))
+
+    def reconcile(self):
+        """Compare with the peer and return (only_local, only_remote): local leaves the peer lacks and RemoteNode leaves the local tree lacks. On an instrumented tree the session is counted as a "sync" operation."""
+        with _measure("sync", self.tree):
+            stats = self.transport.stats
+            before = (stats.round_trips, stats.bytes_sent, stats.bytes_received)
+            hash_prefix = self.hash_prefix
+            if hash_prefix is not None and hash_prefix >= self.tree.hasher.digest_size:
+                hash_prefix = None
+            self.prefix_collided = False
+            try:
+                result = self._reconcile(hash_prefix)
+            except _PrefixCollision:
+                self.prefix_collided = True
+                result = self._reconcile(None)
+            self.stats = SyncStats()
+            self.stats.round_trips = stats.round_trips - before[0]
+            self.stats.bytes_sent = stats.bytes_sent - before[1]
+            self.stats.bytes_received = stats.bytes_received - before[2]
+            return result
+
+    def _reconcile(self, hash_prefix):
+        counters = _counters_of(self.tree)
+        only_local, only_remote = [], []
+
+        remote_root = _remote_root(self.tree.hasher, self._request({"op": "root"}))
+        remote_nodes = [remote_root]
+        local_nodes = _level_ending_at(self.tree.get_root())
+
+        # line the heights up, the taller side compares its whole level
+        while local_nodes[-1].level > remote_nodes[-1].level:
+            local_nodes = get_non_boundary_nodes(local_nodes)
+        while remote_nodes[-1].level > local_nodes[-1].level:
+            remote_nodes = [n for bucket in self._fetch_children(remote_nodes[-1].level, remote_nodes, hash_prefix)
+                            for n in bucket]
+
+        level = local_nodes[-1].level
+        segments = [(local_nodes, remote_nodes)]
+        self.iblt_fell_back = False
+        fanout = _fanout(self.tree.hasher)
+        while segments:
+            if level == 0:
+                for local_nodes, remote_nodes in segments:
+                    for is_local, node in _leaf_differences(local_nodes, remote_nodes):
+                        (only_local if is_local else only_remote).append(node)
+                break
+            groups = []
+            for local_nodes, remote_nodes in segments:
+                segment_groups = _split_mismatches(local_nodes, remote_nodes)
+                if not segment_groups and hash_prefix is not None:
+                    # the owners of this segment differ, so some of their children do unless prefixes collided
+                    raise _PrefixCollision
+                groups.extend(segment_groups)
+            if self.iblt_max_leaves is not None and not self.iblt_fell_back:
+                owners = max(sum(len(local_group) for local_group, _ in groups),
+                             sum(len(remote_group) for _, remote_group in groups))
+                if owners * fanout ** level <= self.iblt_max_leaves:
+                    found = self._reconcile_leaves(level, groups, owners)
+                    if found is not None:
+                        only_local.extend(found[0])
+                        only_remote.extend(found[1])
+                        break
+                    self.iblt_fell_back = True
+            # every mismatching remote owner of the level goes into one request
+            buckets = iter(self._fetch_children(level, [n for _, remote_group in groups for n in remote_group],
+                                                hash_prefix))
+            segments = []
+            for local_group, remote_group in groups:
+                remote_children = [n for _ in remote_group for n in next(buckets)]
+                local_children = get_non_boundary_nodes(local_group)
+                if counters is not None:
+                    counters["bucket_reads"] += len(local_group)
+                    counters["hops"] += len(local_children)
+                segments.append((local_children, remote_children))
+            level -= 1
+
+        only_local.sort(key=lambda node: node.timestamp)
+        only_remote.sort(key=lambda node: node.timestamp)
+        if hash_prefix is not None and not _matches_root(self.tree, remote_root, only_local, only_remote):
+            # a collision that hid a mismatching child or paired nodes up wrongly, which only the full root shows
+            raise _PrefixCollision
+        return only_local, only_remote
+
+    def _reconcile_leaves(self, level, groups, owners):
+        """Find the leaf differences under the mismatching groups of a level with a table exchange. Returns
+        (only_local, only_remote), or None when no table could be decoded."""
+        hasher = self.tree.hasher
+        local_leaves = _leaves_under([n for local_group, _ in groups for n in local_group])
+        remote_owners = [n for _, remote_group in groups for n in remote_group]
+        if not remote_owners:
+            return local_leaves, []
+        try:
+            local_by_key = _leaf_keys(hasher, local_leaves)
+        except struct.error:
+            return None
+
+        cells = IBLT_MIN_CELLS + IBLT_CELLS_PER_OWNER * owners
+        while True:
+            response = self._request(dict(_children_request(level, remote_owners), op="iblt", cells=cells))
+            if response["cells"] is None:
+                return None
+            local_table = _table_of(local_by_key, cells, 8 + hasher.digest_size)
+            remote_table = InvertibleBloomLookupTable.from_wire(response["cells"], len(local_table),
+                                                                local_table.key_size)
+            local_keys, remote_keys, complete = local_table.subtract(remote_table).decode()
+            if complete and all(key in local_by_key for key in local_keys):
+                break
+            # the difference is at least the gap between the leaf counts, which a clustered difference under a few
+            # owners can make much larger than the first table; size one more table for it, then give up
+            needed = IBLT_MIN_CELLS + 2 * abs(response["leaves"] - len(local_leaves))
+            if needed <= cells:
+                return None
+            cells = needed
+
+        only_local = [local_by_key[key] for key in local_keys]
+        only_remote = [RemoteNode(struct.unpack(">q", key[:8])[0], hasher.from_bytes(key[8:]), 0)
+                       for key in remote_keys]
+        # the descent compares leaves by key, so a key both sides hold with other payloads is not a difference
+        shared = {n.timestamp for n in only_local} & {n.timestamp for n in only_remote}
+        return ([n for n in only_local if n.timestamp not in shared],
+                [n for n in only_remote if n.timestamp not in shared])
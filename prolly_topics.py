@@ -0,0 +1,318 @@
+import hashlib
+import sys
+from collections import OrderedDict
+
+from prolly_tree import (ProllyTree, Message, DEFAULT_HASHER, reconcile_prolly_trees, get_non_boundary_nodes,
+                         _split_mismatches, _leaf_differences, _level_ending_at)
+from prolly_forest import _changed_keys
+from prolly_sync import (SyncServer, SyncStats, JsonCodec, _PrefixCollision, _matches_root, _remote_root,
+                         _remote_buckets, _children_request)
+
+# Waku nodes carry many content topics. TopicTrees keeps one ProllyTree per topic plus a small top tree with one
+# leaf per topic, keyed by a 63-bit hash of the topic name, whose payload is the name and the merkel hash of the
+# topic's root. Its root stands for every topic at once, like the top tree of a forest does for epochs.
+#
+# A sync session covers all topics in the same round trips:
+#   {"op": "topic_roots"}
+#       -> {"root": "<hex>", "roots": [[topic, level, "<hex>"], ...]}
+#   {"op": "topic_children", "requests": [[topic, level, [ts...], hash_prefix], ...]}
+#       -> {"children": [[[[ts, "<hex>"], ...], ...], ...]}
+# Equal combined roots end the session after the first round trip. Otherwise only topics whose roots differ are
+# descended into, each as in SyncClient, and the requests of every topic still descending go out together, so a
+# session takes as many round trips as the tallest differing topic instead of their sum. The server keeps the
+# buckets it sends in a cache shared by all topics and sessions, keyed by the merkel hash of their owner, so hot
+# buckets near the roots and subtrees that two topics share are encoded once.
+
+
+def topic_key(topic):
+    """The key of a topic in the top tree."""
+    return int.from_bytes(hashlib.sha256(topic.encode()).digest()[:8], "big") >> 1
+
+
+class BucketCache:
+    """An LRU cache of encoded buckets keyed by the merkel hash of their owner, limited to about max_bytes."""
+
+    def __init__(self, max_bytes=8 << 20):
+        self.max_bytes = max_bytes
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()  # key -> (entries, size), least recently used first
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, key):
+        cached = self._cache.get(key)
+        if cached is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._cache.move_to_end(key)
+        return cached[0]
+
+    def put(self, key, entries):
+        # what the entries take in memory: the list, and an entry list, a timestamp and a hex string per entry
+        size = sys.getsizeof(entries) + sum(sys.getsizeof(entry) + sum(map(sys.getsizeof, entry)) for entry in entries)
+        if key in self._cache:
+            self.cached_bytes -= self._cache.pop(key)[1]
+        self._cache[key] = (entries, size)
+        self.cached_bytes += size
+        while self.cached_bytes > self.max_bytes and len(self._cache) > 1:
+            _, (_, evicted) = self._cache.popitem(last=False)
+            self.cached_bytes -= evicted
+
+
+class TopicTrees:
+    """One ProllyTree per content topic behind one API, with a combined root over the topic roots."""
+
+    def __init__(self, hasher=DEFAULT_HASHER, boundary_bits=None, cache_bytes=8 << 20):
+        if boundary_bits is not None:
+            hasher = hasher.with_boundary_bits(boundary_bits)
+        self.hasher = hasher
+        self.trees = {}  # topic -> ProllyTree
+        self.top = ProllyTree(hasher=hasher)  # one leaf per topic, keyed by topic_key
+        self.cache = BucketCache(cache_bytes)
+        self._topics_by_key = {}
+        self._stale_topics = set()  # topics whose leaf in the top tree is out of date
+
+    def topics(self):
+        return sorted(self.trees)
+
+    def tree(self, topic):
+        """The tree of a topic, None if it holds no message."""
+        return self.trees.get(topic)
+
+    def _tree_for_insert(self, topic):
+        tree = self.trees.get(topic)
+        if tree is None:
+            key = topic_key(topic)
+            if self._topics_by_key.setdefault(key, topic) != topic:
+                raise ValueError(f"topics {topic!r} and {self._topics_by_key[key]!r} have the same key")
+            tree = self.trees[topic] = ProllyTree(hasher=self.hasher)
+        self._stale_topics.add(topic)
+        return tree
+
+    def insert(self, topic, message):
+        return self._tree_for_insert(topic).insert(message)
+
+    def insert_many(self, topic, messages):
+        return self._tree_for_insert(topic).insert_many(messages)
+
+    def search(self, topic, timestamp):
+        tree = self.trees.get(topic)
+        return tree.search(timestamp) if tree is not None else None
+
+    def delete(self, topic, timestamp):
+        tree = self.trees.get(topic)
+        if tree is None:
+            return None
+        node = tree.delete(timestamp)
+        if node is not None:
+            self._stale_topics.add(topic)
+            if tree[0].tail.left is None:
+                del self.trees[topic]
+        return node
+
+    def drop_topic(self, topic):
+        """Drop every message of a topic at once."""
+        if self.trees.pop(topic, None) is not None:
+            self._stale_topics.add(topic)
+
+    def top_tree(self):
+        """The tree over the topic roots, with the leaves of changed topics brought up to date."""
+        hasher = self.hasher
+        for topic in sorted(self._stale_topics):
+            key = topic_key(topic)
+            self.top.delete(key)
+            tree = self.trees.get(topic)
+            if tree is None:
+                del self._topics_by_key[key]
+            else:
+                payload = topic.encode() + b"\0" + hasher.to_bytes(tree.get_root().merkel_hash)
+                self.top.insert(Message(payload, key))
+        self._stale_topics.clear()
+        return self.top
+
+    def get_root(self):
+        return self.top_tree().get_root()
+
+    def reconcile(self, other):
+        """Find {topic: (only_in_self, only_in_other)} for the topics whose trees differ. The top trees are diffed first and only topics whose roots differ are compared."""
+        differences = {}
+        for key in sorted(_changed_keys(self.top_tree(), other.top_tree())):
+            topic = self._topics_by_key.get(key, other._topics_by_key.get(key))
+            tree, other_tree = self.trees.get(topic), other.trees.get(topic)
+            if tree is None:
+                differences[topic] = ([], list(other_tree.range()))
+            elif other_tree is None:
+                differences[topic] = (list(tree.range()), [])
+            else:
+                differences[topic] = reconcile_prolly_trees(tree, other_tree)
+        return differences
+
+
+class TopicSyncServer(SyncServer):
+    """Answers batched sync requests about every topic of a TopicTrees."""
+
+    def __init__(self, topics, codec=None):
+        super().__init__(None, codec)
+        self.topics = topics
+
+    def handle(self, request):
+        op = request["op"]
+        topics = self.topics
+        if op == "topic_roots":
+            roots = []
+            for topic in topics.topics():
+                root = topics.trees[topic].get_root()
+                roots.append([topic, root.level, self._wire_hash(root.merkel_hash)])
+            return {"root": self._wire_hash(topics.get_root().merkel_hash), "roots": roots}
+        if op == "topic_children":
+            return {"children": [[self._topic_children(topic, level, owner, hash_size) for owner in owners]
+                                 for topic, level, owners, hash_size in request["requests"]]}
+        raise ValueError(f"unknown topic sync request {op!r}")
+
+    def _topic_children(self, topic, level, timestamp, hash_size):
+        tree = self.topics.trees.get(topic)
+        if tree is None:
+            return []
+        if timestamp is None:
+            owner = tree.get_root_at_height(tree.get_root().level - level)
+        else:
+            owner = tree.get_intermediate_node(timestamp, level)
+        if owner is None or owner.down is None:
+            return []
+        cache = self.topics.cache
+        entries = cache.get(owner.merkel_hash)
+        if entries is None:
+            entries = [[None if n.is_tail else n.timestamp, self._wire_hash(n.merkel_hash)]
+                       for n in get_non_boundary_nodes([owner])]
+            cache.put(owner.merkel_hash, entries)
+        if hash_size is None:
+            return entries
+        return [[timestamp, wire_hash[:2 * hash_size]] for timestamp, wire_hash in entries]
+
+    def _wire_hash(self, digest, hash_size=None):
+        return self.topics.hasher.to_bytes(digest)[:hash_size].hex()
+
+
+def _topic_descent(tree, remote_root, hash_prefix):
+    """Reconcile one topic as a generator: it yields (level, remote owners) for the buckets it needs, is sent them
+    back and returns (only_local, only_remote). Raises _PrefixCollision like SyncClient, also when the differences
+    found with truncated hashes do not give the topic's full root hash."""
+    only_local, only_remote = [], []
+    remote_nodes = [remote_root]
+    local_nodes = _level_ending_at(tree.get_root())
+    while local_nodes[-1].level > remote_nodes[-1].level:
+        local_nodes = get_non_boundary_nodes(local_nodes)
+    while remote_nodes[-1].level > local_nodes[-1].level:
+        buckets = yield remote_nodes[-1].level, remote_nodes
+        remote_nodes = [n for bucket in buckets for n in bucket]
+
+    level = local_nodes[-1].level
+    segments = [(local_nodes, remote_nodes)]
+    while segments:
+        if level == 0:
+            for local_nodes, remote_nodes in segments:
+                for is_local, node in _leaf_differences(local_nodes, remote_nodes):
+                    (only_local if is_local else only_remote).append(node)
+            break
+        groups = []
+        for local_nodes, remote_nodes in segments:
+            segment_groups = _split_mismatches(local_nodes, remote_nodes)
+            if not segment_groups and hash_prefix is not None:
+                raise _PrefixCollision
+            groups.extend(segment_groups)
+        remote_owners = [n for _, remote_group in groups for n in remote_group]
+        buckets = iter((yield level, remote_owners) if remote_owners else [])
+        segments = [(get_non_boundary_nodes(local_group), [n for _ in remote_group for n in next(buckets)])
+                    for local_group, remote_group in groups]
+        level -= 1
+    only_local.sort(key=lambda node: node.timestamp)
+    only_remote.sort(key=lambda node: node.timestamp)
+    if hash_prefix is not None and not _matches_root(tree, remote_root, only_local, only_remote):
+        raise _PrefixCollision
+    return only_local, only_remote
+
+
+class TopicSyncClient:
+    """Reconciles a TopicTrees with a peer's through a transport, all topics in one session. hash_prefix works as in
+    SyncClient, and a topic whose prefixes collide starts over with full hashes on its own."""
+
+    def __init__(self, topics, transport, codec=None, hash_prefix=None):
+        self.topics = topics
+        self.transport = transport
+        self.codec = codec or JsonCodec()
+        self.hash_prefix = hash_prefix
+        self.stats = SyncStats()
+        self.skipped_topics = 0  # topics of the last session whose roots matched
+
+    def _request(self, message):
+        return self.codec.decode(self.transport.request(self.codec.encode(message)))
+
+    def reconcile(self):
+        """Compare with the peer and return {topic: (only_local, only_remote)} for every topic whose trees differ."""
+        stats = self.transport.stats
+        before = (stats.round_trips, stats.bytes_sent, stats.bytes_received)
+        differences = self._reconcile()
+        self.stats = SyncStats()
+        self.stats.round_trips = stats.round_trips - before[0]
+        self.stats.bytes_sent = stats.bytes_sent - before[1]
+        self.stats.bytes_received = stats.bytes_received - before[2]
+        return differences
+
+    def _reconcile(self):
+        topics = self.topics
+        hasher = topics.hasher
+        hash_prefix = self.hash_prefix
+        if hash_prefix is not None and hash_prefix >= hasher.digest_size:
+            hash_prefix = None
+        response = self._request({"op": "topic_roots"})
+        self.skipped_topics = len(response["roots"])
+        differences = {}
+        if hasher.from_bytes(bytes.fromhex(response["root"])) == topics.get_root().merkel_hash:
+            return differences
+
+        descents = {}  # topic -> (generator, local tree, remote root, hash prefix)
+        pending = {}  # topic -> (level, remote owners) it waits for
+        remote_topics = set()
+
+        def start(topic, tree, remote_root, topic_prefix):
+            descents[topic] = (_topic_descent(tree, remote_root, topic_prefix), tree, remote_root, topic_prefix)
+            advance(topic)
+
+        def advance(topic, buckets=None):
+            descent, tree, remote_root, _ = descents[topic]
+            try:
+                pending[topic] = descent.send(buckets)
+            except StopIteration as finished:
+                if finished.value != ([], []):
+                    differences[topic] = finished.value
+            except _PrefixCollision:
+                start(topic, tree, remote_root, None)
+
+        for topic, level, wire_hash in response["roots"]:
+            remote_topics.add(topic)
+            remote_root = _remote_root(hasher, {"level": level, "merkel_hash": wire_hash})
+            tree = topics.trees.get(topic) or ProllyTree(hasher=hasher)
+            if tree.get_root().merkel_hash == remote_root.merkel_hash:
+                continue
+            self.skipped_topics -= 1
+            start(topic, tree, remote_root, hash_prefix)
+        for topic in topics.topics():
+            if topic not in remote_topics:
+                differences[topic] = (list(topics.trees[topic].range()), [])
+
+        while pending:
+            waiting = list(pending.items())
+            pending.clear()
+            requests = []
+            for topic, (level, owners) in waiting:
+                topic_prefix = descents[topic][3]
+                request = _children_request(level, owners, topic_prefix if level > 1 else None)
+                requests.append([topic, level, request["owners"], request.get("hash_prefix")])
+            response = self._request({"op": "topic_children", "requests": requests})
+            for (topic, (level, _)), buckets in zip(waiting, response["children"]):
+                advance(topic, _remote_buckets(hasher, level, {"children": buckets}))
+        return dict(sorted(differences.items()))
@@ -1,4 +1,6 @@
-import hashlib, time
+import contextlib, functools, hashlib, itertools, os, time, struct, weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import ipdb 
 
 def calculate_hash(hashable_str):
@@ -10,7 +12,12 @@ def calculate_hash(hashable_str):
 
 def is_boundary_hash(
         hash_value,
-        threshold=7):  # modify this function if you want to measure in bits
+        threshold=7,
+        boundary_bits=None):
+    if boundary_bits is not None:
+        # Check if the lowest boundary_bits bits of the hash are all zero, one node in 2 ** boundary_bits on average
+        hash_int = int(hash_value[-((boundary_bits + 3) // 4):], 16)
+        return hash_int & ((1 << boundary_bits) - 1) == 0
     # Check if the last hex word of the hash is below the threshold
     hash_int = int(hash_value[-1:], 16)
     return hash_int < threshold
@@ -21,17 +28,178 @@ def bucket_hash(nodes):
     return calculate_hash("".join([n.merkel_hash for n in nodes]))
 
 
+def encode_payload(data):
+    """Canonical bytes of a message payload: bytes as they are, text as UTF-8 and anything else through str()."""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return bytes(data)
+    if isinstance(data, str):
+        return data.encode()
+    return str(data).encode()
+
+
+class Hasher:
+    """The hashing scheme of a tree: how leaves, promoted nodes and buckets are hashed and which hashes make a boundary.
+
+    The default reproduces the original scheme, SHA-256 over str(data) + str(timestamp) with hex digests, so trees stay comparable with existing peers.
+    With hex_digests=False digests are kept as raw bytes, a leaf hashes the 8-byte big-endian timestamp followed by the canonical payload bytes, and any hashlib algorithm can be used, for example "blake2b" with digest_size=32.
+    boundary_bits sets the target fanout: a node is a boundary when the lowest boundary_bits bits of its hash are zero, so buckets hold 2 ** boundary_bits nodes on average. It must be between 1 and the number of bits of a digest. None keeps the original rule (last hex word below 7, about 2.3 nodes per bucket).
+    """
+
+    def __init__(self, algorithm="sha256", hex_digests=True, digest_size=None, boundary_bits=None):
+        self.algorithm = algorithm
+        self.hex_digests = hex_digests
+        self.boundary_bits = boundary_bits
+        self._digest_size_arg = digest_size
+        constructor = getattr(hashlib, algorithm, None) or functools.partial(hashlib.new, algorithm)
+        if digest_size is None:
+            self.new = constructor
+        else:
+            self.new = functools.partial(constructor, digest_size=digest_size)
+        self.digest_size = self.new().digest_size
+        if boundary_bits is not None and not 1 <= boundary_bits <= 8 * self.digest_size:
+            raise ValueError(f"boundary_bits must be between 1 and {8 * self.digest_size}, got {boundary_bits}")
+
+    def __repr__(self):
+        return (f"Hasher({self.algorithm!r}, hex_digests={self.hex_digests}, digest_size={self.digest_size}, "
+                f"boundary_bits={self.boundary_bits})")
+
+    def __reduce__(self):
+        # rebuilt from its parameters, so a hasher can be sent to worker processes
+        return Hasher, (self.algorithm, self.hex_digests, self._digest_size_arg, self.boundary_bits)
+
+    def copy(self):
+        """A copy of this scheme of the same class, which a tree can change without touching other trees."""
+        hasher = object.__new__(type(self))
+        hasher.__dict__.update(self.__dict__)
+        return hasher
+
+    def with_boundary_bits(self, boundary_bits):
+        """A copy of this scheme with another target fanout."""
+        return Hasher(self.algorithm, self.hex_digests, self._digest_size_arg, boundary_bits)
+
+    def leaf_hash(self, data, timestamp, is_tail=False):
+        """Hash a message stored in a leaf."""
+        if self.hex_digests:
+            return calculate_hash(str(data) + str(timestamp))
+        if is_tail:
+            return self.new(b"Tail").digest()
+        hasher = self.new(struct.pack(">q", timestamp))
+        hasher.update(encode_payload(data))
+        return hasher.digest()
+
+    def promoted_hash(self, node_hash):
+        """Hash of a node promoted to the level above, derived from the hash of the node below it."""
+        if self.hex_digests:
+            return calculate_hash(node_hash)
+        return self.new(node_hash).digest()
+
+    def update(self, hasher, digest):
+        """Feed one digest to an incremental hasher created with new()."""
+        hasher.update(digest.encode() if self.hex_digests else digest)
+
+    def finish(self, hasher):
+        """Get the digest of an incremental hasher in the form the tree stores."""
+        return hasher.hexdigest() if self.hex_digests else hasher.digest()
+
+    def bucket_hash(self, nodes):
+        """Calculate the merkel hash of a bucket by feeding the merkel hashes of its nodes, left to right, to one incremental hasher."""
+        hasher = self.new()
+        for n in nodes:
+            self.update(hasher, n.merkel_hash)
+        return self.finish(hasher)
+
+    def is_boundary(self, node_hash, boundary_bits=None):
+        """Check if a node hash makes a boundary, with this scheme's boundary_bits unless others are given."""
+        if boundary_bits is None:
+            boundary_bits = self.boundary_bits
+        if self.hex_digests:
+            return is_boundary_hash(node_hash, boundary_bits=boundary_bits)
+        if boundary_bits is None:
+            return node_hash[-1] & 0x0F < 7
+        hash_int = int.from_bytes(node_hash[-((boundary_bits + 7) // 8):], "big")
+        return hash_int & ((1 << boundary_bits) - 1) == 0
+
+    def to_bytes(self, digest):
+        """Raw bytes of a digest as stored by the tree."""
+        return bytes.fromhex(digest) if self.hex_digests else digest
+
+    def from_bytes(self, raw):
+        """The stored form of a digest given as raw bytes."""
+        return raw.hex() if self.hex_digests else bytes(raw)
+
+
+# the original SHA-256 scheme with hex digests, the default of every tree
+DEFAULT_HASHER = Hasher()
+
+
+def _hash_leaf_chunk(hasher, pairs):
+    """Hash a chunk of (data, timestamp) pairs and return (node_hash, boundary) for each."""
+    results = []
+    for data, timestamp in pairs:
+        node_hash = hasher.leaf_hash(data, timestamp)
+        results.append((node_hash, hasher.is_boundary(node_hash)))
+    return results
+
+
+class LeafHashPool:
+    """Opt-in parallel hashing of leaves for tree construction and insert_many.
+
+    Messages are cut into chunks of chunk_size and each chunk's leaf hashes and boundary flags are computed by a pool of workers, while the tree keeps consuming earlier chunks in order. Threads only help with payloads of a few KB and more, which hashlib hashes without holding the GIL; processes=True uses worker processes instead, which also helps with small payloads at the price of sending them over. The pool can be reused for many batches; close it, or use it as a context manager, when done.
+    """
+
+    def __init__(self, workers=None, processes=False, chunk_size=4096):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        if processes:
+            self.executor = ProcessPoolExecutor(self.workers)
+        else:
+            self.executor = ThreadPoolExecutor(self.workers)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def hash_leaves(self, messages, hasher=DEFAULT_HASHER):
+        """Yield (message, node_hash, boundary) for the messages in their order. At most two chunks per worker are in flight, so a stream of messages is never held in memory at once."""
+        pending = deque()
+        messages = iter(messages)
+        while True:
+            while len(pending) < 2 * self.workers:
+                chunk = list(itertools.islice(messages, self.chunk_size))
+                if not chunk:
+                    break
+                pending.append((chunk, self.executor.submit(
+                    _hash_leaf_chunk, hasher, [(m.data, m.timestamp) for m in chunk])))
+            if not pending:
+                return
+            chunk, future = pending.popleft()
+            for m, (node_hash, boundary) in zip(chunk, future.result()):
+                yield m, node_hash, boundary
+
+
 class Node:
-    def __init__(self, data, timestamp, is_tail=False):
+    # slots keep a node free of a per-instance __dict__, which matters with one node per message
+    __slots__ = ("timestamp", "data", "node_hash", "level", "up", "down", "left", "right",
+                 "_merkel_hash", "dirty", "boundary", "is_tail", "hasher")
+
+    def __init__(self, data, timestamp, is_tail=False, hasher=DEFAULT_HASHER, node_hash=None):
         # equivalent to key value, timestamp is key, data is value
         self.timestamp = timestamp
         self.data = data
-        self.node_hash = calculate_hash(str(data) + str(timestamp))
+        self.hasher = hasher
+        # the hash can be handed in when it was already computed, for example for a promoted node
+        self.node_hash = node_hash if node_hash is not None else hasher.leaf_hash(data, timestamp, is_tail)
         self.level = 0
         self.up = None
         self.down = None
         self.left = None
         self.right = None
+        self.dirty = False  # set when the merkel hash is stale and must be recomputed on the next read
         self.merkel_hash = self.node_hash
         self.boundary = None
         # tail is a special node which is the right most of any level
@@ -41,19 +209,29 @@ class Node:
     def create_higher_level_node(self):
         """Create a new node with the same timestamp as the current node and create parent-child relationship between them."""
 
-        n = Node(None, self.timestamp)
-        n.is_tail = self.is_tail
+        n = Node(None, self.timestamp, self.is_tail, self.hasher,
+                 node_hash=self.hasher.promoted_hash(self.node_hash))
         n.level = self.level + 1
         n.down = self
         self.up = n
-        n.node_hash = calculate_hash(self.node_hash)
         return n
 
     def __repr__(self):
         return f"Node({self.data}, {self.timestamp})"
 
-    def fill_merkel_hash(self):
-        """Fill the merkel hash of the node by going down walking left till you hit the boundary."""
+    @property
+    def merkel_hash(self):
+        if self.dirty:
+            self._refresh_merkel_hash()
+        return self._merkel_hash
+
+    @merkel_hash.setter
+    def merkel_hash(self, value):
+        self._merkel_hash = value
+        self.dirty = False
+
+    def bucket_nodes(self):
+        """Get the bucket of the node: the nodes on the level below from the previous boundary (exclusive) up to self.down, left to right."""
         # go down and traverse left till you hit the boundary
         node = self.down
         bucket_nodes = [node]
@@ -63,20 +241,32 @@ class Node:
                 break
             node = node.left
             bucket_nodes.append(node)
-        
-        for node in bucket_nodes:
-            if node.merkel_hash is None:
-                node.fill_merkel_hash()
 
         bucket_nodes.reverse()
-        self.merkel_hash = bucket_hash(bucket_nodes)
+        return bucket_nodes
+
+    def fill_merkel_hash(self):
+        """Fill the merkel hash of the node by going down walking left till you hit the boundary."""
+        self.merkel_hash = self.hasher.bucket_hash(self.bucket_nodes())
         return self
 
+    def _refresh_merkel_hash(self):
+        """Recompute the stale merkel hash of the node, first recomputing the stale hashes below it. Uses an explicit stack instead of recursion, so each stale bucket is hashed exactly once."""
+        stack = [(self, self.bucket_nodes())]
+        while stack:
+            node, bucket_nodes = stack[-1]
+            stale = [n for n in bucket_nodes if n.dirty]
+            if stale:
+                stack.extend((n, n.bucket_nodes()) for n in stale)
+                continue
+            stack.pop()
+            node.merkel_hash = node.hasher.bucket_hash(bucket_nodes)
+
     def is_boundary_node(self):
-        """Check if the node is a boundary node. If the node is a tail node, it is a boundary node. If the node is not a tail node, check if the hash of the node is a boundary hash. Cache the result for future use."""
+        """Check if the node is a boundary node. If the node is a tail node, it is a boundary node. If the node is not a tail node, check if the hash of the node is a boundary hash under the tree's boundary_bits. Cache the result for future use."""
         if self.boundary is not None:
             return self.boundary
-        self.boundary = self.is_tail or is_boundary_hash(self.node_hash)
+        self.boundary = self.is_tail or self.hasher.is_boundary(self.node_hash)
         return self.boundary
 
     def find_next_boundary_node(self):
@@ -108,6 +298,8 @@ class Node:
 
 
 class Level:
+    __slots__ = ("level", "tail")
+
     def __init__(self, level):
         self.level = level
         self.tail = None
@@ -127,10 +319,10 @@ class Level:
 
     # Static method to create a base level from a list of messages
     @staticmethod
-    def BaseLevel(messages):
+    def BaseLevel(messages, hasher=DEFAULT_HASHER):
         level = Level(0)
-        nodes = [Node(m.data, m.timestamp) for m in messages]
-        fake_tail = Node("Tail", "Tail", is_tail=True)
+        nodes = [Node(m.data, m.timestamp, hasher=hasher) for m in messages]
+        fake_tail = Node("Tail", "Tail", is_tail=True, hasher=hasher)
         nodes.append(fake_tail)
         linked_nodes = Level.link_nodes(nodes)
         level.tail = linked_nodes[-1]
@@ -159,14 +351,156 @@ class Level:
         return nodes
 
 
+def _ensure_sorted(messages):
+    """Pass messages through, raising ValueError as soon as one is out of timestamp order."""
+    previous = None
+    for m in messages:
+        if previous is not None and m.timestamp < previous.timestamp:
+            raise ValueError(
+                f"messages are not sorted by timestamp: {m.timestamp} after {previous.timestamp}")
+        previous = m
+        yield m
+
+
 class ProllyTree:
-    def __init__(self, messages):
+    _stats = None  # the TreeStats of an instrumented tree, see instrument()
+
+    def __init__(self, messages=(), hasher=DEFAULT_HASHER, boundary_bits=None, hash_pool=None, index=False):
         self.levels = []
-        level = Level.BaseLevel(messages)
-        self.levels.append(level)
-        while len(level.to_list()) > 1:
-            level = Level.NextLevel(level)
-            self.levels.append(level)
+        # boundary_bits sets the target fanout; it travels with the hasher so every node of the tree uses it. Each
+        # tree gets its own copy, which instrument() can switch to counting without touching other trees.
+        if boundary_bits is not None:
+            hasher = hasher.with_boundary_bits(boundary_bits)
+        self.hasher = hasher.copy()
+        self._snapshots = weakref.WeakSet()  # live snapshots that must keep the buckets mutations change
+        self._index = None  # timestamp -> leaf, see build_index
+        self._build_levels(self._new_leaves(messages, hash_pool))
+        if index:
+            self.build_index()
+
+    @property
+    def boundary_bits(self):
+        return self.hasher.boundary_bits
+
+    @classmethod
+    def from_sorted_iter(cls, messages, hasher=DEFAULT_HASHER, boundary_bits=None, hash_pool=None, index=False):
+        """Build a tree from an iterable of messages sorted by timestamp in a single streaming pass. Raises ValueError if the messages are not in ascending timestamp order. A LeafHashPool hashes the leaves in parallel."""
+        return cls(_ensure_sorted(messages), hasher, boundary_bits, hash_pool, index)
+
+    def _new_leaves(self, messages, hash_pool=None):
+        """Create the leaf nodes of messages, in order, with their hashes computed inline or by a LeafHashPool."""
+        hasher = self.hasher
+        if hash_pool is None:
+            for m in messages:
+                yield Node(m.data, m.timestamp, hasher=hasher)
+            return
+        for m, node_hash, boundary in hash_pool.hash_leaves(messages, hasher):
+            node = Node(m.data, m.timestamp, hasher=hasher, node_hash=node_hash)
+            node.boundary = boundary
+            yield node
+
+    def _build_levels(self, leaves):
+        """Build every level in one pass over leaf nodes sorted by timestamp. Boundary nodes are promoted as they stream past and a parent gets its merkel hash as soon as its bucket closes, so only the right edge of each level is held while building."""
+        hasher = self.hasher
+        rightmost = []  # last node appended on each level
+        buckets = []  # running hasher of the open bucket on each level
+
+        def append(node, level_index):
+            if level_index == len(self.levels):
+                self.levels.append(Level(level_index))
+                rightmost.append(None)
+                buckets.append(hasher.new())
+            left = rightmost[level_index]
+            if left is not None:
+                left.right = node
+                node.left = left
+            rightmost[level_index] = node
+            hasher.update(buckets[level_index], node.merkel_hash)
+
+        def close_bucket(level_index, parent):
+            parent.merkel_hash = hasher.finish(buckets[level_index])
+            buckets[level_index] = hasher.new()
+
+        for node in leaves:
+            level_index = 0
+            append(node, level_index)
+            while node.is_boundary_node():
+                parent = node.create_higher_level_node()
+                close_bucket(level_index, parent)
+                node, level_index = parent, level_index + 1
+                append(node, level_index)
+
+        # close every level with its tail, stopping at the first level that holds only the tail
+        node = Node("Tail", "Tail", is_tail=True, hasher=hasher)
+        level_index = 0
+        while True:
+            has_other_nodes = level_index < len(self.levels) and rightmost[level_index] is not None
+            node.is_boundary_node()
+            append(node, level_index)
+            self.levels[level_index].tail = node
+            if not has_other_nodes:
+                break
+            parent = node.create_higher_level_node()
+            close_bucket(level_index, parent)
+            node, level_index = parent, level_index + 1
+
+    def build_index(self):
+        """Keep a dict from timestamp to leaf next to the tree, which makes search, `in`, missing and get_intermediate_node O(1) instead of a descent. insert, insert_many, delete and delete_range keep it up to date. It costs one dict entry per message, 30 to 55 bytes depending on how full the dict is, since the keys are the timestamp objects the leaves already hold."""
+        index = {}
+        node = self[0].tail
+        while node.left is not None:
+            node = node.left
+        while not node.is_tail:
+            # with repeated timestamps the rightmost leaf wins, the one search finds
+            index[node.timestamp] = node
+            node = node.right
+        self._index = index
+
+    def drop_index(self):
+        """Free the index and go back to searching from the root."""
+        self._index = None
+
+    def snapshot(self):
+        """Get a read-only Snapshot of the current version of the tree. It stays consistent while the tree changes: a mutation first lets every live snapshot copy the buckets it is about to change. Take it on the thread that mutates the tree; the snapshot itself can then be read from any thread."""
+        from prolly_snapshot import Snapshot
+        return Snapshot(self)
+
+    def _preserve_for_snapshots(self, node):
+        """Let every live snapshot copy the buckets that change when the bucket holding node changes: the bucket itself and those of all the owners above it."""
+        for snapshot in self._snapshots:
+            with snapshot._lock:
+                owner = node
+                while owner is not None:
+                    owner = owner.up if owner.is_boundary_node() else owner.find_next_boundary_node().up
+                    if owner is not None:
+                        snapshot._keep(owner)
+
+    def instrument(self, hook=None):
+        """Start counting the hashes computed, the pointer hops of searches and the buckets read by diffs, in total and per operation, see prolly_stats.py. hook(operation, counts) is called after every operation with what it cost, for example to export the counts to a metrics system. Returns the tree."""
+        from prolly_stats import instrument
+        return instrument(self, hook)
+
+    def uninstrument(self):
+        """Stop counting. The tree goes back to the code paths without counters and stats() keeps what was counted."""
+        from prolly_stats import uninstrument
+        uninstrument(self)
+
+    def stats(self):
+        """Get a snapshot of the counters: {"totals": {...}, "operations": {name: {"calls": n, ...}}}."""
+        if self._stats is None:
+            return {"totals": {}, "operations": {}}
+        return self._stats.snapshot()
+
+    def save(self, path):
+        """Write the tree to path as a compact binary image, see CompactProllyTree.save."""
+        from prolly_compact import CompactProllyTree
+        CompactProllyTree.from_tree(self).save(path)
+
+    @classmethod
+    def load(cls, path, verify=False):
+        """Rebuild a tree from an image written by save() with the stored hashes, so no message is hashed again. With verify=True every stored hash is checked first. For a read-only tree, CompactProllyTree.load maps the image without building any node."""
+        from prolly_compact import CompactProllyTree
+        return CompactProllyTree.load(path, verify).to_tree()
 
     def __iter__(self):
         return iter(self.levels)
@@ -179,10 +513,15 @@ class ProllyTree:
 
     def insert(self, message):
         """Insert a message into the tree. Create a new level if necessary."""
-        new_node = Node(message.data, message.timestamp)
-        right_of_new_node = self._find_node_greater_than(new_node.timestamp)
-        return self._insert_node_at_level(new_node,
-                                         right_of_new_node=right_of_new_node)
+        new_node = Node(message.data, message.timestamp, hasher=self.hasher)
+        right_of_new_node = self._finger_search(new_node.timestamp)
+        if self._snapshots:
+            self._preserve_for_snapshots(right_of_new_node)
+        self._insert_node_at_level(new_node, right_of_new_node=right_of_new_node)
+        self._mark_inserted_node_dirty(new_node)
+        if self._index is not None:
+            self._index[new_node.timestamp] = new_node
+        return new_node
 
     def _insert_node_at_level(self, new_node, level_index=0, right_of_new_node=None):
         """Insert a node at a given level. Create a new level if after insertion, the top level has more than one node."""
@@ -207,18 +546,53 @@ class ProllyTree:
 
         last_level = self[-1]
 
-        if len(last_level.to_list()) > 1:
-            # add one more level
+        if last_level.tail.left is not None:
+            # the top level holds more than the tail, add one more level
             tree = self._add_empty_level()
 
         return new_node
 
+    def insert_many(self, messages, hash_pool=None):
+        """Insert a batch of messages. The batch is sorted, a run of new leaves falling in the same gap is spliced in after a single descent, and every affected merkel hash is recomputed exactly once on the next read. A LeafHashPool hashes the new leaves in parallel."""
+        new_nodes = list(self._new_leaves(sorted(messages, key=lambda m: m.timestamp), hash_pool))
+        right_of_new_node = None
+        for new_node in new_nodes:
+            # stay in the current gap while the new key is still left of its right end
+            if right_of_new_node is None or not right_of_new_node > new_node:
+                right_of_new_node = self._finger_search(new_node.timestamp)
+            if self._snapshots:
+                self._preserve_for_snapshots(right_of_new_node)
+            self._insert_node_at_level(new_node, right_of_new_node=right_of_new_node)
+            self._mark_inserted_node_dirty(new_node)
+        if self._index is not None:
+            self._index.update((n.timestamp, n) for n in new_nodes)
+        return new_nodes
+
+    def _mark_dirty(self, owner):
+        """Mark a bucket owner and its ancestors as having a stale merkel hash. A dirty node always has dirty ancestors, so the walk stops at the first node already marked, which keeps a stream of mutations at O(height) each."""
+        while owner is not None and not owner.dirty:
+            owner.dirty = True
+            owner = owner.up if owner.is_boundary_node() else owner.find_next_boundary_node().up
+
+    def _mark_inserted_node_dirty(self, new_node):
+        """Mark the buckets changed by inserting a leaf and its promoted copies."""
+        node = new_node
+        while node is not None:
+            # the bucket right of the node changed, and a promoted node owns a brand new bucket
+            self._mark_dirty(node.find_next_boundary_node().up)
+            node = node.up
+            self._mark_dirty(node)
+
     def delete(self, timestamp):
         original_node = self.search(timestamp)
         node = original_node
         if original_node is None:
             return None
         right_boundary_node = original_node.find_next_boundary_node()
+        if self._snapshots:
+            # the promoted copies of the node lose their buckets to the nodes right of them
+            self._preserve_for_snapshots(original_node)
+            self._preserve_for_snapshots(right_boundary_node)
 
         while node is not None:
             left_node = node.left
@@ -228,84 +602,241 @@ class ProllyTree:
                 left_node.right = right_node
             node = node.up
 
-        # now clean up empty levels
-        levels_to_remove = []
-        for i in range(len(self) - 1, 1, -1):
-            current_level = self[i]
-            level_below = self[i - 1]
-            if level_below.tail.left is None:  # only has tail node
-                levels_to_remove.append(i)
+        self._trim_levels()
+        self._mark_dirty(right_boundary_node.up)
+        if self._index is not None:
+            left = original_node.left
+            if left is not None and left.timestamp == timestamp:
+                self._index[timestamp] = left
+            else:
+                del self._index[timestamp]
 
-        for level_index in levels_to_remove:
-            self.levels.pop(level_index)
+        return original_node
 
-        self._update_propagate_merkel_hash(right_boundary_node.up)
+    def delete_range(self, start=None, end=None):
+        """Delete every message with start <= timestamp < end, a bound left as None being open, and return how many were deleted. The run of deleted nodes is cut out of each level with one splice, and only the buckets at the right edge of the cut and the owners above them get their merkel hash recomputed, once, on the next read."""
+        if start is not None and end is not None and start >= end:
+            # an empty range, and the walk below would run off the tail looking for end
+            return 0
+        firsts = self._first_nodes_at_or_after(start)
+        ends = self._first_nodes_at_or_after(end) if end is not None else [level.tail for level in self]
+        if firsts[0] is ends[0]:
+            return 0
+        if self._snapshots:
+            # the first cut node of a level may own a bucket that starts left of the cut, the rest own cut nodes only
+            self._preserve_for_snapshots(ends[0])
+            for first, end_node in zip(firsts[1:], ends[1:]):
+                if first is end_node:
+                    break
+                self._preserve_for_snapshots(first.down)
+
+        deleted = []
+        node = firsts[0]
+        while node is not ends[0]:
+            deleted.append(node.timestamp)
+            node = node.right
+        for first, end_node in zip(firsts, ends):
+            if first is end_node:
+                # nothing was promoted from the cut to this level, so nothing above either
+                break
+            left = first.left
+            end_node.left = left
+            if left is not None:
+                left.right = end_node
+
+        self._trim_levels()
+        if len(self) > 1:
+            # the bucket right of the cut on each level took in what was left of the cut buckets
+            self._mark_dirty(ends[1])
+        if self._index is not None:
+            # only once the nodes are out of the tree, so the index never misses a node the tree still holds
+            for timestamp in deleted:
+                self._index.pop(timestamp, None)
+        return len(deleted)
+
+    def delete_older_than(self, timestamp):
+        """Delete every message older than timestamp and return how many were deleted, see delete_range."""
+        return self.delete_range(None, timestamp)
+
+    def _first_nodes_at_or_after(self, timestamp):
+        """Find on every level the node with the smallest timestamp greater than or equal to timestamp, the leftmost one for None, in one descent. Returns them indexed by level."""
+        nodes = [None] * len(self)
+        node = self.get_root()
+        while True:
+            node = self._left_while_at_or_after(node, timestamp)
+            nodes[node.level] = node
+            if node.down is None:
+                return nodes
+            node = node.down
 
-        return original_node
+    def _trim_levels(self):
+        """Remove the levels above the first one that holds only its tail, as a fresh build would have them."""
+        while len(self) > 1 and self[-2].tail.left is None:
+            self.levels.pop()
+        self[-1].tail.up = None
 
     def search(self, timestamp):
+        if self._index is not None:
+            return self._index.get(timestamp)
         right_node = self._find_node_greater_than(timestamp)
 
         if right_node.left and right_node.left.timestamp == timestamp:
             return right_node.left
         else:
             return None
-    
+
+    def __contains__(self, timestamp):
+        return self.search(timestamp) is not None
+
+    def missing(self, messages):
+        """Get the messages of a batch whose timestamps the tree does not hold, in the order of the batch, for example to drop what a sync peer sent twice before inserting the rest."""
+        if self._index is not None:
+            index = self._index
+            return [m for m in messages if m.timestamp not in index]
+        return [m for m in messages if self.search(m.timestamp) is None]
+
+    def range(self, start=None, end=None):
+        """Lazily yield the leaves with start <= timestamp < end, left to right. A bound left as None is open. Seeks the first leaf with one descent and then walks right pointers."""
+        if start is None:
+            node = self.get_root()
+            while node.down is not None:
+                node = node.down
+                while node.left is not None:
+                    node = node.left
+        else:
+            node = self._find_node_at_level(start, 0)
+        return self._leaves_from(node, end)
+
+    def range_page(self, start=None, end=None, limit=100, cursor=None):
+        """Get one page of at most limit leaves of range(start, end) and the cursor of the next page, None after the last page. Pass the cursor back to continue right after the last leaf of the previous page."""
+        if cursor is None:
+            leaves = self.range(start, end)
+        elif self._index is not None and cursor in self._index:
+            leaves = self._leaves_from(self._index[cursor].right, end)
+        else:
+            leaves = self._leaves_from(self._find_node_greater_than(cursor), end)
+        page = []
+        for node in leaves:
+            if len(page) == limit:
+                return page, page[-1].timestamp
+            page.append(node)
+        return page, None
+
+    @staticmethod
+    def _leaves_from(node, end):
+        while not node.is_tail and (end is None or node.timestamp < end):
+            yield node
+            node = node.right
+
+    def range_fingerprint(self, start=None, end=None):
+        """Get a hash of the leaves with start <= timestamp < end. It combines the merkel hashes of the largest subtrees lying fully inside the window with the leaves at its two edges, so it reads O(height) buckets, and two trees with the same hashing scheme get the same fingerprint exactly when they hold the same messages in the window."""
+        hasher = self.hasher
+        fingerprint = hasher.new()
+        for node in self._range_cover(start, end):
+            hasher.update(fingerprint, node.merkel_hash)
+        return hasher.finish(fingerprint)
+
+    def _range_cover(self, start, end):
+        """Get the largest nodes whose subtrees lie fully inside the window, left to right. A node above level 0 spans the keys after its left neighbour up to its own key, so it is inside when its left neighbour and itself are. Which nodes these are depends only on the keys inside the window."""
+
+        def inside(timestamp):
+            return (start is None or timestamp >= start) and (end is None or timestamp < end)
+
+        def covered(node):
+            if node.is_tail:
+                return False
+            if node.level == 0:
+                return inside(node.timestamp)
+            return node.left is not None and inside(node.left.timestamp) and inside(node.timestamp)
+
+        def reaches_window(node):
+            # the node spans keys after its left neighbour up to its own key, the tail spans up to infinity
+            return ((node.is_tail or start is None or node.timestamp >= start)
+                    and (node.left is None or end is None or node.left.timestamp < end))
+
+        cover = []
+        stack = [self.get_root()]
+        while stack:
+            node = stack.pop()
+            if covered(node):
+                cover.append(node)
+            elif node.level > 0:
+                # later siblings go on the stack first so the cover comes out left to right
+                stack.extend(child for child in reversed(node.bucket_nodes()) if reaches_window(child))
+        return cover
+
     # function to get an intermediate node using a key and a level
     def get_intermediate_node(self, timestamp, level):
         """
-        get the node at a particular level using a key without using find_node_greater_than method
+        get the node at a particular level using a key, or None if the key was not promoted that far
         """
-        # get the root of the tree
-        root = self.get_root()
-        # initialize the node to be returned to be the root
-        node = root
-        # write a traversal method that not just goes down straight but also when comes down the level goes left first till the appropriate node is found to go down
-
-        # get to the level of the node
-        while node.level > level:
-            # go the node which is just bigger than the key/timestamp
-            if node.left and node.left.timestamp > timestamp:
-                node = node.left
-            node = node.down
-        # get to the node at the level and with the key
-        while node.timestamp != timestamp:
-            node = node.left
+        if self._index is not None:
+            # jump to the leaf and climb its promoted copies
+            node = self._index.get(timestamp)
+            while node is not None and node.level < level:
+                node = node.up
+            return node
+        node = self._find_node_at_level(timestamp, level)
+        if node.is_tail or node.timestamp != timestamp:
+            return None
         return node
 
+    def _find_node_at_level(self, timestamp, level):
+        """Find the node of the given level with the smallest timestamp that is greater than or equal to the given timestamp, the tail if there is none."""
+        node = self.get_root()
+        # on every level walk left while the key is still covered, then go down
+        while True:
+            node = self._left_while_at_or_after(node, timestamp)
+            if node.level == level:
+                return node
+            node = node.down
+
     def __repr__(self):
         return "\n".join([str(l) for l in self.levels])
 
     def _find_node_greater_than(self, timestamp):
         """Find the node with the smallest timestamp that is greater than the given timestamp."""
-        node_to_find = Node(None, timestamp)
-        node = self[-1].tail  # root
-
         # get to the level 0 right boundary node of subjected timestamp
+        node = self._descend_while_greater(self[-1].tail, timestamp)
+
+        # start moving left until the left element is timestamp or lower than timestamp
+        return self._left_while_greater(node, timestamp)
+
+    def _finger_search(self, timestamp):
+        """Find the same node as _find_node_greater_than, starting from the right edge instead of the root. The tail of every level is a finger on its rightmost node: climb the tails while that node is still greater than timestamp, then descend from the tail reached. An append stops on level 0 at once, and a key d leaves from the right edge climbs O(log d) levels."""
+        node = self._climb_while_greater(self[0].tail, timestamp)
+        node = self._descend_while_greater(node, timestamp)
+        return self._left_while_greater(node, timestamp)
+
+    # The pointer steps the searches are made of. A left neighbour is never the tail, so plain timestamps can be
+    # compared. An instrumented tree counts the steps, see prolly_stats.py.
+
+    def _climb_while_greater(self, node, timestamp):
+        """Climb from a tail while the rightmost node of its level is still greater than timestamp."""
+        while node.up is not None and node.left is not None and node.left.timestamp > timestamp:
+            node = node.up
+        return node
+
+    def _descend_while_greater(self, node, timestamp):
+        """Go down to level 0, first stepping left on each level while the left neighbour is greater than timestamp."""
         while node.down is not None:
-            if node.left and node.left > node_to_find:
+            if node.left is not None and node.left.timestamp > timestamp:
                 node = node.left
             else:
                 node = node.down
+        return node
 
-        # start moving left until the left element is timestamp or lower than timestamp
-        while node.left and node.left > node_to_find:
+    def _left_while_greater(self, node, timestamp):
+        """Walk left while the left neighbour is greater than timestamp."""
+        while node.left is not None and node.left.timestamp > timestamp:
             node = node.left
-
         return node
 
-    def _update_propagate_merkel_hash(self, node):
-        """Update the merkel hash of the node and propage it up."""
-        node.fill_merkel_hash()
-        # Then update your parent if you have one
-        if node.up is None:
-            # find next boundary node
-            if node.is_tail:
-                return True
-            next_boundary_node = node.find_next_boundary_node()
-            return self._update_propagate_merkel_hash(next_boundary_node.up)
-        else:
-            return self._update_propagate_merkel_hash(node.up)
+    def _left_while_at_or_after(self, node, timestamp):
+        """Walk left while the left neighbour is greater than or equal to timestamp, to the leftmost node for None."""
+        while node.left is not None and (timestamp is None or node.left.timestamp >= timestamp):
+            node = node.left
+        return node
 
     def _add_empty_level(self):
         level_index = len(self)
@@ -313,6 +844,7 @@ class ProllyTree:
         self.levels.append(new_level)
         upgraded_tail = self[level_index - 1].tail.create_higher_level_node()
         new_level.tail = upgraded_tail
+        self._mark_dirty(upgraded_tail)
         return self
     
     def get_root(self):
@@ -346,100 +878,196 @@ class Message:
 # get the nodes that are not boundary nodes starting from a particular boundary node at level just below it
 def get_non_boundary_nodes(list_of_nodes):
     """
-    get all the nodes that are not boundary nodes starting from the first node itself
+    get the buckets of the given nodes from the level just below, in the order of the nodes and left to right within a bucket
     """
     non_boundary_nodes = []
     for node in list_of_nodes:
-        if node.down is None:
-            continue
-        counter_node = node.down
-        non_boundary_nodes.append(counter_node)
-        counter_node= counter_node.left
-
-        while counter_node is not None:
-            if counter_node.boundary:
-                break
-            non_boundary_nodes.insert(0,counter_node)
-            counter_node = counter_node.left
+        if node.down is not None:
+            non_boundary_nodes.extend(node.bucket_nodes())
     return non_boundary_nodes
 
 # get the nodes that are not boundary nodes at level 0
 def get_non_boundary_nodes_for_level_0(list_of_nodes):
     """
-    get all the nodes that are not boundary nodes starting from the first node itself
+    get the level 0 buckets that end at the level 0 copies of the given nodes, left to right
     """
     non_boundary_nodes = []
     for node in list_of_nodes:
         while node.down is not None:
             node = node.down
-        counter_node = node
-        non_boundary_nodes.append(counter_node)
-        counter_node= counter_node.left
-
-        while counter_node is not None:
-            if counter_node.boundary:
-                break
-            non_boundary_nodes.insert(0,counter_node)
-            counter_node = counter_node.left
+        non_boundary_nodes.extend(_bucket_of(node))
     return non_boundary_nodes
 
-# this function is called from the node that wants to Sync with peer node
-def find_diff_between_2_prolly_trees(root1,root2):
+
+def _bucket_of(last_node):
+    """The bucket ending at last_node on its own level: the nodes after the previous boundary up to last_node, left to right."""
+    bucket = [last_node]
+    node = last_node.left
+    while node is not None and not node.is_boundary_node():
+        bucket.append(node)
+        node = node.left
+    bucket.reverse()
+    return bucket
+
+
+def _level_ending_at(node):
+    """All the nodes of a level from the leftmost one up to node, left to right."""
+    nodes = []
+    while node is not None:
+        nodes.append(node)
+        node = node.left
+    nodes.reverse()
+    return nodes
+
+
+def _as_root(tree_or_node):
+    return tree_or_node.get_root() if hasattr(tree_or_node, "get_root") else tree_or_node
+
+
+def _stats_of(tree_or_node):
+    """The TreeStats of an instrumented tree, found from the tree itself or from any of its nodes through the hasher
+    they share, None for anything else."""
+    stats = getattr(tree_or_node, "_stats", None)
+    if stats is None:
+        stats = getattr(getattr(tree_or_node, "hasher", None), "stats", None)
+    return stats if stats is not None and stats.enabled else None
+
+
+def _counters_of(tree_or_node):
+    """The counters of an instrumented tree or of a node of one, None for anything else."""
+    stats = _stats_of(tree_or_node)
+    return stats.counters if stats is not None else None
+
+
+def _measure(operation, *trees_or_nodes):
+    """Count what a block costs as one operation of every instrumented tree among the given trees or nodes, see
+    TreeStats.operation."""
+    stack = contextlib.ExitStack()
+    measured = []
+    for tree_or_node in trees_or_nodes:
+        stats = _stats_of(tree_or_node)
+        if stats is not None and all(stats is not other for other in measured):
+            measured.append(stats)
+            stack.enter_context(stats.operation(operation))
+    return stack
+
+
+def _key(node):
+    # the tail sorts after every timestamp
+    return (1, 0) if node.is_tail else (0, node.timestamp)
+
+
+def _split_mismatches(local_nodes, remote_nodes):
     """
-    we need to find what all keys are there in root2 that are not in root1
+    merge two sorted runs of nodes from the same level of two trees and cut them into the groups that still differ.
+    A key both sides hold is a boundary on every level below in both trees, so it closes a group: the children of
+    one group can be compared without looking at any other group. Keys held by both sides with the same merkel hash
+    have identical subtrees and are dropped.
     """
- 
-    missing_keys =[]
+    groups = []
+    local_group, remote_group = [], []
+    i, j = 0, 0
+    while i < len(local_nodes) or j < len(remote_nodes):
+        if j == len(remote_nodes) or (i < len(local_nodes) and _key(local_nodes[i]) < _key(remote_nodes[j])):
+            local_group.append(local_nodes[i])
+            i += 1
+        elif i == len(local_nodes) or _key(remote_nodes[j]) < _key(local_nodes[i]):
+            remote_group.append(remote_nodes[j])
+            j += 1
+        else:
+            if local_nodes[i].merkel_hash != remote_nodes[j].merkel_hash:
+                local_group.append(local_nodes[i])
+                remote_group.append(remote_nodes[j])
+            if local_group or remote_group:
+                groups.append((local_group, remote_group))
+                local_group, remote_group = [], []
+            i += 1
+            j += 1
+    if local_group or remote_group:
+        groups.append((local_group, remote_group))
+    return groups
+
+
+def _leaf_differences(local_nodes, remote_nodes):
+    """merge two sorted runs of leaves and yield (True, node) for keys only the local side holds and (False, node) for keys only the remote side holds"""
+    i, j = 0, 0
+    while i < len(local_nodes) or j < len(remote_nodes):
+        if j == len(remote_nodes) or (i < len(local_nodes) and _key(local_nodes[i]) < _key(remote_nodes[j])):
+            if not local_nodes[i].is_tail:
+                yield True, local_nodes[i]
+            i += 1
+        elif i == len(local_nodes) or _key(remote_nodes[j]) < _key(local_nodes[i]):
+            if not remote_nodes[j].is_tail:
+                yield False, remote_nodes[j]
+            j += 1
+        else:
+            i += 1
+            j += 1
 
-    node_list1 = [root1]
-    node_list2 = [root2]
 
-    # function to check diff at each level
-    def check_diff_at_each_level(node_list1,node_list2, level):
-        if level < 0:
-            return
+def _align_heights(local_nodes, remote_nodes):
+    """step the taller side down until both runs are on the same level; the shorter root covers its whole tree, so the taller side compares its whole level"""
+    while local_nodes[-1].level > remote_nodes[-1].level:
+        local_nodes = get_non_boundary_nodes(local_nodes)
+    while remote_nodes[-1].level > local_nodes[-1].level:
+        remote_nodes = get_non_boundary_nodes(remote_nodes)
+    return local_nodes, remote_nodes
 
-        next_level_keys_to_fetch_node1 = []
-        next_level_keys_to_fetch_node2 = []
-        level_ptr1, level_ptr2 = node_list1[-1], node_list2[-1]
-        # check if at a particular level the keys/merkel_hash are same or not
-        while level_ptr1 and level_ptr2 :
-            # if timestamps match then only check for merkel hash and if they do not match then add them to missing keys
-            if level_ptr1.timestamp == level_ptr2.timestamp:
-                # mismatch in merkel hash so add it to missing keys
-                if level_ptr1.merkel_hash != level_ptr2.merkel_hash:
-                    # insert at first position always
-                    next_level_keys_to_fetch_node1.insert(0,level_ptr1)
-                    next_level_keys_to_fetch_node2.insert(0,level_ptr2)
-                # advance the pointers
-                level_ptr1 = level_ptr1.left
-                level_ptr2 = level_ptr2.left
-            # tree 1 has no such key so add it to missing keys
-            elif level_ptr1.timestamp < level_ptr2.timestamp:
-                # do not let non level 0 nodes to be part of the misisng keys
-                if level_ptr2.level ==0:
-                    missing_keys.append(level_ptr2)
-                next_level_keys_to_fetch_node2.insert(0,level_ptr2)
-                # move the pointer of tree2 may be the next key is present in tree1
-                level_ptr2 = level_ptr2.left
-            # tree1 has extra keys than tree2, skip the tree1 key and see if next one matches
-            else:
-                level_ptr1 = level_ptr1.left
 
-        # get the corresponding keys where the merkel hash did not match from local Prolly tree
-        node_list1 = get_non_boundary_nodes(next_level_keys_to_fetch_node1)
-        # remote node is being called to send the keys/nodes where merkel_hash doesn't match
-        node_list2 = get_non_boundary_nodes(next_level_keys_to_fetch_node2)
+def iter_reconcile_prolly_trees(root1, root2):
+    """
+    walk both trees level by level, descending only into groups whose merkel hashes differ, and yield (True, leaf) for
+    leaves only tree 1 holds and (False, leaf) for leaves only tree 2 holds. A root may be any node: it stands for its
+    whole level from the leftmost node up to it.
+    """
+    counters1, counters2 = _counters_of(root1), _counters_of(root2)
+    local_nodes, remote_nodes = _align_heights(_level_ending_at(_as_root(root1)), _level_ending_at(_as_root(root2)))
+    pending = deque([(local_nodes[-1].level, local_nodes, remote_nodes)])
+    while pending:
+        level, local_nodes, remote_nodes = pending.popleft()
+        if level == 0:
+            yield from _leaf_differences(local_nodes, remote_nodes)
+            continue
+        for local_group, remote_group in _split_mismatches(local_nodes, remote_nodes):
+            local_children = get_non_boundary_nodes(local_group)
+            remote_children = get_non_boundary_nodes(remote_group)
+            # reading a bucket walks one pointer per node, counted on the tree it belongs to
+            if counters1 is not None:
+                counters1["bucket_reads"] += len(local_group)
+                counters1["hops"] += len(local_children)
+            if counters2 is not None:
+                counters2["bucket_reads"] += len(remote_group)
+                counters2["hops"] += len(remote_children)
+            pending.append((level - 1, local_children, remote_children))
+
+
+def iter_diff_between_2_prolly_trees(root1, root2):
+    """
+    yield the leaves of tree 2 whose keys are not in tree 1 as soon as they are found. Roots of different heights are
+    fine, and a ProllyTree can be passed instead of its root.
+    """
+    for only_in_tree1, node in iter_reconcile_prolly_trees(root1, root2):
+        if not only_in_tree1:
+            yield node
 
-        # meaning that all nodes match the hashes at this level so no further check required
-        if len(node_list1) == 0 and len(node_list2) ==0:
-            return missing_keys
-        elif len(node_list1) == 0:
-            res = get_non_boundary_nodes_for_level_0(node_list2)
-            [missing_keys.append(node) for node in res]
-            return missing_keys
 
-        check_diff_at_each_level(node_list1, node_list2, level-1)
+# this function is called from the node that wants to Sync with peer node
+def find_diff_between_2_prolly_trees(root1,root2):
+    """
+    we need to find what all keys are there in root2 that are not in root1
+    """
+    with _measure("diff", root1, root2):
+        return list(iter_diff_between_2_prolly_trees(root1, root2))
 
-    check_diff_at_each_level(node_list1, node_list2, root1.level)
-    return missing_keys
\ No newline at end of file
+
+def reconcile_prolly_trees(root1, root2):
+    """
+    find both directions of the difference in one descent: the leaves only tree 1 holds and the leaves only tree 2
+    holds, as (only_in_tree1, only_in_tree2). Both share the per-level hash comparisons, so one session gives
+    everything a two-way sync needs.
+    """
+    only_in_tree1, only_in_tree2 = [], []
+    with _measure("reconcile", root1, root2):
+        for in_tree1, node in iter_reconcile_prolly_trees(root1, root2):
+            (only_in_tree1 if in_tree1 else only_in_tree2).append(node)
+    return only_in_tree1, only_in_tree2
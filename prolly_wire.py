@@ -0,0 +1,207 @@
+from prolly_sync import JsonCodec
+
+# A binary encoding of sync messages, for links where bytes count.
+#
+# The messages that grow with the tree are the children requests and responses: runs of (timestamp, merkel hash)
+# pairs as get_non_boundary_nodes returns them, sorted by timestamp. A run stores every timestamp as the zigzag
+# varint of its difference from the previous one, so close timestamps take one or two bytes, and every hash as its
+# raw bytes instead of hex. A response carries hashes of one size, the full digest or the prefix the client asked
+# for with "hash_prefix". The tail has no timestamp and is always the last node of its bucket, so a bucket header
+# holds the node count and a tail flag, and the tail's hash follows without a timestamp.
+#
+#   children request:   b"O" id+1 level hash_prefix run_header timestamps...
+#   children response:  b"C" id+1 hash_size bucket_count (run_header (timestamp hash | hash)...)...
+#   anything else:      b"J" JSON
+#
+# where every number is an unsigned LEB128 varint, id+1 is 0 for a message without an id, and a run header is
+# count << 1 | ends_with_tail. A message with a key the binary form does not know, or with timestamps that are not
+# integers, goes as JSON. Decoding reads the varints and hashes straight from a memoryview of the payload.
+
+CHILDREN_REQUEST = ord("O")
+CHILDREN_RESPONSE = ord("C")
+JSON = ord("J")
+
+_REQUEST_KEYS = {"op", "level", "owners", "hash_prefix", "id"}
+_RESPONSE_KEYS = {"children", "id"}
+
+
+class WireWriter:
+    """Appends varints and runs to a growing bytearray."""
+    __slots__ = ("out",)
+
+    def __init__(self, out=None):
+        self.out = bytearray() if out is None else out
+
+    def varint(self, value):
+        out = self.out
+        while value > 0x7F:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+
+    def run(self, entries, hash_size=None, previous=0):
+        """Write a run of (timestamp, digest) pairs, or bare timestamps when hash_size is None, with None as the
+        timestamp of a trailing tail. Digests are raw bytes or hex strings of exactly hash_size bytes. Returns the
+        last timestamp, the base of the next run's first difference. Raises TypeError for a timestamp that is not an
+        integer and ValueError for a digest of another size."""
+        out = self.out
+        count = len(entries)
+        tail = count > 0 and (entries[-1] if hash_size is None else entries[-1][0]) is None
+        self.varint(count << 1 | tail)
+        for index, entry in enumerate(entries):
+            timestamp = entry if hash_size is None else entry[0]
+            if timestamp is not None or index < count - 1:
+                if type(timestamp) is not int:
+                    raise TypeError(f"cannot encode the timestamp {timestamp!r}")
+                delta = timestamp - previous
+                value = delta << 1 if delta >= 0 else (-delta << 1) - 1
+                while value > 0x7F:
+                    out.append((value & 0x7F) | 0x80)
+                    value >>= 7
+                out.append(value)
+                previous = timestamp
+            if hash_size is not None:
+                digest = entry[1]
+                if isinstance(digest, str):
+                    digest = bytes.fromhex(digest)
+                if len(digest) != hash_size:
+                    raise ValueError(f"a digest of {len(digest)} bytes in a run of {hash_size}-byte hashes")
+                out += digest
+        return previous
+
+
+class WireReader:
+    """Reads varints and runs from a buffer in place."""
+    __slots__ = ("view", "offset")
+
+    def __init__(self, buffer, offset=0):
+        self.view = memoryview(buffer).cast("B")
+        self.offset = offset
+
+    def varint(self):
+        view, offset = self.view, self.offset
+        value = shift = 0
+        while True:
+            byte = view[offset]
+            offset += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                self.offset = offset
+                return value
+            shift += 7
+
+    def run(self, hash_size=None, previous=0):
+        """Yield the (timestamp, digest) pairs of a run, or bare timestamps when hash_size is None, with None as the
+        timestamp of a trailing tail. The reader's offset follows the entries as they are yielded."""
+        header = self.varint()
+        count = header >> 1
+        tail = header & 1
+        view, offset = self.view, self.offset
+        for index in range(count):
+            if tail and index == count - 1:
+                timestamp = None
+            else:
+                value = shift = 0
+                while True:
+                    byte = view[offset]
+                    offset += 1
+                    value |= (byte & 0x7F) << shift
+                    if byte < 0x80:
+                        break
+                    shift += 7
+                previous += -((value + 1) >> 1) if value & 1 else value >> 1
+                timestamp = previous
+            if hash_size is None:
+                self.offset = offset
+                yield timestamp
+            else:
+                digest = bytes(view[offset:offset + hash_size])
+                offset += hash_size
+                self.offset = offset
+                yield timestamp, digest
+
+
+class BinaryCodec:
+    """Encodes sync messages in the binary form above and everything else as JSON. Decoded hashes are raw bytes,
+    which the client takes like the hex strings of JsonCodec."""
+
+    def __init__(self):
+        self.json = JsonCodec()
+
+    def encode(self, message):
+        try:
+            if message.get("op") == "children" and message.keys() <= _REQUEST_KEYS:
+                return self._encode_request(message)
+            if "children" in message and message.keys() <= _RESPONSE_KEYS:
+                return self._encode_response(message)
+        except (TypeError, ValueError):
+            pass
+        return bytes((JSON,)) + self.json.encode(message)
+
+    def decode(self, payload):
+        reader = WireReader(payload, 1)
+        tag = reader.view[0]
+        if tag == CHILDREN_REQUEST:
+            return self._decode_request(reader)
+        if tag == CHILDREN_RESPONSE:
+            return self._decode_response(reader)
+        if tag == JSON:
+            return self.json.decode(bytes(reader.view[1:]))
+        raise ValueError(f"unknown sync message tag {tag!r}")
+
+    def _encode_request(self, message):
+        writer = WireWriter(bytearray((CHILDREN_REQUEST,)))
+        _write_id(writer, message)
+        writer.varint(message["level"])
+        writer.varint(message.get("hash_prefix") or 0)
+        writer.run(message["owners"])
+        return bytes(writer.out)
+
+    def _decode_request(self, reader):
+        message = {"op": "children"}
+        _read_id(reader, message)
+        message["level"] = reader.varint()
+        hash_prefix = reader.varint()
+        if hash_prefix:
+            message["hash_prefix"] = hash_prefix
+        message["owners"] = list(reader.run())
+        return message
+
+    def _encode_response(self, message):
+        buckets = message["children"]
+        first = next((bucket[0] for bucket in buckets if bucket), (None, b""))[-1]
+        if not isinstance(first, (str, bytes)):
+            raise TypeError("not a run of hashes")
+        hash_size = len(first) // 2 if isinstance(first, str) else len(first)
+        writer = WireWriter(bytearray((CHILDREN_RESPONSE,)))
+        _write_id(writer, message)
+        writer.varint(hash_size)
+        writer.varint(len(buckets))
+        previous = 0
+        for bucket in buckets:
+            previous = writer.run(bucket, hash_size, previous)
+        return bytes(writer.out)
+
+    def _decode_response(self, reader):
+        message = {}
+        _read_id(reader, message)
+        hash_size = reader.varint()
+        buckets = []
+        previous = 0
+        for _ in range(reader.varint()):
+            bucket = [[timestamp, digest] for timestamp, digest in reader.run(hash_size, previous)]
+            previous = next((entry[0] for entry in reversed(bucket) if entry[0] is not None), previous)
+            buckets.append(bucket)
+        message["children"] = buckets
+        return message
+
+
+def _write_id(writer, message):
+    request_id = message.get("id")
+    writer.varint(0 if request_id is None else request_id + 1)
+
+
+def _read_id(reader, message):
+    request_id = reader.varint()
+    if request_id:
+        message["id"] = request_id - 1
@@ -0,0 +1,37 @@
+import random
+import unittest
+from prolly_tree import ProllyTree, Message
+
+
+class TestProllyTreeAppend(unittest.TestCase):
+
+    def test_finger_search_finds_the_same_node(self):
+        tree = ProllyTree([Message(i, i) for i in range(0, 20000, 2)])
+        # Step 1: Keys before, between, on and after the stored ones, near and far from the right edge
+        for timestamp in [-1, 0, 1, 7777, 19997, 19998, 19999, 25000] + random.Random(1).sample(range(20000), 300):
+            # Step 2: The search from the right edge lands where the search from the root does
+            self.assertIs(tree._finger_search(timestamp), tree._find_node_greater_than(timestamp))
+
+    def test_appends_and_near_tail_inserts(self):
+        rng = random.Random(5)
+        # Step 1: Stream messages that are mostly in order, some arriving a little late
+        timestamps = list(range(5000))
+        for i in range(0, 5000, 10):
+            j = min(i + rng.randrange(1, 30), 4999)
+            timestamps[i], timestamps[j] = timestamps[j], timestamps[i]
+        tree = ProllyTree()
+        for timestamp in timestamps:
+            tree.insert(Message(timestamp, timestamp))
+
+        # Step 2: The tree is the one built from the sorted messages
+        expected = ProllyTree([Message(i, i) for i in range(5000)])
+        self.assertEqual([n.timestamp for n in tree.range()], list(range(5000)))
+        self.assertEqual(tree.get_root().merkel_hash, expected.get_root().merkel_hash)
+
+        # Step 3: The tails stay linked while levels are added, so the finger still agrees with the root descent
+        for timestamp in range(-1, 5001, 7):
+            self.assertIs(tree._finger_search(timestamp), tree._find_node_greater_than(timestamp))
+
+
+if __name__ == '__main__':
+    unittest.main()
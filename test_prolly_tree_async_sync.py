@@ -0,0 +1,107 @@
+import asyncio
+import unittest
+from prolly_tree import ProllyTree, Message, reconcile_prolly_trees
+from prolly_async_sync import AsyncSyncServer, AsyncSyncClient, reconcile_with_peers, _read_frame
+from test_prolly_tree_sync import build_pair, timestamps
+
+
+class TestProllyTreeAsyncSync(unittest.TestCase):
+
+    def test_pipelined_session_matches_local_reconcile(self):
+        async def run(tree1, tree2, max_in_flight):
+            server = await AsyncSyncServer(tree2).start()
+            client = await AsyncSyncClient.connect(tree1, server.sockets[0].getsockname()[:2],
+                                                   max_in_flight=max_in_flight)
+            try:
+                return await client.reconcile(), client.stats
+            finally:
+                await client.close()
+                server.close()
+                await server.wait_closed()
+
+        for shared, only1, only2 in [(500, 0, 0), (2000, 20, 30), (10, 300, 200)]:
+            # Step 1: Node 2 serves its tree, Node 1 reconciles with and without pipelining
+            tree1, tree2 = build_pair(shared, only1, only2)
+            expected_local, expected_remote = reconcile_prolly_trees(tree1, tree2)
+            for max_in_flight in [1, 64]:
+                (only_local, only_remote), stats = asyncio.run(run(tree1, tree2, max_in_flight))
+
+                # Step 2: Both find what reconciling the two trees in one process finds, in timestamp order
+                self.assertEqual([n.timestamp for n in only_local], timestamps(expected_local))
+                self.assertEqual([n.timestamp for n in only_remote], timestamps(expected_remote))
+                self.assertGreaterEqual(stats.round_trips, 1)
+
+    def test_concurrent_sessions_with_many_peers(self):
+        # Step 1: One local tree and several peers, each missing and holding different messages
+        local = ProllyTree([Message(i, i) for i in range(0, 3000, 2)])
+        peers = [ProllyTree([Message(i, i) for i in range(p, 3000, 2 + p)]) for p in range(4)]
+
+        async def run():
+            servers = [await AsyncSyncServer(peer, latency=0.001).start() for peer in peers]
+            try:
+                return await reconcile_with_peers(local, [s.sockets[0].getsockname()[:2] for s in servers])
+            finally:
+                for server in servers:
+                    server.close()
+                    await server.wait_closed()
+
+        # Step 2: Every session agrees with a local reconcile against the same peer
+        for peer, (only_local, only_remote) in zip(peers, asyncio.run(run())):
+            expected_local, expected_remote = reconcile_prolly_trees(local, peer)
+            self.assertEqual([n.timestamp for n in only_local], timestamps(expected_local))
+            self.assertEqual([n.timestamp for n in only_remote], timestamps(expected_remote))
+
+    def test_bad_requests_fail_instead_of_hanging(self):
+        async def run():
+            server = await AsyncSyncServer(ProllyTree([Message(i, i) for i in range(100)])).start()
+            address = server.sockets[0].getsockname()[:2]
+            try:
+                # Step 1: A request the server cannot answer raises, and the connection stays usable
+                client = await AsyncSyncClient.connect(ProllyTree(), address)
+                with self.assertRaises(ValueError):
+                    await asyncio.wait_for(client._request({"op": "bogus"}), 3)
+                with self.assertRaises(ValueError):
+                    await asyncio.wait_for(client._request({"op": "children"}), 3)
+                self.assertEqual(len((await asyncio.wait_for(client.reconcile(), 3))[1]), 100)
+                await client.close()
+
+                # Step 2: A frame the server cannot decode closes the connection and fails what is waiting on it
+                client = await AsyncSyncClient.connect(ProllyTree(), address)
+                client.writer.write(b"\x00\x00\x00\x03bad")
+                with self.assertRaises(ConnectionError):
+                    await asyncio.wait_for(client._request({"op": "root"}), 3)
+                with self.assertRaises(ConnectionError):
+                    await asyncio.wait_for(client._request({"op": "root"}), 3)
+                await client.close()
+            finally:
+                server.close()
+                await server.wait_closed()
+
+        asyncio.run(run())
+
+    def test_undecodable_response_fails_the_session(self):
+        async def garbage(reader, writer):
+            # answer every request with a frame no codec can read
+            while await _read_frame(reader) is not None:
+                writer.write(b"\x00\x00\x00\x03bad")
+            writer.close()
+
+        async def run():
+            server = await asyncio.start_server(garbage, "127.0.0.1", 0)
+            try:
+                client = await AsyncSyncClient.connect(ProllyTree([Message(1, 1)]),
+                                                       server.sockets[0].getsockname()[:2])
+                with self.assertRaises(ValueError):
+                    await asyncio.wait_for(client.reconcile(), 3)
+                with self.assertRaises(ConnectionError):
+                    await asyncio.wait_for(client._request({"op": "root"}), 3)
+                await asyncio.wait_for(client.close(), 3)
+            finally:
+                server.close()
+                await server.wait_closed()
+
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+from prolly_tree import ProllyTree, Level, Message
+
+
+def build_with_levels(messages):
+    """Build the levels the way the tree used to: a base level and then one full level at a time."""
+    level = Level.BaseLevel(messages)
+    levels = [level]
+    while len(level.to_list()) > 1:
+        level = Level.NextLevel(level)
+        levels.append(level)
+    return levels
+
+
+class TestProllyTreeBulkLoad(unittest.TestCase):
+
+    def test_same_tree_as_level_by_level_build(self):
+        for count in [0, 1, 2, 5, 15, 100, 1000]:
+            messages = [Message(i, i) for i in range(count)]
+            # Step 1: Build the tree both ways
+            tree = ProllyTree.from_sorted_iter(iter(messages))
+            levels = build_with_levels(messages)
+
+            # Step 2: Every level holds the same keys and merkel hashes
+            self.assertEqual(len(tree), len(levels))
+            for streamed, built in zip(tree, levels):
+                self.assertEqual([(n.timestamp, n.merkel_hash) for n in streamed.to_list()],
+                                 [(n.timestamp, n.merkel_hash) for n in built.to_list()])
+
+            # Step 3: The root hash matches
+            self.assertEqual(tree.get_root().merkel_hash, levels[-1].tail.merkel_hash)
+
+    def test_unsorted_messages_are_rejected(self):
+        messages = [Message(i, i) for i in [1, 3, 2]]
+        with self.assertRaises(ValueError):
+            ProllyTree.from_sorted_iter(messages)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+from prolly_tree import ProllyTree, Message, find_diff_between_2_prolly_trees
+from prolly_compact import CompactProllyTree
+
+
+def level_entries(level):
+    return [(n.timestamp, n.node_hash, n.merkel_hash, n.is_boundary_node()) for n in level]
+
+
+class TestCompactProllyTree(unittest.TestCase):
+
+    def test_same_levels_as_linked_tree(self):
+        for count in [0, 1, 5, 15, 200]:
+            messages = [Message(i, i) for i in range(count)]
+            tree = ProllyTree(messages)
+            # Step 1: Build the compact form both from the tree and from the messages
+            for compact in [CompactProllyTree.from_tree(tree), CompactProllyTree.from_sorted_iter(messages)]:
+                # Step 2: Every level holds the same entries
+                self.assertEqual(len(compact), len(tree))
+                for compact_level, level in zip(compact, tree):
+                    self.assertEqual(level_entries(compact_level.to_list(compact)), level_entries(level.to_list()))
+                self.assertEqual(compact.get_root().merkel_hash, tree.get_root().merkel_hash)
+
+    def test_search_and_links(self):
+        tree = CompactProllyTree.from_sorted_iter([Message(i, i * 2) for i in range(50)])
+        node = tree.search(20)
+        self.assertEqual(node.data, 10)
+        self.assertIsNone(tree.search(21))
+        self.assertEqual(node.left.timestamp, 18)
+        self.assertEqual(node.right.timestamp, 22)
+        # a promoted node can be reached from its child and back
+        promoted = tree.get_root().down
+        self.assertEqual(promoted.down.up.index, promoted.index)
+
+    def test_diff_against_compact_tree(self):
+        # Step 1: Node 1 keeps the linked tree and the peer keeps a compact image
+        tree1 = ProllyTree([Message(i, i) for i in range(11)])
+        tree2 = CompactProllyTree.from_sorted_iter([Message(i, i) for i in range(15)])
+        root_of_tree1, root_of_tree2 = tree1.get_root(), tree2.get_root()
+        if root_of_tree1.level > root_of_tree2.level:
+            root_of_tree1 = tree1.get_root_at_height(root_of_tree1.level - root_of_tree2.level)
+        elif root_of_tree2.level > root_of_tree1.level:
+            root_of_tree2 = tree2.get_root_at_height(root_of_tree2.level - root_of_tree1.level)
+
+        # Step 2: The diff walks the compact nodes like linked ones
+        diff_result = find_diff_between_2_prolly_trees(root_of_tree1, root_of_tree2)
+        self.assertEqual(sorted([node.timestamp for node in diff_result]), [11, 12, 13, 14])
+
+
+if __name__ == '__main__':
+    unittest.main()
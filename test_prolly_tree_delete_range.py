@@ -0,0 +1,69 @@
+import random
+import unittest
+from prolly_tree import ProllyTree, Message, Hasher
+
+
+def levels(tree):
+    return [[(n.timestamp, n.merkel_hash) for n in level.to_list()] for level in tree]
+
+
+class TestProllyTreeDeleteRange(unittest.TestCase):
+
+    def test_delete_range_matches_a_fresh_build(self):
+        rng = random.Random(12)
+        for hasher in [Hasher(), Hasher("blake2b", hex_digests=False, digest_size=16, boundary_bits=2)]:
+            keys = sorted(rng.sample(range(50000), 3000))
+            for start, end in [(None, None), (None, 20000), (20000, None), (10000, 30000), (keys[5], keys[6]),
+                               (keys[100] + 1, keys[2000]), (60000, 70000), (30000, 30000)]:
+                # Step 1: Delete a window from a tree
+                tree = ProllyTree([Message(i, i) for i in keys], hasher=hasher)
+                kept = [k for k in keys if not ((start is None or k >= start) and (end is None or k < end))]
+                self.assertEqual(tree.delete_range(start, end), len(keys) - len(kept))
+
+                # Step 2: The tree is the tree built from what is left
+                expected = ProllyTree([Message(i, i) for i in kept], hasher=hasher)
+                self.assertEqual(levels(tree), levels(expected))
+
+                # Step 3: It keeps working as a tree
+                tree.insert(Message("new", 50001))
+                expected.insert(Message("new", 50001))
+                self.assertEqual(tree.get_root().merkel_hash, expected.get_root().merkel_hash)
+
+    def test_inverted_range_deletes_nothing(self):
+        messages = [Message(i, i) for i in range(0, 3000, 3)]
+        for index in [False, True]:
+            # Step 1: A range whose start is past its end, on a plain and an indexed tree
+            tree = ProllyTree(messages, index=index)
+            root = tree.get_root().merkel_hash
+            for start, end in [(2000, 1000), (3, 0), (5000, -5)]:
+                self.assertEqual(tree.delete_range(start, end), 0)
+
+            # Step 2: The tree and its index are untouched
+            self.assertEqual([n.timestamp for n in tree.range()], list(range(0, 3000, 3)))
+            self.assertEqual(tree.get_root().merkel_hash, root)
+            self.assertIsNotNone(tree.search(1500))
+            if index:
+                self.assertEqual(set(tree._index), set(range(0, 3000, 3)))
+
+    def test_delete_older_than(self):
+        # Step 1: Keep a stream of messages and expire the old ones in steps
+        tree = ProllyTree([Message(i, i) for i in range(10000)])
+        for cutoff in [1000, 1000, 5000, 9999]:
+            tree.delete_older_than(cutoff)
+            # Step 2: Only the newer messages are left and the hashes match a fresh build
+            self.assertEqual([n.timestamp for n in tree.range()], list(range(cutoff, 10000)))
+            expected = ProllyTree([Message(i, i) for i in range(cutoff, 10000)])
+            self.assertEqual(tree.get_root().merkel_hash, expected.get_root().merkel_hash)
+
+    def test_delete_range_keeps_snapshots(self):
+        tree = ProllyTree([Message(i, i) for i in range(5000)])
+        with tree.snapshot() as snapshot:
+            tree.delete_range(1000, 4000)
+            tree.insert_many([Message(i, i) for i in range(2000, 2100)])
+            self.assertEqual([n.timestamp for n in snapshot.range()], list(range(5000)))
+            self.assertEqual(snapshot.get_root().merkel_hash,
+                             ProllyTree([Message(i, i) for i in range(5000)]).get_root().merkel_hash)
+
+
+if __name__ == '__main__':
+    unittest.main()
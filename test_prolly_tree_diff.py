@@ -1,5 +1,7 @@
+import random
+import types
 import unittest
-from prolly_tree import ProllyTree, Message, find_diff_between_2_prolly_trees
+from prolly_tree import ProllyTree, Message, find_diff_between_2_prolly_trees, iter_diff_between_2_prolly_trees
 
 class TestProllyTreeDiffProtocol(unittest.TestCase):
 
@@ -135,5 +137,35 @@ class TestProllyTreeDiffProtocol(unittest.TestCase):
         expected_missing_keys = [Message(5, 5)] + [Message(i, i) for i in range(8, 18)]
         self.assertEqual(sorted([node.timestamp for node in diff_result]), sorted([node.timestamp for node in expected_missing_keys]))
 
+    def test_heights_are_handled_by_the_diff(self):
+        # Step 1: Trees of very different heights, compared straight from their roots
+        tree1 = ProllyTree([Message(i, i) for i in range(3)])
+        tree2 = ProllyTree([Message(i, i) for i in range(200)])
+        self.assertNotEqual(len(tree1), len(tree2))
+
+        # Step 2: Both directions work without lining the roots up first
+        self.assertEqual(sorted(node.timestamp for node in find_diff_between_2_prolly_trees(tree1, tree2)),
+                         list(range(3, 200)))
+        self.assertEqual(find_diff_between_2_prolly_trees(tree2.get_root(), tree1.get_root()), [])
+
+    def test_large_random_divergence(self):
+        rng = random.Random(11)
+        for shared, only1, only2 in [(2000, 0, 1), (2000, 30, 30), (500, 700, 900)]:
+            keys = rng.sample(range(100000), shared + only1 + only2)
+            keys1 = keys[:shared + only1]
+            keys2 = keys[:shared] + keys[shared + only1:]
+            tree1 = ProllyTree([Message(i, i) for i in sorted(keys1)])
+            tree2 = ProllyTree([Message(i, i) for i in sorted(keys2)])
+
+            diff_result = find_diff_between_2_prolly_trees(tree1, tree2)
+            self.assertEqual(sorted(node.timestamp for node in diff_result), sorted(set(keys2) - set(keys1)))
+
+    def test_missing_leaves_are_streamed(self):
+        tree1 = ProllyTree([Message(i, i) for i in range(100)])
+        tree2 = ProllyTree([Message(i, i) for i in range(120)])
+        diff_result = iter_diff_between_2_prolly_trees(tree1, tree2)
+        self.assertIsInstance(diff_result, types.GeneratorType)
+        self.assertEqual(next(diff_result).level, 0)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
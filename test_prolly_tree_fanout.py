@@ -0,0 +1,48 @@
+import unittest
+from prolly_tree import ProllyTree, Message, Hasher, is_boundary_hash
+
+
+class TestProllyTreeFanout(unittest.TestCase):
+
+    def test_buckets_follow_target_fanout(self):
+        messages = [Message(i, i) for i in range(4000)]
+        # Step 1: Build with the original rule and with 16 nodes per bucket on average
+        default_tree = ProllyTree(messages)
+        wide_tree = ProllyTree(messages, boundary_bits=4)
+
+        # Step 2: The leaf level is cut into about 4000 / 16 buckets and the tree gets much shorter
+        promoted = len(wide_tree[1].to_list()) - 1
+        self.assertTrue(150 < promoted < 350, promoted)
+        self.assertLess(len(wide_tree), len(default_tree))
+
+    def test_mutations_keep_fanout(self):
+        for hasher in [Hasher(), Hasher(hex_digests=False)]:
+            tree = ProllyTree([Message(i, i) for i in range(0, 600, 2)], hasher=hasher, boundary_bits=3)
+            tree.insert_many([Message(i, i) for i in range(1, 300, 2)])
+            tree.delete(10)
+            expected = ProllyTree([Message(i, i) for i in sorted(list(range(0, 600, 2)) + list(range(1, 300, 2)))
+                                   if i != 10], hasher=hasher, boundary_bits=3)
+            self.assertEqual(tree.get_root().merkel_hash, expected.get_root().merkel_hash)
+            self.assertEqual(len(tree), len(expected))
+
+    def test_hex_and_binary_digests_pick_the_same_boundaries(self):
+        hasher = Hasher(hex_digests=False)
+        for i in range(200):
+            digest = hasher.leaf_hash(i, i)
+            for bits in [1, 3, 4, 5, 9]:
+                self.assertEqual(hasher.is_boundary(digest, bits), is_boundary_hash(digest.hex(), boundary_bits=bits))
+
+    def test_boundary_bits_are_validated(self):
+        # no bits would make every node a boundary and the levels would never end
+        for bits in [0, -1, 257]:
+            with self.assertRaises(ValueError):
+                Hasher(boundary_bits=bits)
+            with self.assertRaises(ValueError):
+                ProllyTree([Message(i, i) for i in range(3)], boundary_bits=bits)
+        with self.assertRaises(ValueError):
+            Hasher("blake2b", digest_size=16).with_boundary_bits(129)
+        self.assertEqual(ProllyTree([Message(i, i) for i in range(3)], boundary_bits=256).boundary_bits, 256)
+
+
+if __name__ == '__main__':
+    unittest.main()
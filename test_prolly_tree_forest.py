@@ -0,0 +1,72 @@
+import random
+import unittest
+from prolly_tree import ProllyTree, Message, reconcile_prolly_trees
+from prolly_forest import ProllyForest
+
+
+def timestamps(nodes):
+    return sorted(node.timestamp for node in nodes)
+
+
+class TestProllyForest(unittest.TestCase):
+
+    def test_forest_holds_the_same_messages_as_one_tree(self):
+        rng = random.Random(2)
+        keys = rng.sample(range(20000), 3000)
+        # Step 1: Build a forest of 1000-wide epochs sequentially and with worker processes
+        forest = ProllyForest([Message(i, i) for i in keys], epoch_length=1000)
+        built = ProllyForest.build([Message(i, i) for i in keys], epoch_length=1000, processes=2)
+
+        # Step 2: Both hold every message and agree on every epoch root
+        self.assertEqual([n.timestamp for n in forest.range()], sorted(keys))
+        self.assertEqual(forest.epochs(), built.epochs())
+        self.assertEqual(forest.get_root().merkel_hash, built.get_root().merkel_hash)
+        for epoch in forest.epochs():
+            self.assertEqual(forest.shards[epoch].get_root().merkel_hash,
+                             built.shards[epoch].get_root().merkel_hash)
+
+        # Step 3: Insert, search and delete are routed to the right epoch
+        forest.insert(Message("new", 25000))
+        self.assertEqual(forest.search(25000).data, "new")
+        self.assertEqual(forest.delete(keys[0]).timestamp, keys[0])
+        self.assertIsNone(forest.search(keys[0]))
+        self.assertEqual([n.timestamp for n in forest.range(5000, 6000)],
+                         sorted(k for k in keys[1:] if 5000 <= k < 6000))
+
+    def test_reconcile_descends_into_changed_epochs_only(self):
+        # Step 1: Two forests that differ in two epochs, one of them missing on one side
+        forest1 = ProllyForest([Message(i, i) for i in range(0, 10000, 3)], epoch_length=1000)
+        forest2 = ProllyForest([Message(i, i) for i in range(0, 10000, 3) if i not in (1500, 1503) and i < 9000],
+                               epoch_length=1000)
+        forest2.insert(Message("extra", 4001))
+
+        # Step 2: The changed epochs are found and compared
+        only1, only2 = forest1.reconcile(forest2)
+        self.assertEqual(timestamps(only1), [1500, 1503] + list(range(9000, 10000, 3)))
+        self.assertEqual(timestamps(only2), [4001])
+        self.assertEqual(timestamps(forest2.diff(forest1)), timestamps(only1))
+
+        # Step 3: The result matches a diff of single trees
+        tree1 = ProllyTree([n for n in forest1.range()])
+        tree2 = ProllyTree([n for n in forest2.range()])
+        expected1, expected2 = reconcile_prolly_trees(tree1, tree2)
+        self.assertEqual(timestamps(only1), timestamps(expected1))
+        self.assertEqual(timestamps(only2), timestamps(expected2))
+
+    def test_drop_epochs(self):
+        forest = ProllyForest([Message(i, i) for i in range(10000)], epoch_length=1000)
+        root_before = forest.get_root().merkel_hash
+        # Step 1: Drop the epochs that ended by 3500
+        forest.drop_older_than(3500)
+        self.assertEqual(forest.epochs(), list(range(3, 10)))
+        self.assertIsNone(forest.search(2999))
+        self.assertEqual(forest.search(3000).data, 3000)
+
+        # Step 2: The top tree matches a forest built without the dropped messages
+        self.assertNotEqual(forest.get_root().merkel_hash, root_before)
+        expected = ProllyForest([Message(i, i) for i in range(3000, 10000)], epoch_length=1000)
+        self.assertEqual(forest.get_root().merkel_hash, expected.get_root().merkel_hash)
+
+
+if __name__ == '__main__':
+    unittest.main()
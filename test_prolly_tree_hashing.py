@@ -0,0 +1,46 @@
+import unittest
+from prolly_tree import ProllyTree, Message, Hasher, find_diff_between_2_prolly_trees
+from prolly_compact import CompactProllyTree
+
+
+class TestProllyTreeHashing(unittest.TestCase):
+
+    def test_default_scheme_keeps_existing_root_hashes(self):
+        # root hash of 15 messages under the original SHA-256/hex scheme
+        tree = ProllyTree([Message(i, i) for i in range(15)])
+        self.assertEqual(tree.get_root().merkel_hash,
+                         "c79f74b9c8b690a51dc1c1a7c4ff31621613005204c0ee1b084a7ffadd704937")
+
+    def test_binary_digests(self):
+        for hasher in [Hasher(hex_digests=False), Hasher("blake2b", hex_digests=False, digest_size=32)]:
+            # Step 1: Build a tree keeping raw digests
+            tree = ProllyTree([Message(i, i) for i in range(100)], hasher=hasher)
+            root_hash = tree.get_root().merkel_hash
+            self.assertIsInstance(root_hash, bytes)
+            self.assertEqual(len(root_hash), 32)
+
+            # Step 2: Mutations and the compact form agree with a fresh build
+            tree.insert(Message(100, 100))
+            tree.delete(3)
+            expected = ProllyTree([Message(i, i) for i in range(101) if i != 3], hasher=hasher)
+            self.assertEqual(tree.get_root().merkel_hash, expected.get_root().merkel_hash)
+            self.assertEqual(CompactProllyTree.from_tree(expected).get_root().merkel_hash,
+                             expected.get_root().merkel_hash)
+
+    def test_canonical_payload_encoding(self):
+        hasher = Hasher(hex_digests=False)
+        self.assertEqual(hasher.leaf_hash("abc", 5), hasher.leaf_hash(b"abc", 5))
+        self.assertNotEqual(hasher.leaf_hash("abc", 5), hasher.leaf_hash("abc", 6))
+
+    def test_diff_with_binary_digests(self):
+        hasher = Hasher("blake2b", hex_digests=False, digest_size=32)
+        tree1 = ProllyTree([Message(i, i) for i in range(0, 20, 2)], hasher=hasher)
+        tree2 = ProllyTree([Message(i, i) for i in range(0, 20, 2)], hasher=hasher)
+        tree2.insert(Message(5, 5))
+        self.assertEqual(len(tree1), len(tree2))
+        diff_result = find_diff_between_2_prolly_trees(tree1.get_root(), tree2.get_root())
+        self.assertEqual([node.timestamp for node in diff_result], [5])
+
+
+if __name__ == '__main__':
+    unittest.main()
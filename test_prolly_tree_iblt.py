@@ -0,0 +1,92 @@
+import unittest
+from prolly_tree import ProllyTree, Message, Hasher, reconcile_prolly_trees
+from prolly_sync import SyncServer, SyncClient, LoopbackTransport
+from prolly_iblt import InvertibleBloomLookupTable
+from test_prolly_tree_sync import build_pair, timestamps
+
+
+class TestProllyTreeIblt(unittest.TestCase):
+
+    def test_table_decodes_a_small_difference(self):
+        keys = [i.to_bytes(8, "big") for i in range(1000)]
+        # Step 1: Two tables of sets that share all but a few keys
+        table1 = InvertibleBloomLookupTable(30, 8)
+        table2 = InvertibleBloomLookupTable(30, 8)
+        for key in keys[:995]:
+            table1.add(key)
+        for key in keys[3:]:
+            table2.add(key)
+
+        # Step 2: The difference is recovered although each table holds hundreds of keys
+        only1, only2, complete = table1.subtract(table2).decode()
+        self.assertTrue(complete)
+        self.assertEqual(sorted(only1), keys[:3])
+        self.assertEqual(sorted(only2), keys[995:])
+
+        # Step 3: A table far too small for the difference says it could not decode
+        small1, small2 = InvertibleBloomLookupTable(6, 8), InvertibleBloomLookupTable(6, 8)
+        for key in keys[:100]:
+            small1.add(key)
+        self.assertFalse(small1.subtract(small2).decode()[2])
+
+        # Step 4: The table survives the wire
+        wire = InvertibleBloomLookupTable.from_wire(table2.to_wire(), len(table2), 8)
+        self.assertEqual((wire.counts, wire.keys, wire.checks), (table2.counts, table2.keys, table2.checks))
+
+    def test_hybrid_sync_matches_descent(self):
+        for shared, only1, only2 in [(5000, 1, 0), (5000, 0, 1), (5000, 4, 6), (2000, 20, 30), (10, 300, 200)]:
+            for hasher in [Hasher(), Hasher(hex_digests=False, boundary_bits=3)]:
+                tree1, tree2 = build_pair(shared, only1, only2, hasher=hasher)
+                # Step 1: Reconcile in hybrid mode and with the plain descent
+                hybrid = SyncClient(tree1, LoopbackTransport(SyncServer(tree2)), iblt_max_leaves=1024)
+                plain = SyncClient(tree1, LoopbackTransport(SyncServer(tree2)))
+                only_local, only_remote = hybrid.reconcile()
+
+                # Step 2: Both find what reconciling the trees in one process finds
+                expected_local, expected_remote = reconcile_prolly_trees(tree1, tree2)
+                self.assertEqual(timestamps(only_local), timestamps(expected_local))
+                self.assertEqual(timestamps(only_remote), timestamps(expected_remote))
+                self.assertEqual([n.merkel_hash for n in only_remote],
+                                 [tree2.search(n.timestamp).merkel_hash for n in only_remote])
+
+                # Step 3: A small difference takes fewer round trips than the descent
+                plain.reconcile()
+                if only1 + only2 <= 10:
+                    self.assertFalse(hybrid.iblt_fell_back)
+                    self.assertLess(hybrid.stats.round_trips, plain.stats.round_trips)
+
+    def test_clustered_difference_retries_with_a_larger_table(self):
+        # Step 1: A clustered difference much larger than the table sized for the few mismatching owners
+        tree1 = ProllyTree([Message(i, i) for i in range(3000)])
+        tree2 = ProllyTree([Message(i, i) for i in range(3000) if not 1000 <= i < 1400])
+        client = SyncClient(tree1, LoopbackTransport(SyncServer(tree2)), iblt_max_leaves=4096)
+        only_local, only_remote = client.reconcile()
+
+        # Step 2: The gap between the leaf counts sizes a second table that decodes it
+        self.assertFalse(client.iblt_fell_back)
+        self.assertEqual(timestamps(only_local), list(range(1000, 1400)))
+        self.assertEqual(only_remote, [])
+
+    def test_fallback_to_descent(self):
+        # Step 1: Both sides hold as many leaves, but a different half of the same window
+        tree1 = ProllyTree([Message(i, i) for i in range(3000) if not (1000 <= i < 1400 and i % 2)])
+        tree2 = ProllyTree([Message(i, i) for i in range(3000) if not (1000 <= i < 1400 and i % 2 == 0)])
+        client = SyncClient(tree1, LoopbackTransport(SyncServer(tree2)), iblt_max_leaves=4096)
+        only_local, only_remote = client.reconcile()
+
+        # Step 2: Decoding fails and the descent finishes the job
+        self.assertTrue(client.iblt_fell_back)
+        self.assertEqual(timestamps(only_local), list(range(1000, 1400, 2)))
+        self.assertEqual(timestamps(only_remote), list(range(1001, 1400, 2)))
+
+    def test_non_integer_timestamps_fall_back(self):
+        tree1 = ProllyTree([Message(i, i / 2) for i in range(500)])
+        tree2 = ProllyTree([Message(i, i / 2) for i in range(500) if i != 77])
+        client = SyncClient(tree1, LoopbackTransport(SyncServer(tree2)), iblt_max_leaves=4096)
+        only_local, only_remote = client.reconcile()
+        self.assertTrue(client.iblt_fell_back)
+        self.assertEqual(timestamps(only_local), [38.5])
+
+
+if __name__ == '__main__':
+    unittest.main()
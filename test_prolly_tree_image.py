@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+from prolly_tree import ProllyTree, Message, Hasher, find_diff_between_2_prolly_trees
+from prolly_compact import CompactProllyTree
+
+
+def level_entries(level):
+    return [(n.timestamp, n.data, n.node_hash, n.merkel_hash, n.is_boundary_node()) for n in level.to_list()]
+
+
+class TestProllyTreeImage(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "tree.img")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_save_and_load(self):
+        for hasher in [Hasher(), Hasher("blake2b", hex_digests=False, digest_size=16, boundary_bits=2)]:
+            for count in [0, 1, 300]:
+                # Step 1: Save a tree with mixed payloads and load it back
+                tree = ProllyTree([Message(f"m{i}" if i % 2 else i.to_bytes(2, "big"), i) for i in range(count)],
+                                  hasher=hasher)
+                tree.save(self.path)
+                loaded = ProllyTree.load(self.path, verify=True)
+
+                # Step 2: Every level holds the same entries
+                self.assertEqual(len(loaded), len(tree))
+                for loaded_level, level in zip(loaded, tree):
+                    self.assertEqual(level_entries(loaded_level), level_entries(level))
+
+                # Step 3: The loaded tree can be mutated like a built one
+                loaded.insert(Message("new", 1000))
+                tree.insert(Message("new", 1000))
+                self.assertEqual(loaded.get_root().merkel_hash, tree.get_root().merkel_hash)
+
+    def test_mapped_image(self):
+        tree = ProllyTree([Message(i, i * 2) for i in range(2000)])
+        tree.save(self.path)
+
+        # Step 1: Map the image without building any node
+        compact = CompactProllyTree.load(self.path)
+        self.assertEqual(compact.get_root().merkel_hash, tree.get_root().merkel_hash)
+        self.assertEqual(compact.search(1000).data, 500)
+        self.assertEqual(compact.verify(), tree.get_root().merkel_hash)
+
+        # Step 2: The mapped tree can be diffed against a linked one
+        other = ProllyTree([Message(i, i * 2) for i in range(1990)])
+        self.assertEqual([n.timestamp for n in find_diff_between_2_prolly_trees(other, compact)],
+                         list(range(3980, 4000, 2)))
+
+    def test_corruption_is_detected(self):
+        tree = ProllyTree([Message(i, i) for i in range(500)])
+        tree.save(self.path)
+        # Step 1: Flip one byte of the stored hash of a leaf
+        with open(self.path, "rb") as f:
+            image = bytearray(f.read())
+        position = image.index(bytes.fromhex(tree.search(250).node_hash))
+        image[position] ^= 0xFF
+        with open(self.path, "wb") as f:
+            f.write(image)
+
+        # Step 2: Loading without a check works, verifying fails
+        CompactProllyTree.load(self.path)
+        with self.assertRaises(ValueError):
+            ProllyTree.load(self.path, verify=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import random
+import unittest
+from prolly_tree import ProllyTree, Message
+
+
+class TestProllyTreeIndex(unittest.TestCase):
+
+    def assertSameAnswers(self, indexed, plain, timestamps):
+        for timestamp in timestamps:
+            self.assertIs(indexed.search(timestamp) is None, plain.search(timestamp) is None)
+            self.assertEqual(timestamp in indexed, timestamp in plain)
+            for level in range(len(plain)):
+                expected = plain.get_intermediate_node(timestamp, level)
+                node = indexed.get_intermediate_node(timestamp, level)
+                self.assertEqual(None if node is None else (node.timestamp, node.level),
+                                 None if expected is None else (expected.timestamp, expected.level))
+
+    def test_index_follows_mutations(self):
+        rng = random.Random(3)
+        messages = [Message(i, i) for i in range(0, 6000, 3)]
+        # Step 1: The same tree with and without an index
+        indexed = ProllyTree(messages, index=True)
+        plain = ProllyTree(messages)
+
+        # Step 2: Apply the same inserts, batches and deletes to both
+        for tree in [indexed, plain]:
+            for timestamp in rng.sample(range(6000), 300):
+                tree.insert(Message(timestamp, timestamp))
+            tree.insert_many([Message(t, t) for t in range(6000, 6500)])
+            tree.delete(3)
+            tree.delete(4242)
+            tree.delete_range(1000, 2000)
+            tree.delete_older_than(10)
+            rng.seed(3)
+
+        # Step 3: Every lookup answers as the pointer walk does
+        self.assertEqual(set(indexed._index), {n.timestamp for n in plain.range()})
+        self.assertSameAnswers(indexed, plain, range(-1, 6600, 7))
+        self.assertEqual(indexed.get_root().merkel_hash, plain.get_root().merkel_hash)
+
+    def test_missing_filters_a_batch(self):
+        tree = ProllyTree([Message(i, i) for i in range(0, 100, 2)], index=True)
+        batch = [Message(t, t) for t in [5, 4, 99, 0, 200]]
+        # Step 1: Only the messages the tree lacks are left, in the order of the batch
+        self.assertEqual([m.timestamp for m in tree.missing(batch)], [5, 99, 200])
+        tree.drop_index()
+        self.assertEqual([m.timestamp for m in tree.missing(batch)], [5, 99, 200])
+
+    def test_repeated_timestamps(self):
+        tree = ProllyTree([Message("a", 1), Message("b", 2)], index=True)
+        # Step 1: The index points at the rightmost leaf with a timestamp, as search does without it
+        tree.insert(Message("c", 2))
+        self.assertEqual(tree.search(2).data, "c")
+        tree.delete(2)
+        self.assertEqual(tree.search(2).data, "b")
+        tree.delete(2)
+        self.assertNotIn(2, tree)
+        self.assertIn(1, tree)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import random
+import unittest
+from prolly_tree import ProllyTree, Message
+
+
+def tree_entries(tree):
+    return [[(n.timestamp, n.merkel_hash) for n in level.to_list()] for level in tree]
+
+
+class TestProllyTreeInsertMany(unittest.TestCase):
+
+    def test_insert_many_matches_fresh_build(self):
+        rng = random.Random(7)
+        for existing_count, batch_count in [(0, 10), (5, 1), (20, 50), (300, 120)]:
+            keys = rng.sample(range(10 * (existing_count + batch_count)), existing_count + batch_count)
+            existing, batch = sorted(keys[:existing_count]), keys[existing_count:]
+
+            # Step 1: Insert an unsorted batch into an existing tree
+            tree = ProllyTree([Message(i, i) for i in existing])
+            inserted = tree.insert_many([Message(i, i) for i in batch])
+            self.assertEqual(sorted(batch), [node.timestamp for node in inserted])
+
+            # Step 2: The tree is the one built from scratch, merkel hashes included
+            expected = ProllyTree([Message(i, i) for i in sorted(keys)])
+            self.assertEqual(tree_entries(tree), tree_entries(expected))
+            self.assertEqual(tree.get_root().merkel_hash, expected.get_root().merkel_hash)
+
+    def test_inserted_messages_are_searchable(self):
+        tree = ProllyTree([Message(i, i) for i in range(0, 20, 2)])
+        tree.insert_many([Message(i, i) for i in range(1, 20, 2)])
+        for i in range(20):
+            self.assertEqual(tree.search(i).data, i)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import random
+import unittest
+from unittest import mock
+
+from prolly_tree import ProllyTree, Message
+
+
+def dirty_nodes(tree):
+    return [n for level in tree for n in level.to_list() if n.dirty]
+
+
+class TestProllyTreeMerkelHash(unittest.TestCase):
+
+    def test_root_hash_is_correct_after_inserts_and_deletes(self):
+        rng = random.Random(3)
+        keys = rng.sample(range(2000), 400)
+        # Step 1: Insert messages one at a time into an existing tree
+        tree = ProllyTree([Message(i, i) for i in sorted(keys[:200])])
+        for key in keys[200:]:
+            tree.insert(Message(key, key))
+        expected = ProllyTree([Message(i, i) for i in sorted(keys)])
+        self.assertEqual(tree.get_root().merkel_hash, expected.get_root().merkel_hash)
+
+        # Step 2: Delete some of them again
+        for key in keys[:150]:
+            tree.delete(key)
+        expected = ProllyTree([Message(i, i) for i in sorted(keys[150:])])
+        self.assertEqual(tree.get_root().merkel_hash, expected.get_root().merkel_hash)
+
+    def test_hashes_are_recomputed_lazily_once_per_dirty_bucket(self):
+        tree = ProllyTree([Message(i, i) for i in range(0, 1000, 2)])
+        # Step 1: Mutations only mark buckets dirty, nothing is hashed yet
+        with mock.patch.object(tree.hasher, "bucket_hash", wraps=tree.hasher.bucket_hash) as hashed:
+            for i in range(1, 200, 2):
+                tree.insert(Message(i, i))
+            self.assertEqual(hashed.call_count, 0)
+
+        # Step 2: Reading the root hash hashes every dirty bucket exactly once
+        stale = len(dirty_nodes(tree))
+        self.assertGreater(stale, 0)
+        with mock.patch.object(tree.hasher, "bucket_hash", wraps=tree.hasher.bucket_hash) as hashed:
+            tree.get_root().merkel_hash
+            self.assertEqual(hashed.call_count, stale)
+        self.assertEqual(dirty_nodes(tree), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import pickle
+import unittest
+from prolly_tree import ProllyTree, Message, Hasher, LeafHashPool
+
+
+def levels(tree):
+    return [[(n.timestamp, n.node_hash, n.merkel_hash, n.is_boundary_node()) for n in level.to_list()]
+            for level in tree]
+
+
+class TestProllyTreeParallelHashing(unittest.TestCase):
+
+    def test_pool_builds_the_same_tree(self):
+        messages = [Message(f"payload {i}" * (i % 7), i) for i in range(3000)]
+        for hasher in [Hasher(), Hasher("blake2b", hex_digests=False, digest_size=16, boundary_bits=3)]:
+            expected = ProllyTree(messages, hasher=hasher)
+            for processes in [False, True]:
+                # Step 1: Build with leaves hashed by a pool of threads or processes in small chunks
+                with LeafHashPool(workers=2, processes=processes, chunk_size=100) as pool:
+                    tree = ProllyTree.from_sorted_iter(messages, hasher=hasher, hash_pool=pool)
+
+                    # Step 2: Every level is the same as a sequential build
+                    self.assertEqual(levels(tree), levels(expected))
+
+                    # Step 3: Batches inserted through the same pool give the same tree as well
+                    batch = [Message(i, i + 0.5 if hasher.hex_digests else i + 5000) for i in range(0, 3000, 3)]
+                    tree.insert_many(batch, hash_pool=pool)
+                    expected_after = ProllyTree(messages, hasher=hasher)
+                    expected_after.insert_many(batch)
+                    self.assertEqual(tree.get_root().merkel_hash, expected_after.get_root().merkel_hash)
+
+    def test_hasher_pickles(self):
+        hasher = Hasher("blake2b", hex_digests=False, digest_size=20, boundary_bits=5)
+        copy = pickle.loads(pickle.dumps(hasher))
+        self.assertEqual(repr(copy), repr(hasher))
+        self.assertEqual(copy.leaf_hash("a", 1), hasher.leaf_hash("a", 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import random
+import unittest
+from prolly_tree import ProllyTree, Message, Hasher
+
+
+class TestProllyTreeRange(unittest.TestCase):
+
+    def test_range_matches_filtering_the_messages(self):
+        # Step 1: Create a tree with gaps between the timestamps
+        timestamps = sorted(random.Random(4).sample(range(10000), 2000))
+        tree = ProllyTree([Message(i, i) for i in timestamps])
+
+        # Step 2: Windows with bounds on, between and outside the keys give the keys inside them
+        for start, end in [(None, None), (None, 500), (500, None), (timestamps[10], timestamps[20]),
+                           (timestamps[10] + 1, timestamps[20] + 1), (3000, 3000), (20000, 30000), (-5, 3)]:
+            expected = [t for t in timestamps if (start is None or t >= start) and (end is None or t < end)]
+            self.assertEqual([n.timestamp for n in tree.range(start, end)], expected)
+
+    def test_range_pages(self):
+        tree = ProllyTree([Message(i, i) for i in range(0, 1000, 3)])
+
+        # Step 1: Page through a window 7 leaves at a time
+        seen, cursor, pages = [], None, 0
+        while True:
+            page, cursor = tree.range_page(100, 400, limit=7, cursor=cursor)
+            seen.extend(n.timestamp for n in page)
+            pages += 1
+            if cursor is None:
+                break
+            self.assertEqual(len(page), 7)
+
+        # Step 2: The pages add up to the window
+        self.assertEqual(seen, list(range(102, 400, 3)))
+        self.assertEqual(pages, -(-len(seen) // 7))
+
+    def test_range_fingerprint(self):
+        for hasher in [Hasher(), Hasher("blake2b", hex_digests=False, digest_size=16, boundary_bits=3)]:
+            # Step 1: Two trees that hold the same messages from 4000 to 6000 but different ones outside of it
+            rng = random.Random(8)
+            window = list(range(4000, 6000))
+            outside1 = rng.sample(range(4000), 1500) + rng.sample(range(6000, 10000), 1500)
+            outside2 = rng.sample(range(4000), 700) + rng.sample(range(6000, 10000), 2000)
+            tree1 = ProllyTree([Message(i, i) for i in sorted(window + outside1)], hasher=hasher)
+            tree2 = ProllyTree([Message(i, i) for i in sorted(window + outside2)], hasher=hasher)
+            window_only = ProllyTree([Message(i, i) for i in window], hasher=hasher)
+
+            # Step 2: The fingerprints of the window agree, with the window alone as well
+            fingerprint = tree1.range_fingerprint(4000, 6000)
+            self.assertEqual(tree2.range_fingerprint(4000, 6000), fingerprint)
+            self.assertEqual(window_only.range_fingerprint(), fingerprint)
+            self.assertNotEqual(tree1.range_fingerprint(3000, 6000), tree2.range_fingerprint(3000, 6000))
+
+            # Step 3: Only a few subtrees and edge leaves make up the fingerprint
+            self.assertLess(len(tree1._range_cover(4000, 6000)), 200)
+
+            # Step 4: Losing a message of the window changes it and getting it back restores it
+            tree2.delete(4500)
+            self.assertNotEqual(tree2.range_fingerprint(4000, 6000), fingerprint)
+            tree2.insert(Message(4500, 4500))
+            self.assertEqual(tree2.range_fingerprint(4000, 6000), fingerprint)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import random
+import unittest
+from unittest import mock
+
+import prolly_tree
+from prolly_tree import ProllyTree, Message, reconcile_prolly_trees, find_diff_between_2_prolly_trees
+
+
+class TestProllyTreeReconcile(unittest.TestCase):
+
+    def test_both_directions_in_one_descent(self):
+        rng = random.Random(5)
+        for shared, only1, only2 in [(100, 0, 0), (100, 3, 0), (1000, 1, 1), (800, 200, 50), (0, 10, 40)]:
+            keys = rng.sample(range(50000), shared + only1 + only2)
+            keys1 = keys[:shared + only1]
+            keys2 = keys[:shared] + keys[shared + only1:]
+            # Step 1: Node 1 and its peer Node 2 hold overlapping message sets
+            tree1 = ProllyTree([Message(i, i) for i in sorted(keys1)])
+            tree2 = ProllyTree([Message(i, i) for i in sorted(keys2)])
+
+            # Step 2: One reconciliation gives what each side is missing
+            only_in_tree1, only_in_tree2 = reconcile_prolly_trees(tree1.get_root(), tree2.get_root())
+            self.assertEqual(sorted(node.timestamp for node in only_in_tree1), sorted(set(keys1) - set(keys2)))
+            self.assertEqual(sorted(node.timestamp for node in only_in_tree2), sorted(set(keys2) - set(keys1)))
+
+    def test_reconcile_costs_one_session(self):
+        tree1 = ProllyTree([Message(i, i) for i in range(0, 3000) if i % 97])
+        tree2 = ProllyTree([Message(i, i) for i in range(0, 3000) if i % 89])
+        with mock.patch.object(prolly_tree, "get_non_boundary_nodes",
+                               wraps=prolly_tree.get_non_boundary_nodes) as fetched:
+            reconcile_prolly_trees(tree1, tree2)
+            reconcile_fetches = fetched.call_count
+            fetched.reset_mock()
+            find_diff_between_2_prolly_trees(tree1, tree2)
+            find_diff_between_2_prolly_trees(tree2, tree1)
+            two_diff_fetches = fetched.call_count
+        self.assertEqual(2 * reconcile_fetches, two_diff_fetches)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import multiprocessing
+import os
+import tempfile
+import unittest
+from prolly_tree import ProllyTree, Message, Hasher, find_diff_between_2_prolly_trees, reconcile_prolly_trees
+from prolly_compact import CompactProllyTree
+from prolly_sync import SyncClient, SocketTransport, LoopbackTransport, JsonCodec
+from prolly_shared import SharedTreePublisher, SharedTreeReader, SharedSyncServer, SharedSyncWorkers
+
+
+def timestamps(nodes):
+    return sorted(node.timestamp for node in nodes)
+
+
+def _root_in_child(name, queue):
+    with SharedTreeReader(name) as reader:
+        queue.put((reader.generation, reader.tree().get_root().merkel_hash, reader.generation))
+
+
+class TestProllyTreeShared(unittest.TestCase):
+
+    def test_image_in_buffer(self):
+        for hasher in [Hasher(), Hasher("blake2b", hex_digests=False, digest_size=16, boundary_bits=2)]:
+            tree = ProllyTree([Message(i, i) for i in range(700)], hasher=hasher)
+            compact = CompactProllyTree.from_tree(tree)
+            buffer = bytearray(compact.image_size())
+            self.assertEqual(compact.write_image(buffer), len(buffer))
+            loaded = CompactProllyTree.from_buffer(buffer, verify=True)
+            self.assertEqual(loaded.get_root().merkel_hash, tree.get_root().merkel_hash)
+            self.assertEqual(loaded.get_intermediate_node(tree[1].to_list()[0].timestamp, 1).merkel_hash,
+                             tree[1].to_list()[0].merkel_hash)
+            self.assertIsNone(loaded.get_intermediate_node(-1, 1))
+
+    def test_publish_and_switch(self):
+        with SharedTreePublisher() as publisher:
+            tree = ProllyTree([Message(i, i) for i in range(500)])
+            with SharedTreeReader(publisher.name) as reader:
+                # Step 1: Nothing has been published yet
+                with self.assertRaises(LookupError):
+                    reader.tree()
+
+                # Step 2: The reader sees the published tree, and diffs against it like against the tree itself
+                publisher.publish(tree)
+                first = reader.tree()
+                self.assertEqual(first.get_root().merkel_hash, tree.get_root().merkel_hash)
+                other = ProllyTree([Message(i, i) for i in range(490)])
+                self.assertEqual(timestamps(find_diff_between_2_prolly_trees(other, first)), list(range(490, 500)))
+
+                # Step 3: A new image replaces the old one, which stays readable while it is in use
+                tree.insert(Message("new", 1000))
+                self.assertEqual(publisher.publish(tree), 2)
+                second = reader.tree()
+                self.assertEqual(reader.generation, 2)
+                self.assertEqual(second.get_root().merkel_hash, tree.get_root().merkel_hash)
+                self.assertEqual(second.search(1000).data, "new")
+                self.assertIsNone(first.search(1000))
+                self.assertIs(reader.tree(), second)
+
+    def test_reader_in_another_process(self):
+        tree = ProllyTree([Message(i, i) for i in range(300)])
+        with SharedTreePublisher() as publisher:
+            publisher.publish(tree)
+            context = multiprocessing.get_context("spawn")
+            queue = context.Queue()
+            process = context.Process(target=_root_in_child, args=(publisher.name, queue))
+            process.start()
+            before, root_hash, after = queue.get(timeout=30)
+            process.join()
+        self.assertEqual((before, root_hash, after), (0, tree.get_root().merkel_hash, 1))
+
+    def test_session_stays_on_one_image(self):
+        tree1 = ProllyTree([Message(i, i) for i in range(2000)])
+        tree2 = ProllyTree([Message(i, i) for i in range(1990)])
+        with SharedTreePublisher() as publisher, SharedTreeReader(publisher.name) as reader:
+            publisher.publish(tree1)
+            server = SharedSyncServer(reader)
+
+            class Republishing(LoopbackTransport):
+                def _exchange(self, payload):
+                    # a new image is published between every two requests of the session
+                    response = super()._exchange(payload)
+                    tree1.insert(Message("late", 10000 + publisher.generation))
+                    publisher.publish(tree1)
+                    return response
+
+            only_local, only_remote = SyncClient(tree2, Republishing(server)).reconcile()
+            server.tree = None
+        self.assertEqual(only_local, [])
+        self.assertEqual(timestamps(only_remote), list(range(1990, 2000)))
+
+    def test_workers(self):
+        tree1 = ProllyTree([Message(i, i) for i in range(3000)])
+        tree2 = ProllyTree([Message(i, i) for i in range(20, 3010)])
+        with tempfile.TemporaryDirectory() as directory, SharedTreePublisher() as publisher:
+            publisher.publish(tree1)
+            path = os.path.join(directory, "sync.sock")
+            with SharedSyncWorkers(publisher.name, path, workers=2):
+                for _ in range(2):
+                    transport = SocketTransport.connect(path)
+                    try:
+                        only_local, only_remote = SyncClient(tree2, transport).reconcile()
+                    finally:
+                        transport.close()
+                    expected_local, expected_remote = reconcile_prolly_trees(tree2, tree1)
+                    self.assertEqual(timestamps(only_local), timestamps(expected_local))
+                    self.assertEqual(timestamps(only_remote), timestamps(expected_remote))
+                    # the workers switch to the new image for the next session
+                    tree1.insert(Message("new", 5000))
+                    publisher.publish(tree1)
+
+    def test_bad_requests_do_not_stop_workers(self):
+        tree1 = ProllyTree([Message(i, i) for i in range(300)])
+        tree2 = ProllyTree([Message(i, i) for i in range(290)])
+        with tempfile.TemporaryDirectory() as directory, SharedTreePublisher() as publisher:
+            publisher.publish(tree1)
+            path = os.path.join(directory, "sync.sock")
+            with SharedSyncWorkers(publisher.name, path, workers=1):
+                # Step 1: A malformed frame, an unknown request and a missing field each close their connection
+                for payload in [b"not json", JsonCodec().encode({"op": "bogus"}), JsonCodec().encode({})]:
+                    transport = SocketTransport.connect(path)
+                    with self.assertRaises(ConnectionError):
+                        transport.request(payload)
+                    transport.close()
+
+                # Step 2: The single worker still answers a session
+                transport = SocketTransport.connect(path)
+                try:
+                    _, only_remote = SyncClient(tree2, transport).reconcile()
+                finally:
+                    transport.close()
+                self.assertEqual(timestamps(only_remote), list(range(290, 300)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import gc
+import random
+import threading
+import unittest
+from prolly_tree import ProllyTree, Message, Hasher, reconcile_prolly_trees, find_diff_between_2_prolly_trees
+from prolly_sync import SyncServer, SyncClient, LoopbackTransport
+
+
+def leaves(view):
+    return [(n.timestamp, n.data) for n in view.range()]
+
+
+class TestProllyTreeSnapshot(unittest.TestCase):
+
+    def test_snapshot_is_frozen_while_the_tree_changes(self):
+        rng = random.Random(6)
+        for hasher in [Hasher(), Hasher("blake2b", hex_digests=False, digest_size=16, boundary_bits=2)]:
+            # Step 1: Take a snapshot and remember what the tree looks like
+            tree = ProllyTree([Message(i, i) for i in range(0, 4000, 2)], hasher=hasher)
+            snapshot = tree.snapshot()
+            expected_leaves = leaves(tree)
+            expected_root = tree.get_root().merkel_hash
+            frozen = ProllyTree([Message(i, i) for i in range(0, 4000, 2)], hasher=hasher)
+
+            # Step 2: Insert, batch insert and delete around it
+            for _ in range(200):
+                tree.insert(Message("new", rng.randrange(4000, 8000) * 2 + 1))
+                tree.delete(rng.randrange(0, 4000, 2))
+            tree.insert_many([Message("batch", i) for i in range(1, 400, 2)])
+
+            # Step 3: The snapshot still reads the old version
+            self.assertEqual(snapshot.get_root().merkel_hash, expected_root)
+            self.assertEqual(leaves(snapshot), expected_leaves)
+            self.assertEqual(snapshot.search(1000).data, 1000)
+            self.assertIsNone(snapshot.search(1))
+            self.assertEqual(reconcile_prolly_trees(snapshot, frozen), ([], []))
+
+            # Step 4: Only the buckets on the changed paths were copied
+            self.assertLess(snapshot.saved_buckets(), 601 * len(tree))
+
+            # Step 5: The diff between the versions is what changed
+            only_old, only_new = reconcile_prolly_trees(snapshot, tree)
+            self.assertEqual({n.timestamp for n in only_old}, {t for t, _ in expected_leaves} - {t for t, _ in leaves(tree)})
+            self.assertEqual({n.timestamp for n in only_new}, {t for t, _ in leaves(tree)} - {t for t, _ in expected_leaves})
+            snapshot.release()
+
+    def test_many_versions_and_release(self):
+        tree = ProllyTree([Message(i, i) for i in range(500)])
+        versions = []
+        # Step 1: Snapshot after every batch of inserts
+        for batch in range(5):
+            versions.append((tree.snapshot(), leaves(tree)))
+            tree.insert_many([Message(i, i) for i in range(1000 + batch * 50, 1050 + batch * 50)])
+        # Step 2: Every version reads as it was
+        for snapshot, expected in versions:
+            self.assertEqual(leaves(snapshot), expected)
+
+        # Step 3: Released and dropped snapshots stop following the tree
+        versions[0][0].release()
+        del versions[1:], snapshot
+        gc.collect()
+        self.assertEqual(len(tree._snapshots), 0)
+
+    def test_sync_reads_a_snapshot_while_writer_runs(self):
+        tree = ProllyTree([Message(i, i) for i in range(3000)])
+        peer = ProllyTree([Message(i, i) for i in range(3000) if i % 100])
+        snapshot = tree.snapshot()
+
+        # Step 1: A writer thread keeps inserting while the snapshot is served to a peer
+        def write():
+            for i in range(3000, 5000):
+                tree.insert(Message(i, i))
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        client = SyncClient(peer, LoopbackTransport(SyncServer(snapshot)))
+        only_local, only_remote = client.reconcile()
+        writer.join()
+
+        # Step 2: The peer sees exactly the messages of the snapshot it lacks
+        self.assertEqual(only_local, [])
+        self.assertEqual([n.timestamp for n in only_remote], list(range(0, 3000, 100)))
+        self.assertEqual(len(find_diff_between_2_prolly_trees(snapshot, tree)), 2000)
+
+
+if __name__ == '__main__':
+    unittest.main()
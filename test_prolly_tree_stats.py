@@ -0,0 +1,71 @@
+import unittest
+from prolly_tree import ProllyTree, Message, Hasher, reconcile_prolly_trees, find_diff_between_2_prolly_trees
+from prolly_sync import SyncServer, SyncClient, LoopbackTransport
+
+
+class TestProllyTreeStats(unittest.TestCase):
+
+    def test_operations_are_counted(self):
+        tree = ProllyTree([Message(i, i) for i in range(1000)])
+        calls = []
+        # Step 1: Instrument the tree with a hook that collects what every operation cost
+        tree.instrument(lambda operation, counts: calls.append((operation, counts)))
+        tree.insert(Message(5000, 5000))
+        tree.search(10)
+        tree.delete(20)
+
+        # Step 2: The hook saw each operation once; the search inside delete is part of the delete
+        self.assertEqual([operation for operation, _ in calls], ["insert", "search", "delete"])
+        insert_counts = calls[0][1]
+        self.assertEqual(insert_counts["calls"], 1)
+        self.assertEqual(insert_counts["leaf_hashes"], 1)
+        self.assertGreater(calls[1][1]["hops"], 0)
+
+        # Step 3: Reading the root refreshes the stale merkel hashes, which shows in the totals
+        tree.get_root().merkel_hash
+        stats = tree.stats()
+        self.assertGreater(stats["totals"]["bucket_hashes"], 0)
+        self.assertEqual(stats["operations"]["search"]["calls"], 1)
+        self.assertEqual(stats["totals"]["hops"], sum(counts["hops"] for _, counts in calls))
+
+    def test_instrumented_tree_behaves_the_same(self):
+        messages = [Message(i, i) for i in range(0, 3000, 3)]
+        plain = ProllyTree(messages)
+        # Step 1: Only the instrumented tree counts, although both use the default hasher
+        instrumented = ProllyTree(messages).instrument()
+        for tree in [plain, instrumented]:
+            tree.insert_many([Message(i, i) for i in range(1, 300, 3)])
+            tree.delete_range(100, 200)
+        self.assertEqual(plain.stats(), {"totals": {}, "operations": {}})
+        self.assertEqual(instrumented.get_root().merkel_hash, plain.get_root().merkel_hash)
+
+        # Step 2: Switching the counters off brings back the plain classes and keeps what was counted
+        totals = instrumented.stats()["totals"]
+        instrumented.uninstrument()
+        self.assertIs(type(instrumented), ProllyTree)
+        self.assertIs(type(instrumented.hasher), Hasher)
+        instrumented.insert(Message(9999, 9999))
+        instrumented.get_root().merkel_hash
+        self.assertEqual(instrumented.stats()["totals"], totals)
+
+    def test_diff_and_sync_sessions(self):
+        tree1 = ProllyTree([Message(i, i) for i in range(2000)]).instrument()
+        tree2 = ProllyTree([Message(i, i) for i in range(2000) if i != 500])
+        # Step 1: A diff and a sync session on the instrumented tree are counted as operations
+        reconcile_prolly_trees(tree1, tree2)
+        SyncClient(tree1, LoopbackTransport(SyncServer(tree2))).reconcile()
+        operations = tree1.stats()["operations"]
+        self.assertGreater(operations["reconcile"]["bucket_reads"], 0)
+        self.assertGreater(operations["sync"]["bucket_reads"], 0)
+        self.assertEqual(operations["sync"]["leaf_hashes"], 0)
+
+        # Step 2: Root nodes, as the original diff calls pass them, are counted too, on either side
+        tree2.instrument()
+        find_diff_between_2_prolly_trees(tree2.get_root(), tree1.get_root())
+        for tree in [tree1, tree2]:
+            self.assertEqual(tree.stats()["operations"]["diff"]["calls"], 1)
+            self.assertGreater(tree.stats()["operations"]["diff"]["bucket_reads"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import os
+import tempfile
+import tracemalloc
+import unittest
+from prolly_tree import ProllyTree, Message, Hasher, reconcile_prolly_trees
+from prolly_store import BucketStore
+from prolly_sync import SyncServer, SyncClient, LoopbackTransport
+
+
+class TestProllyTreeStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = BucketStore(os.path.join(self.directory.name, "buckets.db"))
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def test_stored_tree_reads_like_the_tree(self):
+        for hasher in [Hasher(), Hasher("blake2b", hex_digests=False, digest_size=16, boundary_bits=3)]:
+            # Step 1: Save a tree and open it again
+            tree = ProllyTree([Message(f"m{i}", i) for i in range(0, 3000, 2)], hasher=hasher)
+            self.store.save(tree, name=repr(hasher))
+            stored = self.store.open(name=repr(hasher))
+
+            # Step 2: Same root, same leaves, same lookups
+            self.assertEqual(len(stored), len(tree))
+            self.assertEqual(stored.get_root().merkel_hash, tree.get_root().merkel_hash)
+            self.assertEqual([(n.timestamp, n.data) for n in stored.range()],
+                             [(n.timestamp, n.data) for n in tree.range()])
+            self.assertEqual([n.timestamp for n in stored.range(101, 201)], list(range(102, 201, 2)))
+            self.assertEqual(stored.search(1234).data, "m1234")
+            self.assertIsNone(stored.search(1235))
+            promoted = tree.get_root().down.left
+            self.assertEqual(stored.get_intermediate_node(promoted.timestamp, promoted.level).merkel_hash,
+                             promoted.merkel_hash)
+
+    def test_diff_only_loads_the_buckets_it_reaches(self):
+        # Step 1: The archive is on disk, a peer differs from it by a few messages
+        tree = ProllyTree([Message(i, i) for i in range(20000)])
+        self.store.save(tree)
+        peer = ProllyTree([Message(i, i) for i in range(20000) if i not in (77, 9000, 15000)])
+        stored = self.store.open(cache_bytes=1 << 16)
+
+        # Step 2: The diff finds the missing messages
+        only_stored, only_peer = reconcile_prolly_trees(stored, peer)
+        self.assertEqual([n.timestamp for n in only_stored], [77, 9000, 15000])
+        self.assertEqual(only_peer, [])
+
+        # Step 3: Only a small part of the store was read and the cache stayed in its budget
+        self.assertLess(stored.loads, self.store.bucket_count() // 20)
+        self.assertLessEqual(stored.cached_bytes, 1 << 16)
+
+        # Step 4: The stored tree can be served to a peer as well
+        only_local, only_remote = SyncClient(peer, LoopbackTransport(SyncServer(stored))).reconcile()
+        self.assertEqual([n.timestamp for n in only_remote], [77, 9000, 15000])
+
+    def test_scan_stays_in_the_cache_budget(self):
+        # Step 1: A store many times larger than the cache
+        cache_bytes = 1 << 18
+        self.store.save(ProllyTree([Message(f"m{i}", i) for i in range(50000)]))
+        stored = self.store.open(cache_bytes=cache_bytes, resident_levels=1)
+
+        # Step 2: Scan every leaf and keep none of them
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            self.assertEqual(sum(1 for _ in stored.range()), 50000)
+            held = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+
+        # Step 3: What the cache holds is about its budget, plus the LRU bookkeeping
+        self.assertGreater(stored.loads, 100)
+        self.assertLessEqual(stored.cached_bytes, cache_bytes)
+        self.assertLess(held, cache_bytes * 2)
+
+    def test_saving_again_writes_only_changed_buckets(self):
+        tree = ProllyTree([Message(i, i) for i in range(5000)])
+        first = self.store.save(tree)
+        # Step 1: Nothing changed, nothing written
+        self.assertEqual(self.store.save(tree), 0)
+
+        # Step 2: One new message rewrites its path only
+        tree.insert(Message("new", 2500.5))
+        self.assertLess(self.store.save(tree), len(tree) * 4)
+        self.assertEqual(self.store.open().search(2500.5).data, "new")
+        self.assertGreater(first, 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
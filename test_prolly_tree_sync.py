@@ -0,0 +1,64 @@
+import random
+import socket
+import threading
+import unittest
+from prolly_tree import ProllyTree, Message, Hasher, reconcile_prolly_trees
+from prolly_sync import SyncServer, SyncClient, LoopbackTransport, SocketTransport
+
+
+def build_pair(shared, only1, only2, seed=9, hasher=Hasher()):
+    rng = random.Random(seed)
+    keys = rng.sample(range(100000), shared + only1 + only2)
+    keys1 = keys[:shared + only1]
+    keys2 = keys[:shared] + keys[shared + only1:]
+    return (ProllyTree([Message(i, i) for i in sorted(keys1)], hasher=hasher),
+            ProllyTree([Message(i, i) for i in sorted(keys2)], hasher=hasher))
+
+
+def timestamps(nodes):
+    return sorted(node.timestamp for node in nodes)
+
+
+class TestProllyTreeSync(unittest.TestCase):
+
+    def test_loopback_sync_matches_local_reconcile(self):
+        for shared, only1, only2 in [(500, 0, 0), (500, 1, 0), (2000, 20, 30), (10, 300, 200)]:
+            # Step 1: Node 1 keeps its tree and Node 2 serves its tree over an in-memory transport
+            tree1, tree2 = build_pair(shared, only1, only2)
+            client = SyncClient(tree1, LoopbackTransport(SyncServer(tree2)))
+
+            # Step 2: The session finds what reconciling the two trees in one process finds
+            only_local, only_remote = client.reconcile()
+            expected_local, expected_remote = reconcile_prolly_trees(tree1, tree2)
+            self.assertEqual(timestamps(only_local), timestamps(expected_local))
+            self.assertEqual(timestamps(only_remote), timestamps(expected_remote))
+
+            # Step 3: One round trip for the root and at most one per level below it
+            self.assertLessEqual(client.stats.round_trips, max(len(tree1), len(tree2)))
+            self.assertGreater(client.stats.bytes_received, 0)
+
+    def test_identical_trees_take_one_round_trip(self):
+        tree1, tree2 = build_pair(300, 0, 0)
+        client = SyncClient(tree1, LoopbackTransport(SyncServer(tree2)))
+        self.assertEqual(client.reconcile(), ([], []))
+        self.assertEqual(client.stats.round_trips, 1)
+
+    def test_socket_transport(self):
+        tree1, tree2 = build_pair(1000, 15, 25, hasher=Hasher(hex_digests=False))
+        client_sock, server_sock = socket.socketpair()
+        server = threading.Thread(target=SyncServer(tree2).serve_connection, args=(server_sock,))
+        server.start()
+        transport = SocketTransport(client_sock)
+        try:
+            only_local, only_remote = SyncClient(tree1, transport).reconcile()
+        finally:
+            transport.close()
+            server.join()
+        expected_local, expected_remote = reconcile_prolly_trees(tree1, tree2)
+        self.assertEqual(timestamps(only_local), timestamps(expected_local))
+        self.assertEqual(timestamps(only_remote), timestamps(expected_remote))
+        self.assertEqual(transport.stats.bytes_sent > 0, True)
+
+
+if __name__ == '__main__':
+    unittest.main()
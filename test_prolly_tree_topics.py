@@ -0,0 +1,141 @@
+import random
+import sys
+import unittest
+from prolly_tree import ProllyTree, Message, Hasher, reconcile_prolly_trees
+from prolly_sync import SyncClient, SyncServer, LoopbackTransport
+from prolly_wire import BinaryCodec
+from prolly_topics import TopicTrees, TopicSyncServer, TopicSyncClient, BucketCache
+
+
+def timestamps(nodes):
+    return sorted(node.timestamp for node in nodes)
+
+
+def build_pair(topic_count=12, per_topic=400, changed=(3, 7), hasher=Hasher()):
+    topics1, topics2 = TopicTrees(hasher), TopicTrees(hasher)
+    for t in range(topic_count):
+        topic = f"/waku/2/topic-{t}/proto"
+        for i in range(per_topic):
+            topics1.insert(topic, Message(i, i * 10 + t))
+            if t not in changed or i % 50:
+                topics2.insert(topic, Message(i, i * 10 + t))
+    return topics1, topics2
+
+
+class TestProllyTreeTopics(unittest.TestCase):
+
+    def test_routing_and_combined_root(self):
+        topics = TopicTrees()
+        # Step 1: Messages are routed by topic, and the same timestamp can live in two topics
+        topics.insert("a", Message("x", 1))
+        topics.insert_many("b", [Message("y", 1), Message("z", 2)])
+        self.assertEqual(topics.search("a", 1).data, "x")
+        self.assertEqual(topics.search("b", 1).data, "y")
+        self.assertIsNone(topics.search("a", 2))
+        self.assertIsNone(topics.search("c", 1))
+        self.assertEqual(topics.topics(), ["a", "b"])
+
+        # Step 2: The combined root follows every topic root and does not depend on the order of the inserts
+        other = TopicTrees()
+        other.insert_many("b", [Message("z", 2), Message("y", 1)])
+        self.assertNotEqual(other.get_root().merkel_hash, topics.get_root().merkel_hash)
+        other.insert("a", Message("x", 1))
+        self.assertEqual(other.get_root().merkel_hash, topics.get_root().merkel_hash)
+
+        # Step 3: Deleting the last message of a topic removes the topic
+        root_hash = topics.get_root().merkel_hash
+        topics.insert("c", Message("w", 5))
+        self.assertEqual(topics.delete("c", 5).timestamp, 5)
+        self.assertEqual(topics.topics(), ["a", "b"])
+        self.assertEqual(topics.get_root().merkel_hash, root_hash)
+        topics.drop_topic("b")
+        self.assertEqual(topics.topics(), ["a"])
+
+    def test_local_reconcile(self):
+        topics1, topics2 = build_pair()
+        topics1.insert("/only/1", Message(1, 1))
+        topics2.insert("/only/2", Message(2, 2))
+        differences = topics1.reconcile(topics2)
+        self.assertEqual(sorted(differences), ["/only/1", "/only/2", "/waku/2/topic-3/proto", "/waku/2/topic-7/proto"])
+        self.assertEqual(timestamps(differences["/waku/2/topic-3/proto"][0]), [i * 10 + 3 for i in range(0, 400, 50)])
+        self.assertEqual(differences["/only/2"][0], [])
+        self.assertEqual(timestamps(differences["/only/2"][1]), [2])
+
+    def test_one_session_for_all_topics(self):
+        for hasher, codec, hash_prefix in [(Hasher(), None, None), (Hasher(hex_digests=False), BinaryCodec(), 8),
+                                           (Hasher(), None, 1)]:
+            topics1, topics2 = build_pair(hasher=hasher)
+            topics1.insert("/only/1", Message(1, 1))
+            topics2.insert("/only/2", Message(2, 2))
+            server = TopicSyncServer(topics1, codec)
+            client = TopicSyncClient(topics2, LoopbackTransport(server), codec, hash_prefix=hash_prefix)
+
+            # Step 1: The session finds what reconciling every pair of topic trees finds
+            differences = client.reconcile()
+            self.assertEqual(sorted(differences), sorted(topics2.reconcile(topics1)))
+            for topic, (only_local, only_remote) in differences.items():
+                tree1 = topics1.tree(topic) or ProllyTree(hasher=hasher)
+                tree2 = topics2.tree(topic) or ProllyTree(hasher=hasher)
+                expected_local, expected_remote = reconcile_prolly_trees(tree2, tree1)
+                self.assertEqual(timestamps(only_local), timestamps(expected_local))
+                self.assertEqual(timestamps(only_remote), timestamps(expected_remote))
+
+            # Step 2: Topics with matching roots are skipped and the topics share round trips
+            self.assertEqual(client.skipped_topics, 10)
+            separate = 0
+            for t in (3, 7):
+                topic = f"/waku/2/topic-{t}/proto"
+                single = SyncClient(topics2.tree(topic), LoopbackTransport(SyncServer(topics1.tree(topic))))
+                single.reconcile()
+                separate += single.stats.round_trips
+            self.assertLess(client.stats.round_trips, separate + 2)
+
+            # Step 3: A second session is answered from the shared bucket cache
+            misses = topics1.cache.misses
+            TopicSyncClient(topics2, LoopbackTransport(server), codec, hash_prefix=hash_prefix).reconcile()
+            self.assertEqual(topics1.cache.misses, misses)
+            self.assertGreater(topics1.cache.hits, 0)
+
+    def test_prefix_collisions_never_change_the_result(self):
+        # every topic is checked against its full root hash, so one-byte prefixes still give exact differences
+        hasher = Hasher(hex_digests=False)
+        for seed in range(5):
+            rng = random.Random(seed)
+            topics1, topics2 = TopicTrees(hasher), TopicTrees(hasher)
+            expected = {}
+            for t in range(4):
+                topic = f"/waku/2/topic-{t}/proto"
+                keys = rng.sample(range(10 ** 9), 1600)
+                topics1.insert_many(topic, [Message(k, k) for k in keys])
+                topics2.insert_many(topic, [Message(k, k) for k in keys[:1500]])
+                expected[topic] = ([], sorted(keys[1500:]))
+            client = TopicSyncClient(topics2, LoopbackTransport(TopicSyncServer(topics1)), hash_prefix=1)
+            differences = client.reconcile()
+            self.assertEqual({topic: (timestamps(only_local), timestamps(only_remote))
+                              for topic, (only_local, only_remote) in differences.items()}, expected)
+
+    def test_equal_roots_take_one_round_trip(self):
+        topics1, topics2 = build_pair(changed=())
+        client = TopicSyncClient(topics2, LoopbackTransport(TopicSyncServer(topics1)))
+        self.assertEqual(client.reconcile(), {})
+        self.assertEqual(client.stats.round_trips, 1)
+
+    def test_bucket_cache_is_bounded(self):
+        cache = BucketCache(max_bytes=1000)
+        for i in range(100):
+            cache.put(i, [[i, "ab" * 32]])
+        self.assertLessEqual(cache.cached_bytes, 1000)
+        self.assertIsNone(cache.get(0))
+        self.assertEqual(cache.get(99), [[99, "ab" * 32]])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # entries are counted with what the lists and strings take in memory, not just their payload
+        cache = BucketCache()
+        entries = [[i, "ab" * 32] for i in range(10)]
+        cache.put(0, entries)
+        self.assertGreaterEqual(cache.cached_bytes, sum(sys.getsizeof(entry) + sys.getsizeof(entry[1])
+                                                        for entry in entries))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import random
+import unittest
+from prolly_tree import ProllyTree, Message, Hasher, reconcile_prolly_trees
+from prolly_sync import SyncServer, SyncClient, LoopbackTransport, HashPrefix
+from prolly_wire import BinaryCodec, WireWriter, WireReader
+
+
+def timestamps(nodes):
+    return sorted(node.timestamp for node in nodes)
+
+
+class TestProllyTreeWire(unittest.TestCase):
+
+    def test_runs(self):
+        # Step 1: Timestamps of any sign and order, with and without hashes and a trailing tail
+        runs = [[], [5], [None], [0, 1, 2, 2 ** 62, None], [-7, 300, -2 ** 40, 12]]
+        writer = WireWriter()
+        previous = 0
+        for run in runs:
+            previous = writer.run(run, previous=previous)
+            previous = writer.run([(t, bytes([i]) * 3) for i, t in enumerate(run)], 3, previous)
+
+        # Step 2: Reading them back from a memoryview gives the same entries
+        reader = WireReader(memoryview(bytes(writer.out)))
+        previous = 0
+        for run in runs:
+            self.assertEqual(list(reader.run(previous=previous)), run)
+            previous = next((t for t in reversed(run) if t is not None), previous)
+            self.assertEqual(list(reader.run(3, previous)), [(t, bytes([i]) * 3) for i, t in enumerate(run)])
+            previous = next((t for t in reversed(run) if t is not None), previous)
+        self.assertEqual(reader.offset, len(writer.out))
+
+    def test_codec(self):
+        codec = BinaryCodec()
+        messages = [
+            {"op": "root"},
+            {"op": "children", "level": 3, "owners": [10, 20, None], "id": 0},
+            {"op": "children", "level": 1, "owners": [10], "hash_prefix": 8},
+            {"children": [[[10, "ab" * 32], [12, "cd" * 32]], [], [[None, "ef" * 32]]], "id": 41},
+            {"children": []},
+            {"op": "children", "level": 1, "owners": ["a", "b"]},
+            {"children": [[["a", "ab" * 32]]]},
+            {"cells": None},
+        ]
+        for message in messages:
+            decoded = codec.decode(codec.encode(message))
+            if "children" in message:
+                # hashes come back as raw bytes
+                decoded["children"] = [[[t, h if isinstance(h, str) else h.hex()] for t, h in bucket]
+                                       for bucket in decoded["children"]]
+            self.assertEqual(decoded, message)
+        # a run of 32-byte hashes with integer timestamps takes a little over 33 bytes per entry
+        entries = [[1700000000000000000 + 1000 * i, "ab" * 32] for i in range(1000)]
+        self.assertLess(len(codec.encode({"children": [entries]})), 1000 * 36)
+
+    def test_hash_prefix(self):
+        self.assertEqual(HashPrefix(b"\xab\xcd"), b"\xab\xcd\xef")
+        self.assertEqual("abcdef", HashPrefix(b"\xab\xcd"))
+        self.assertNotEqual("abceef", HashPrefix(b"\xab\xcd\xef"))
+        self.assertFalse(b"\xab\xce" != HashPrefix(b"\xab"))
+
+    def test_sync(self):
+        for hasher in [Hasher(), Hasher(hex_digests=False, boundary_bits=3)]:
+            tree1 = ProllyTree([Message(i, i * 1000) for i in range(20000)], hasher=hasher)
+            tree2 = ProllyTree([Message(i, i * 1000) for i in range(20000) if i % 97], hasher=hasher)
+            expected_local, expected_remote = reconcile_prolly_trees(tree2, tree1)
+            codec = BinaryCodec()
+            for hash_prefix in [None, 8, 1]:
+                # Step 1: The binary codec, with or without truncated hashes, finds what the local reconcile finds
+                client = SyncClient(tree2, LoopbackTransport(SyncServer(tree1, codec)), codec, hash_prefix=hash_prefix)
+                only_local, only_remote = client.reconcile()
+                self.assertEqual(timestamps(only_local), timestamps(expected_local))
+                self.assertEqual(timestamps(only_remote), timestamps(expected_remote))
+
+                # Step 2: Leaves always come with their full hashes
+                self.assertEqual(sorted(n.merkel_hash for n in only_remote),
+                                 sorted(n.merkel_hash for n in expected_remote))
+
+    def test_prefix_collision_falls_back(self):
+        # with one-byte prefixes these trees collide under a mismatching owner, which restarts the session
+        tree1 = ProllyTree([Message(i, i * 1000) for i in range(20000)])
+        tree2 = ProllyTree([Message(i, i * 1000) for i in range(20000) if i % 97])
+        client = SyncClient(tree2, LoopbackTransport(SyncServer(tree1)), hash_prefix=1)
+        only_local, only_remote = client.reconcile()
+        self.assertTrue(client.prefix_collided)
+        self.assertEqual(only_local, [])
+        self.assertEqual(timestamps(only_remote), [i * 1000 for i in range(0, 20000, 97)])
+
+        # truncation pays off above the leaves
+        full = SyncClient(tree2, LoopbackTransport(SyncServer(tree1)))
+        full.reconcile()
+        truncated = SyncClient(tree2, LoopbackTransport(SyncServer(tree1)), hash_prefix=8)
+        truncated.reconcile()
+        self.assertFalse(truncated.prefix_collided)
+        self.assertLess(truncated.stats.bytes_received, full.stats.bytes_received)
+
+    def test_prefix_collisions_never_change_the_result(self):
+        # one-byte prefixes collide all the time, also where no group is left without mismatching children
+        hasher = Hasher(hex_digests=False)
+        for seed in range(20):
+            rng = random.Random(seed)
+            keys = rng.sample(range(10 ** 9), 3200)
+            local = ProllyTree.from_sorted_iter([Message(k, k) for k in sorted(keys[:3000])], hasher=hasher)
+            peer = ProllyTree.from_sorted_iter([Message(k, k) for k in sorted(keys)], hasher=hasher)
+            for k in keys[:3000:150]:
+                peer.delete(k)
+            client = SyncClient(local, LoopbackTransport(SyncServer(peer)), hash_prefix=1)
+            only_local, only_remote = client.reconcile()
+            self.assertEqual(timestamps(only_local), sorted(keys[:3000:150]))
+            self.assertEqual(timestamps(only_remote), sorted(keys[3000:]))
+
+
+if __name__ == '__main__':
+    unittest.main()